@@ -1,5 +1,6 @@
 from functools import lru_cache
 from pathlib import Path
+from typing import Dict, Optional
 
 from pydantic import BaseSettings
 
@@ -11,7 +12,74 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     SIGNUPS_ALLOWED: bool = True
     HISTORY_LOG: bool = True
+    # history is written in batches, once the buffer is full or after the
+    # interval (in seconds). durable makes requests wait for the write
+    HISTORY_BUFFER_SIZE: int = 500
+    HISTORY_FLUSH_INTERVAL: float = 1
+    HISTORY_DURABLE: bool = False
+    # days to keep history for, in total & for each type by name
+    # e.g. {"DOWNLOAD": 30}, 0 keeps forever. downloads older than
+    # the rollup days are folded into daily counts, 0 disables
+    HISTORY_RETENTION_DAYS: int = 0
+    HISTORY_RETENTION_BY_TYPE: Dict[str, int] = {}
+    HISTORY_ROLLUP_DAYS: int = 0
+    # hours between history compactions & the rows changed
+    # in each transaction, an interval of 0 disables
+    HISTORY_COMPACT_INTERVAL: int = 24
+    HISTORY_COMPACT_CHUNK_SIZE: int = 1000
     DEFAULT_ADMIN_UNAME: str = "admin"
+    # max bytes of an upload to hold in memory at once
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+    # max bytes of a download to hold in memory at once
+    DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+    # threads used for blocking filesystem calls
+    FS_THREAD_POOL_SIZE: int = 16
+    # processes used to hash passwords & how many hashes can wait for one,
+    # before requests are turned away
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 64
+    # processes used to compress zip entries, defaults to cpu count
+    ZIP_COMPRESS_WORKERS: Optional[int] = None
+    # where generated zips are cached, a max size of 0 disables the cache
+    ZIP_CACHE_PATH: Path = Path("data/cache/zips")
+    ZIP_CACHE_MAX_BYTES: int = 0
+    # compress text downloads when accepted by the client,
+    # compressed copies are cached to avoid compressing again,
+    # a max size of 0 disables the cache
+    DOWNLOAD_COMPRESSION: bool = True
+    DOWNLOAD_COMPRESSION_MIN_SIZE: int = 1024
+    DOWNLOAD_COMPRESSION_CACHE_PATH: Path = Path("data/cache/encoded")
+    DOWNLOAD_COMPRESSION_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # how many directory listings to keep in memory, 0 disables
+    LISTING_CACHE_SIZE: int = 256
+    # seconds between full reconciles of the metadata index, 0 disables
+    INDEX_RECONCILE_INTERVAL: int = 60 * 60 * 24
+    # whether to store a sha256 of file contents in the metadata index
+    INDEX_CONTENT_HASH: bool = False
+    # max bytes for each users home (unless set on the user) & the shared
+    # directory, 0 disables
+    USER_QUOTA_BYTES: int = 0
+    SHARED_QUOTA_BYTES: int = 0
+    # hours an upload session can go without new chunks before it expires,
+    # freeing its space in the quota, 0 never expires
+    UPLOAD_SESSION_EXPIRE_HOURS: int = 24
+    # seconds between removing expired upload sessions & their files, 0 disables
+    UPLOAD_SESSION_SWEEP_INTERVAL: int = 60 * 60
+    # how many authenticated users to cache & for how many seconds, 0 disables
+    USER_CACHE_SIZE: int = 1024
+    USER_CACHE_TTL: int = 60
+    # how many path ids to cache for history & shares, 0 disables
+    FAKE_PATH_CACHE_SIZE: int = 4096
+    # max background jobs to run at once, in total & for each job type
+    JOB_WORKERS: int = 4
+    JOB_CONCURRENCY: Dict[str, int] = {
+        "delete_directory": 2,
+        "delete_user": 1,
+        "create_zip": 1,
+        "compact_history": 1,
+    }
+    # where the files made by background jobs are kept
+    JOB_RESULTS_PATH: Path = Path("data/jobs")
 
     HOST: str = "127.0.0.1"
     PORT: int = 8000
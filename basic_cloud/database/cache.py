@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+from uuid import UUID
+
+from ..config import get_settings
+from .models import User
+
+
+class UserCache:
+    """
+    static class for caching users by uuid, so authenticating
+    a request does not need a database lookup. entries are removed
+    when the user is changed, and expire in case they are
+    changed by another process
+    """
+    _entries: "OrderedDict[UUID, Tuple[float, User]]" = OrderedDict()
+    _generations: Dict[UUID, int] = {}
+
+    @staticmethod
+    def get_generation(user_uuid: UUID) -> int:
+        """
+        gets how many times a user has been invalidated,
+        read before loading the user to pass to set
+
+            :param user_uuid: the users uuid
+            :return: the generation
+        """
+        return UserCache._generations.get(user_uuid, 0)
+
+    @staticmethod
+    def get(user_uuid: UUID) -> Optional[User]:
+        """
+        gets a user from the cache
+
+            :param user_uuid: the users uuid
+            :return: the user, or None if not cached or expired
+        """
+        entry = UserCache._entries.get(user_uuid)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            UserCache._entries.pop(user_uuid, None)
+            return None
+        UserCache._entries.move_to_end(user_uuid)
+        return user
+
+    @staticmethod
+    def set(user: User, generation: int):
+        """
+        adds a user to the cache
+
+            :param user: the user
+            :param generation: from get_generation, before the user was loaded
+        """
+        max_size = get_settings().USER_CACHE_SIZE
+        if max_size <= 0:
+            return
+        if generation != UserCache.get_generation(user.uuid):
+            # was changed while being loaded, so may be out of date
+            return
+        UserCache._entries[user.uuid] = (
+            time.monotonic() + get_settings().USER_CACHE_TTL,
+            user,
+        )
+        UserCache._entries.move_to_end(user.uuid)
+        while len(UserCache._entries) > max_size:
+            UserCache._entries.popitem(last=False)
+
+    @staticmethod
+    def invalidate(user_uuid: UUID):
+        UserCache._generations[user_uuid] = UserCache.get_generation(user_uuid) + 1
+        UserCache._entries.pop(user_uuid, None)
+
+
+class FakePathCache:
+    """
+    static class for caching fake path ids by path, so recording
+    history or sharing a path skips hashing it & the database lookup.
+    entries are removed when the fake path is deleted
+    """
+    _entries: "OrderedDict[str, int]" = OrderedDict()
+
+    @staticmethod
+    def get(path: Union[Path, str]) -> Optional[int]:
+        """
+        gets a fake path id from the cache
+
+            :param path: the path
+            :return: the id, or None if not cached
+        """
+        # keyed the same way the path is hashed
+        key = str(path)
+        fake_path_id = FakePathCache._entries.get(key)
+        if fake_path_id is not None:
+            FakePathCache._entries.move_to_end(key)
+        return fake_path_id
+
+    @staticmethod
+    def set(path: Union[Path, str], fake_path_id: int):
+        max_size = get_settings().FAKE_PATH_CACHE_SIZE
+        if max_size <= 0:
+            return
+        key = str(path)
+        FakePathCache._entries[key] = fake_path_id
+        FakePathCache._entries.move_to_end(key)
+        while len(FakePathCache._entries) > max_size:
+            FakePathCache._entries.popitem(last=False)
+
+    @staticmethod
+    def invalidate(path: Union[Path, str]):
+        FakePathCache._entries.pop(str(path), None)
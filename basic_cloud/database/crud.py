@@ -1,10 +1,23 @@
-from datetime import datetime
+from collections import Counter
+from datetime import date, datetime
+from functools import reduce
+from operator import or_
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from uuid import UUID
 
-from ..helpers.constants import ContentChangeTypes
-from .models import ContentChange, FakePath, Share, User
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F, Q, Subquery
+from tortoise.functions import Count, Sum
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
+
+from ..helpers.constants import ContentChangeTypes, JobStatus, JobType
+from .cache import FakePathCache, UserCache
+from .models import (ContentChange, DownloadRollup, FakePath, IndexedPath,
+                     IndexState, Job, Share, StorageUsage, UploadChunk,
+                     UploadSession, User)
 from .models import Share as FileShare
 
 # USER CRUD
@@ -36,19 +49,29 @@ async def get_user_by_username(username: str) -> User:
     return await User.filter(username=username).get_or_none()
 
 
+async def get_first_admin_user() -> Optional[User]:
+    return await User.filter(is_admin=True, disabled=False).order_by("created_at").first()
+
+
 async def get_user_by_uuid(user_uuid: UUID) -> User:
     return await User.filter(uuid=user_uuid).get_or_none()
 
 
+async def get_existing_user_uuids(user_uuids: Set[UUID]) -> Set[UUID]:
+    return set(await User.filter(uuid__in=user_uuids).values_list("uuid", flat=True))
+
+
 async def update_user_by_uuid(user_uuid: UUID, data: dict) -> User:
     user = await User.filter(uuid=user_uuid).get()
     user.update_from_dict(data)
     await user.save()
+    UserCache.invalidate(user_uuid)
     return user
 
 
 async def delete_user_by_uuid(user_uuid: UUID):
     await User.filter(uuid=user_uuid).delete()
+    UserCache.invalidate(user_uuid)
 
 # CONTENT CHANGE CRUD
 
@@ -59,9 +82,8 @@ async def create_content_change(
         is_dir: bool,
         triggered_by: User = None,
         extra_meta: dict = None) -> ContentChange:
-    fake_path = await FakePath.get_or_create({"path": path, "is_dir": is_dir}, path_hash=path)
     kwargs = {
-        "fake_path": fake_path[0],
+        "fake_path_id": await get_or_create_fake_path_id(path, is_dir),
         "type_enum": change_type,
         "triggered_by": triggered_by,
         "extra_meta": extra_meta,
@@ -71,24 +93,281 @@ async def create_content_change(
     return content_change_row
 
 
-async def get_content_changes_by_path(path: Path) -> List[ContentChange]:
-    fake_path = await FakePath.get_or_none(path_hash=path)
-    if fake_path:
-        return await ContentChange.filter(fake_path=fake_path).all()
+async def get_fake_path_id(path: Path) -> Optional[int]:
+    """
+    gets the fake path id for a path, using the cache
+
+        :param path: the path
+        :return: the id, or None if the path has no fake path
+    """
+    fake_path_id = FakePathCache.get(path)
+    if fake_path_id is None:
+        fake_path_id = await FakePath.filter(path_hash=path).first().values_list("id", flat=True)
+        if fake_path_id is not None:
+            FakePathCache.set(path, fake_path_id)
+    return fake_path_id
+
+
+async def get_or_create_fake_path_ids(paths: Dict[Path, bool]) -> Dict[Path, int]:
+    """
+    gets the fake path ids for many paths at once,
+    creating any that do not exist yet
+
+        :param paths: each path & whether it is a directory
+        :return: the fake path ids by path
+    """
+    ids = {}
+    for path in paths:
+        fake_path_id = FakePathCache.get(path)
+        if fake_path_id is not None:
+            ids[path] = fake_path_id
+    uncached = [path for path in paths if path not in ids]
+    if uncached:
+        ids.update(await FakePath.filter(path_hash__in=uncached).values_list("path", "id"))
+        missing = [
+            FakePath(path_hash=path, path=path, path_key=path.as_posix(), is_dir=paths[path])
+            for path in uncached
+            if path not in ids
+        ]
+        if missing:
+            await FakePath.bulk_create(missing, ignore_conflicts=True)
+            ids.update(await FakePath.filter(
+                path_hash__in=[row.path for row in missing],
+            ).values_list("path", "id"))
+        for path in uncached:
+            FakePathCache.set(path, ids[path])
+    return ids
+
+
+async def get_or_create_fake_path_id(path: Path, is_dir: bool) -> int:
+    return (await get_or_create_fake_path_ids({path: is_dir}))[path]
+
+
+async def backfill_fake_path_keys(batch_size: int = 1000):
+    """
+    sets the path key of any fake paths created before it existed
+    """
+    while True:
+        rows = await FakePath.filter(path_key=None).limit(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            row.path_key = row.path.as_posix()
+        await FakePath.bulk_update(rows, ["path_key"])
+
+
+async def bulk_create_content_changes(rows: List[ContentChange]):
+    # a single batch, so either every row or none are written
+    await ContentChange.bulk_create(rows)
+
+
+def filter_content_changes(
+        query: QuerySet,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[datetime, int]] = None,
+        descending: bool = False,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        type_enums: Optional[List[ContentChangeTypes]] = None,
+        triggered_by_id: Optional[UUID] = None) -> QuerySet:
+    """
+    filters & orders content changes, pages
+    are found using the created_at & id of the last row
+
+        :param query: the content changes to filter
+        :param limit: max rows to return
+        :param after: the created_at & id of the row before the page
+        :param descending: whether newest should be first
+        :param since: only changes at or after
+        :param until: only changes before
+        :param type_enums: only changes of these types
+        :param triggered_by_id: only changes by this user
+        :return: the filtered query
+    """
+    if since is not None:
+        query = query.filter(created_at__gte=since)
+    if until is not None:
+        query = query.filter(created_at__lt=until)
+    if type_enums:
+        query = query.filter(type_enum__in=type_enums)
+    if triggered_by_id is not None:
+        query = query.filter(triggered_by_id=triggered_by_id)
+    if after is not None:
+        created_at, row_id = after
+        if descending:
+            query = query.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=row_id))
+        else:
+            query = query.filter(
+                Q(created_at__gt=created_at) |
+                Q(created_at=created_at, id__gt=row_id))
+    if descending:
+        query = query.order_by("-created_at", "-id")
+    else:
+        query = query.order_by("created_at", "id")
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+async def get_content_changes_by_path(path: Path, **filters) -> List[ContentChange]:
+    """
+    gets the content changes for a path
+
+        :param path: the path
+        :param filters: passed to filter_content_changes
+        :return: the content changes
+    """
+    fake_path_id = await get_fake_path_id(path)
+    if fake_path_id is not None:
+        return await filter_content_changes(
+            ContentChange.filter(fake_path_id=fake_path_id),
+            **filters,
+        )
     return []
 
+async def get_content_changes_below(path: Path, **filters) -> List[ContentChange]:
+    """
+    gets the content changes for a path and everything below it,
+    the paths are found with a range on the path key index.
+    the changes are looked up by path, so every match is sorted
+    before the limit is applied, keep it bounded with since/until
+
+        :param path: the path
+        :param filters: passed to filter_content_changes
+        :return: the content changes
+    """
+    path_key = path.as_posix()
+    start, end = get_key_range(path_key)
+    fake_path_ids = FakePath.filter(
+        Q(path_key=path_key) | Q(path_key__gte=start, path_key__lt=end),
+    ).values("id")
+    return await filter_content_changes(
+        ContentChange.filter(fake_path_id__in=Subquery(fake_path_ids)),
+        **filters,
+    )
+
+# HISTORY COMPACTION CRUD
+
+
+def filter_expired_content_changes(
+        cutoffs: Dict[ContentChangeTypes, datetime]) -> QuerySet[ContentChange]:
+    """
+    filters the content changes older than the cutoff for their type
+
+        :param cutoffs: the cutoff for each type, must not be empty
+        :return: the query
+    """
+    return ContentChange.filter(reduce(or_, (
+        Q(type_enum=change_type, created_at__lt=cutoff)
+        for change_type, cutoff in cutoffs.items()
+    )))
+
+
+def filter_downloads_to_rollup(before: datetime) -> QuerySet[ContentChange]:
+    return ContentChange.filter(
+        type_enum=ContentChangeTypes.DOWNLOAD,
+        created_at__lt=before,
+    )
+
+
+async def delete_content_changes_chunk(query: QuerySet[ContentChange], chunk_size: int) -> int:
+    """
+    deletes the oldest matching content changes,
+    limited so the table is not locked for long
+
+        :param query: the content changes to delete
+        :param chunk_size: the max rows to delete
+        :return: how many were deleted
+    """
+    ids = await query.order_by("id").limit(chunk_size).values_list("id", flat=True)
+    if ids:
+        await ContentChange.filter(id__in=ids).delete()
+    return len(ids)
+
+
+async def rollup_downloads_chunk(before: datetime, chunk_size: int) -> int:
+    """
+    folds the oldest download content changes into
+    the daily download counts, then deletes them
+
+        :param before: roll up downloads before this
+        :param chunk_size: the max rows to roll up
+        :return: how many were rolled up
+    """
+    rows = await filter_downloads_to_rollup(before)\
+        .order_by("id")\
+        .limit(chunk_size)\
+        .values_list("id", "fake_path_id", "created_at")
+    if not rows:
+        return 0
+    counts = Counter((fake_path_id, created_at.date()) for _, fake_path_id, created_at in rows)
+    # the counts & deletes must commit together, or downloads would be counted twice
+    async with in_transaction():
+        await DownloadRollup.bulk_create(
+            [DownloadRollup(fake_path_id=fake_path_id, day=day) for fake_path_id, day in counts],
+            ignore_conflicts=True,
+        )
+        for (fake_path_id, day), count in counts.items():
+            await DownloadRollup.filter(fake_path_id=fake_path_id, day=day)\
+                .update(downloads=F("downloads") + count)
+        await ContentChange.filter(id__in=[row[0] for row in rows]).delete()
+    return len(rows)
+
+
+async def delete_download_rollups_before(day: date):
+    await DownloadRollup.filter(day__lt=day).delete()
+
+
+async def delete_orphan_fake_paths_chunk(chunk_size: int) -> int:
+    """
+    deletes fake paths that no longer have any history or shares
+
+        :param chunk_size: the max rows to delete
+        :return: how many were deleted
+    """
+    def filter_orphans(query: QuerySet[FakePath]) -> QuerySet[FakePath]:
+        return query.filter(
+            id__not_in=Subquery(ContentChange.all().values("fake_path_id")),
+        ).filter(
+            id__not_in=Subquery(Share.all().values("fake_path_id")),
+        ).filter(
+            id__not_in=Subquery(DownloadRollup.all().values("fake_path_id")),
+        )
+
+    rows = await filter_orphans(FakePath.all())\
+        .order_by("id")\
+        .limit(chunk_size)\
+        .values_list("id", "path")
+    if not rows:
+        return 0
+    # removed before & after, so the id can't be used or cached again while deleting
+    for _, path in rows:
+        FakePathCache.invalidate(path)
+    # checked again, in case history was added since selecting
+    deleted = await filter_orphans(FakePath.filter(id__in=[row[0] for row in rows])).delete()
+    for _, path in rows:
+        FakePathCache.invalidate(path)
+    return deleted
+
 # FILE SHARE CRUD
 
 
 async def create_file_share(filepath: Path, expires: datetime, uses_left: int) -> FileShare:
-    fake_path = await FakePath.get_or_create({"path": filepath, "is_dir": False}, path_hash=filepath)
     file_share = FileShare(
-        fake_path=fake_path[0],
+        fake_path_id=await get_or_create_fake_path_id(filepath, False),
         path=filepath,
         expires=expires,
         uses_left=uses_left
     )
-    await file_share.save()
+    try:
+        await file_share.save()
+    except IntegrityError:
+        # the fake path was removed as unused after getting its id
+        FakePathCache.invalidate(filepath)
+        file_share.fake_path_id = await get_or_create_fake_path_id(filepath, False)
+        await file_share.save()
     return file_share
 
 
@@ -97,11 +376,264 @@ async def get_file_share_by_uuid(share_uuid: UUID) -> FileShare:
 
 
 async def get_shares_by_filepath(filepath: Path) -> List[FileShare]:
-    fake_path = await FakePath.get_or_none(path_hash=filepath)
-    if fake_path:
-        return await FileShare.filter(fake_path=fake_path).all()
+    fake_path_id = await get_fake_path_id(filepath)
+    if fake_path_id is not None:
+        return await FileShare.filter(fake_path_id=fake_path_id).all()
     return []
 
 
 async def delete_file_share(share_uuid: UUID):
     await FileShare.filter(uuid=share_uuid).delete()
+
+# UPLOAD SESSION CRUD
+
+
+async def create_upload_session(
+        owner: User,
+        path: Path,
+        total_size: int,
+        part_size: int = None) -> UploadSession:
+    upload_session = UploadSession(
+        owner=owner,
+        path=path,
+        total_size=total_size,
+        part_size=part_size,
+    )
+    await upload_session.save()
+    return upload_session
+
+
+async def get_upload_sessions_size(
+        path_key: str,
+        owner: Optional[User] = None,
+        updated_since: Optional[datetime] = None) -> int:
+    """
+    totals the size of the upload sessions below a path
+
+        :param path_key: the path key e.g. shared or homes/bob
+        :param owner: only count sessions started by this user
+        :param updated_since: only count sessions written to since
+        :return: the total size in bytes
+    """
+    query = UploadSession.filter(path__startswith=path_key + "/")
+    if owner is not None:
+        query = query.filter(owner=owner)
+    if updated_since is not None:
+        query = query.filter(updated_at__gte=updated_since)
+    total = await query.annotate(total=Sum("total_size")).first().values_list("total", flat=True)
+    return total or 0
+
+
+async def get_upload_session_by_uuid(session_uuid: UUID, owner: User) -> UploadSession:
+    return await UploadSession.filter(uuid=session_uuid, owner=owner).get()
+
+
+async def create_upload_chunk(upload_session: UploadSession, offset: int, length: int) -> UploadChunk:
+    upload_chunk = UploadChunk(
+        session=upload_session,
+        offset=offset,
+        length=length,
+    )
+    await upload_chunk.save()
+    # keeps the session from being counted as abandoned
+    await UploadSession.filter(uuid=upload_session.uuid).update(updated_at=timezone.now())
+    return upload_chunk
+
+
+async def get_upload_chunks(upload_session: UploadSession) -> List[UploadChunk]:
+    return await UploadChunk.filter(session=upload_session).order_by("offset").all()
+
+
+async def delete_upload_session(session_uuid: UUID):
+    await UploadSession.filter(uuid=session_uuid).delete()
+
+
+async def get_expired_upload_sessions(updated_before: datetime, limit: int) -> List[UploadSession]:
+    return await UploadSession.filter(
+        updated_at__lt=updated_before,
+    ).order_by("updated_at").limit(limit)
+
+
+async def delete_upload_sessions(session_uuids: List[UUID]):
+    await UploadSession.filter(uuid__in=session_uuids).delete()
+
+# PATH INDEX CRUD
+
+
+def get_key_range(path_key: str) -> Tuple[str, str]:
+    """
+    gets the range of path keys that are below a path,
+    so they can be found using the path key index
+
+        :param path_key: the path key
+        :return: the inclusive start & exclusive end
+    """
+    # "0" is the character after "/"
+    return f"{path_key}/", f"{path_key}0"
+
+
+async def get_indexed_path(path_key: str) -> Optional[IndexedPath]:
+    return await IndexedPath.get_or_none(path_key=path_key)
+
+
+async def get_indexed_children(parent_key: str) -> Dict[str, IndexedPath]:
+    rows = await IndexedPath.filter(parent_key=parent_key).all()
+    return {row.name: row for row in rows}
+
+
+async def upsert_indexed_path(path_key: str, values: dict) -> IndexedPath:
+    return (await IndexedPath.update_or_create(values, path_key=path_key))[0]
+
+
+async def bulk_create_indexed_paths(rows: List[IndexedPath]):
+    # a path may have been indexed by a change since it was scanned
+    await IndexedPath.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+
+
+async def bulk_update_indexed_paths(rows: List[IndexedPath], fields: List[str]):
+    await IndexedPath.bulk_update(rows, fields, batch_size=1000)
+
+
+async def mark_indexed_children_seen(parent_key: str, generation: int):
+    await IndexedPath.filter(
+        parent_key=parent_key,
+        generation__lt=generation,
+    ).update(generation=generation)
+
+
+async def delete_indexed_path(path_key: str):
+    start, end = get_key_range(path_key)
+    await IndexedPath.filter(path_key=path_key).delete()
+    await IndexedPath.filter(path_key__gte=start, path_key__lt=end).delete()
+
+
+async def delete_unseen_indexed_paths(root_key: str, generation: int):
+    start, end = get_key_range(root_key)
+    await IndexedPath.filter(
+        path_key__gte=start,
+        path_key__lt=end,
+        generation__lt=generation,
+    ).delete()
+
+
+async def rename_indexed_paths(path_key: str, new_path_key: str):
+    """
+    moves a path and everything below it to a new path in the index
+
+        :param path_key: the current path key
+        :param new_path_key: the new path key
+    """
+    start, end = get_key_range(path_key)
+    rows = await IndexedPath.filter(
+        Q(path_key=path_key) | Q(path_key__gte=start, path_key__lt=end))
+    for row in rows:
+        row.path_key = new_path_key + row.path_key[len(path_key):]
+        if row.path_key == new_path_key:
+            row.name = Path(new_path_key).name
+        else:
+            row.parent_key = new_path_key + row.parent_key[len(path_key):]
+    if rows:
+        await IndexedPath.bulk_update(rows, ["path_key", "parent_key", "name"], batch_size=1000)
+
+
+async def get_indexed_usage(path_key: str) -> Tuple[int, int]:
+    """
+    totals the files in the index at or below a path
+
+        :param path_key: the path key
+        :return: the total bytes & number of files
+    """
+    start, end = get_key_range(path_key)
+    row = await IndexedPath.filter(
+        Q(path_key=path_key) | Q(path_key__gte=start, path_key__lt=end),
+        is_dir=False,
+    ).annotate(total=Sum("size"), count=Count("id")).first().values("total", "count")
+    return row["total"] or 0, row["count"] or 0
+
+
+async def get_index_state(root: str) -> IndexState:
+    return (await IndexState.get_or_create(root=root))[0]
+
+
+# STORAGE USAGE CRUD
+
+
+async def get_storage_usage(key: str) -> StorageUsage:
+    return (await StorageUsage.get_or_create(key=key))[0]
+
+
+async def get_storage_usages_below(key: str) -> List[StorageUsage]:
+    start, end = get_key_range(key)
+    return await StorageUsage.filter(key__gte=start, key__lt=end).order_by("key")
+
+
+async def add_storage_usage(keys: List[str], bytes_delta: int, files_delta: int):
+    """
+    adjusts the running totals, without reading them first
+
+        :param keys: the usage keys to adjust
+        :param bytes_delta: the change in bytes
+        :param files_delta: the change in number of files
+    """
+    for key in keys:
+        await StorageUsage.get_or_create(key=key)
+    await StorageUsage.filter(key__in=keys).update(
+        bytes=F("bytes") + bytes_delta,
+        files=F("files") + files_delta,
+    )
+
+
+async def set_storage_usage(key: str, bytes_size: int, file_count: int):
+    await StorageUsage.update_or_create(
+        {"bytes": bytes_size, "files": file_count},
+        key=key,
+    )
+
+
+async def rename_storage_usage(key: str, new_key: str):
+    await StorageUsage.filter(key=new_key).delete()
+    await StorageUsage.filter(key=key).update(key=new_key)
+
+
+async def delete_storage_usage(key: str):
+    await StorageUsage.filter(key=key).delete()
+
+
+# JOB CRUD
+
+
+async def create_job(owner: User, job_type: JobType, payload: dict) -> Job:
+    job = Job(
+        owner=owner,
+        job_type=job_type,
+        payload=payload,
+    )
+    await job.save()
+    return job
+
+
+async def get_job_by_uuid(job_uuid: UUID) -> Job:
+    return await Job.filter(uuid=job_uuid).get()
+
+
+async def get_jobs_by_owner(owner: User) -> List[Job]:
+    return await Job.filter(owner=owner).order_by("-created_at").all()
+
+
+async def get_unfinished_jobs() -> List[Job]:
+    return await Job.filter(
+        status__in=(JobStatus.QUEUED, JobStatus.RUNNING),
+    ).order_by("created_at").all()
+
+
+async def update_job(job: Job, **values):
+    job.update_from_dict(values)
+    await job.save()
+
+
+async def get_latest_job(job_type: JobType) -> Optional[Job]:
+    return await Job.filter(job_type=job_type).order_by("-created_at").first()
+
+
+async def delete_job(job_uuid: UUID):
+    await Job.filter(uuid=job_uuid).delete()
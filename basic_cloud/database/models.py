@@ -1,11 +1,13 @@
-from tortoise.fields.data import (BinaryField, BooleanField, CharField,
-                                  DatetimeField, IntEnumField, IntField,
+from tortoise.fields.base import CASCADE
+from tortoise.fields.data import (BigIntField, BinaryField, BooleanField,
+                                  CharEnumField, CharField, DateField,
+                                  DatetimeField, FloatField, IntEnumField, IntField,
                                   JSONField, UUIDField)
 from tortoise.fields.relational import (ForeignKeyField, ForeignKeyRelation,
                                         ReverseRelation)
 from tortoise.models import Model
 
-from ..helpers.constants import ContentChangeTypes
+from ..helpers.constants import ContentChangeTypes, JobStatus, JobType
 from .custom_fields import PathField, Sha256Field
 
 
@@ -17,14 +19,20 @@ class ModifyMixin:
 class User(Model, ModifyMixin):
     """
     information about a user
+
+        quota_bytes: max bytes the users home can hold,
+                     None will use the default quota
     """
     uuid = UUIDField(pk=True)
     username = CharField(25, unique=True)
     hashed_password = BinaryField()
     is_admin = BooleanField(default=False)
     disabled = BooleanField(default=False)
+    quota_bytes = BigIntField(null=True)
 
     content_changes: ReverseRelation["ContentChange"]
+    upload_sessions: ReverseRelation["UploadSession"]
+    jobs: ReverseRelation["Job"]
 
 
 class FakePath(Model):
@@ -33,10 +41,13 @@ class FakePath(Model):
 
         path_hash: the unique hash of the path
         path: the actual path
+        path_key: the path as a posix string e.g. shared/docs/a.txt,
+                  so paths below a directory can be found with a range
         is_dir: whether path is a directory
     """
     path_hash = Sha256Field(unique=True)
     path = PathField()
+    path_key = CharField(1024, index=True, null=True)
     is_dir = BooleanField()
 
     content_changes: ReverseRelation["ContentChange"]
@@ -65,6 +76,33 @@ class ContentChange(Model):
     )
     extra_meta = JSONField(null=True)
 
+    class Meta:
+        indexes = (
+            ("fake_path", "created_at"),
+            ("triggered_by", "created_at"),
+            ("type_enum", "created_at"),
+        )
+
+
+class DownloadRollup(Model):
+    """
+    the number of downloads of a path on a day,
+    old download history is folded into these
+
+        fake_path: the path that it relates to
+        day: the day the downloads happened (UTC)
+        downloads: how many downloads there were
+    """
+    fake_path: ForeignKeyRelation[FakePath] = ForeignKeyField(
+        "models.FakePath",
+        "download_rollups",
+    )
+    day = DateField()
+    downloads = IntField(default=0)
+
+    class Meta:
+        unique_together = (("fake_path", "day"),)
+
 
 class Share(Model):
     """
@@ -82,3 +120,122 @@ class Share(Model):
     )
     expires = DatetimeField(null=True)
     uses_left = IntField(null=True)
+
+
+class UploadSession(Model, ModifyMixin):
+    """
+    a resumable upload of a single file
+
+        uuid: the primary key
+        owner: the user who started the upload
+        path: the path the file will be written to
+        total_size: the final size of the file in bytes
+        part_size: the size of each numbered part (if using parts)
+    """
+    uuid = UUIDField(pk=True)
+    owner: ForeignKeyRelation[User] = ForeignKeyField(
+        "models.User",
+        "upload_sessions",
+        on_delete=CASCADE,
+    )
+    path = PathField()
+    total_size = BigIntField()
+    part_size = BigIntField(null=True)
+
+    chunks: ReverseRelation["UploadChunk"]
+
+
+class UploadChunk(Model):
+    """
+    a range of bytes received for a upload session
+
+        session: the upload session it belongs to
+        offset: where the chunk starts in the file
+        length: the length of the chunk in bytes
+    """
+    session: ForeignKeyRelation[UploadSession] = ForeignKeyField(
+        "models.UploadSession",
+        "chunks",
+        on_delete=CASCADE,
+    )
+    offset = BigIntField()
+    length = BigIntField()
+
+
+class IndexedPath(Model):
+    """
+    a path in the filesystem metadata index
+
+        path_key: the path as a posix string e.g. shared/docs/a.txt
+        parent_key: the parent path as a posix string
+        name: the file/directory name
+        is_dir: whether path is a directory
+        size: the size in bytes (0 for directories)
+        mtime_ns: when the path was last modified, in nanoseconds
+        content_hash: the sha256 of the file content (if enabled)
+        generation: the reconcile pass that last saw the path
+    """
+    path_key = CharField(1024, unique=True)
+    parent_key = CharField(1024, index=True)
+    name = CharField(255, index=True)
+    is_dir = BooleanField()
+    size = BigIntField(default=0)
+    mtime_ns = BigIntField()
+    content_hash = CharField(64, null=True)
+    generation = IntField(default=0)
+
+
+class IndexState(Model):
+    """
+    progress of reconciling a root directory with the index
+
+        root: the root directory name
+        generation: the current reconcile pass
+        checkpoint: the last directory finished in the current pass
+        finished_at: when the last full pass finished
+    """
+    root = CharField(255, unique=True)
+    generation = IntField(default=1)
+    checkpoint = CharField(1024, null=True)
+    finished_at = DatetimeField(null=True)
+
+
+class StorageUsage(Model):
+    """
+    running totals of the files stored under a path,
+    kept for each root directory and user home
+
+        key: the path as a posix string e.g. shared or homes/bob
+        bytes: the total size of the files in bytes
+        files: the number of files
+    """
+    key = CharField(1024, unique=True)
+    bytes = BigIntField(default=0)
+    files = BigIntField(default=0)
+
+
+class Job(Model, ModifyMixin):
+    """
+    a long running operation, run in the background
+
+        uuid: the primary key
+        owner: the user that started the job
+        job_type: what the job does
+        status: the progress of the job
+        payload: the arguments for the job
+        progress: how much is done, between 0 and 1
+        result: what the job returned, or the error if it failed
+        finished_at: when the job finished
+    """
+    uuid = UUIDField(pk=True)
+    owner: ForeignKeyRelation[User] = ForeignKeyField(
+        "models.User",
+        "jobs",
+        on_delete=CASCADE,
+    )
+    job_type = CharEnumField(JobType)
+    status = CharEnumField(JobStatus, default=JobStatus.QUEUED)
+    payload = JSONField()
+    progress = FloatField(default=0)
+    result = JSONField(null=True)
+    finished_at = DatetimeField(null=True)
@@ -1,11 +1,11 @@
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseModel
-from pydantic.types import UUID4, Json
+from pydantic import BaseModel, conint
+from pydantic.types import UUID4
 
-from ..helpers.constants import ContentChangeTypes
+from ..helpers.constants import ContentChangeTypes, JobStatus, JobType
 
 
 class ModifyBase(BaseModel):
@@ -20,6 +20,19 @@ class User(ModifyBase):
     is_admin: bool = False
 
 
+class StorageQuota(BaseModel):
+    path: Path
+    bytes_used: int
+    file_count: int
+    bytes_limit: Optional[int]
+
+
+class UserMe(User):
+    quota_bytes: Optional[int]
+    home_storage: StorageQuota
+    shared_storage: StorageQuota
+
+
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -29,6 +42,7 @@ class UserModifyAdmin(BaseModel):
     username: Optional[str]
     disabled: Optional[bool]
     is_admin: Optional[bool]
+    quota_bytes: Optional[conint(ge=0)]
 
 
 class Token(BaseModel):
@@ -40,7 +54,7 @@ class ContentChange(BaseModel):
     created_at: datetime
     type_enum: ContentChangeTypes
     triggered_by_id: Optional[UUID4]
-    extra_meta: Optional[Json]
+    extra_meta: Optional[dict]
 
 
 class FileShareCreate(BaseModel):
@@ -53,3 +67,33 @@ class FileShare(BaseModel):
     uuid: UUID4
     expires: Optional[datetime]
     uses_left: Optional[int]
+
+
+class ByteRange(BaseModel):
+    start: int
+    end: int
+
+
+class UploadSessionCreate(BaseModel):
+    directory: Path
+    filename: str
+    total_size: conint(ge=0)
+    part_size: Optional[conint(gt=0)]
+
+
+class UploadSession(BaseModel):
+    uuid: UUID4
+    path: Path
+    total_size: int
+    part_size: Optional[int]
+    part_count: Optional[int]
+    received: List[ByteRange]
+
+
+class Job(ModifyBase):
+    uuid: UUID4
+    job_type: JobType
+    status: JobStatus
+    progress: float
+    result: Optional[dict]
+    finished_at: Optional[datetime]
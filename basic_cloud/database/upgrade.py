@@ -0,0 +1,35 @@
+"""
+adds columns to tables made by older versions,
+as generate_schemas only creates missing tables
+"""
+import logging
+
+from tortoise import Tortoise
+
+logger = logging.getLogger(__name__)
+
+# the table, column & column definition of each added column
+ADDED_COLUMNS = (
+    ("user", "quota_bytes", "BIGINT"),
+    ("fakepath", "path_key", "VARCHAR(1024)"),
+)
+
+
+async def add_missing_columns():
+    """
+    adds any missing columns to existing tables, must run
+    before generate_schemas so new indexes can be created.
+    only sqlite is upgraded, other databases must be altered by hand
+    """
+    connection = Tortoise.get_connection("default")
+    if connection.capabilities.dialect != "sqlite":
+        return
+    for table, column, definition in ADDED_COLUMNS:
+        rows = await connection.execute_query_dict(f'PRAGMA table_info("{table}")')
+        if not rows:
+            # table does not exist yet, generate_schemas will create it
+            continue
+        if column not in {row["name"] for row in rows}:
+            logger.warning("adding missing column '%s' to '%s'", column, table)
+            await connection.execute_script(
+                f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition};')
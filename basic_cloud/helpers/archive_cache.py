@@ -0,0 +1,230 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+from uuid import uuid4
+
+from ..config import get_settings
+from .constants import HIDDEN_TEMP_PREFIXES
+
+TEMP_SUFFIX = ".part"
+
+
+@dataclass
+class CachedArchive:
+    path: Path
+    size: int
+    directory: Optional[Path]
+
+
+def fingerprint_directory(root_path: Path, hasher):
+    """
+    adds every path below a directory
+    with its size & mtime to the hash,
+    paths are walked in a sorted order
+
+        :param root_path: the directory to walk
+        :param hasher: the hash object to update
+    """
+    directories = [(root_path, "")]
+    while directories:
+        directory, relative = directories.pop()
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name, reverse=True)
+        for entry in entries:
+            if entry.name.startswith(HIDDEN_TEMP_PREFIXES):
+                continue
+            name = relative + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    hasher.update(f"d:{name}\0".encode())
+                    directories.append((Path(entry.path), name + "/"))
+                    continue
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            hasher.update(
+                f"f:{name}:{stat_result.st_size}:{stat_result.st_mtime_ns}\0".encode())
+
+
+def iter_open_file(fo: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    """
+    reads an open file in chunks, closing it once done
+
+        :param fo: the open file
+        :param chunk_size: max bytes to read at once
+        :return: the chunks read
+    """
+    try:
+        while True:
+            chunk = fo.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fo.close()
+
+
+class ArchiveCache:
+    """
+    static class for the on-disk cache of generated zips,
+    the least recently used are removed to stay in the byte budget
+    """
+    _entries: "OrderedDict[str, CachedArchive]" = OrderedDict()
+    _total_bytes: int = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return get_settings().ZIP_CACHE_MAX_BYTES > 0
+
+    @staticmethod
+    def load():
+        """
+        loads the existing cached archives,
+        removing any that were not finished
+        """
+        cache_path = get_settings().ZIP_CACHE_PATH
+        cache_path.mkdir(parents=True, exist_ok=True)
+        archives = []
+        for path in cache_path.iterdir():
+            if path.name.endswith(TEMP_SUFFIX):
+                path.unlink(missing_ok=True)
+            elif path.suffix == ".zip":
+                archives.append((path.stat(), path))
+        with ArchiveCache._lock:
+            for stat_result, path in sorted(archives, key=lambda a: a[0].st_mtime):
+                ArchiveCache._add(
+                    path.stem,
+                    CachedArchive(path, stat_result.st_size, None),
+                )
+            ArchiveCache._evict()
+
+    @staticmethod
+    def get_key(
+            root_path: Path,
+            directory: Path,
+            compression_level: Optional[int]) -> str:
+        """
+        creates the cache key for a directory zip,
+        from a fingerprint of its current contents
+
+            :param root_path: the full path of the directory
+            :param directory: the directory path
+            :param compression_level: the zip compression level
+            :return: the key
+        """
+        hasher = hashlib.sha256()
+        hasher.update(f"{directory.as_posix()}\0{compression_level or 0}\0".encode())
+        fingerprint_directory(root_path, hasher)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def open(key: str) -> Optional[BinaryIO]:
+        """
+        opens a cached archive, marking it as recently used.
+        opened under the lock, so it can still be read
+        if it is evicted or invalidated while being sent
+
+            :param key: the cache key
+            :return: the open archive, or None if not cached
+        """
+        with ArchiveCache._lock:
+            cached = ArchiveCache._entries.get(key)
+            if cached is None:
+                return None
+            try:
+                fo = open(cached.path, "rb")
+            except FileNotFoundError:
+                ArchiveCache._remove(key)
+                return None
+            ArchiveCache._entries.move_to_end(key)
+        try:
+            # keeps the order when loaded after a restart
+            os.utime(fo.fileno())
+        except OSError:
+            pass
+        return fo
+
+    @staticmethod
+    def store(key: str, directory: Path, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        passes through the zip chunks, while also
+        writing them to the cache. will only be cached
+        if the archive completes and fits in the budget
+
+            :param key: the cache key
+            :param directory: the directory path the archive is of
+            :param chunks: the zip chunks
+            :return: the zip chunks
+        """
+        cache_path = get_settings().ZIP_CACHE_PATH
+        max_bytes = get_settings().ZIP_CACHE_MAX_BYTES
+        temp_path = cache_path.joinpath(f"{key}.{uuid4().hex}{TEMP_SUFFIX}")
+        size = 0
+        fo = open(temp_path, "wb")
+        try:
+            for chunk in chunks:
+                if fo is not None:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        # too big to cache, keep streaming without it
+                        fo.close()
+                        fo = None
+                        temp_path.unlink(missing_ok=True)
+                    else:
+                        fo.write(chunk)
+                yield chunk
+            if fo is not None:
+                fo.close()
+                fo = None
+                archive_path = cache_path.joinpath(f"{key}.zip")
+                os.replace(temp_path, archive_path)
+                with ArchiveCache._lock:
+                    ArchiveCache._add(key, CachedArchive(archive_path, size, directory))
+                    ArchiveCache._evict()
+        finally:
+            if fo is not None:
+                fo.close()
+                temp_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def invalidate(path: Path):
+        """
+        removes any cached archives of directories
+        that contain the changed path
+
+            :param path: the path that changed
+        """
+        with ArchiveCache._lock:
+            keys = [
+                key for key, cached in ArchiveCache._entries.items()
+                if cached.directory is not None and (
+                    cached.directory == path or cached.directory in path.parents)
+            ]
+            for key in keys:
+                ArchiveCache._remove(key)
+
+    @staticmethod
+    def _add(key: str, cached: CachedArchive):
+        ArchiveCache._remove(key, unlink=False)
+        ArchiveCache._entries[key] = cached
+        ArchiveCache._total_bytes += cached.size
+
+    @staticmethod
+    def _remove(key: str, unlink: bool = True):
+        cached = ArchiveCache._entries.pop(key, None)
+        if cached is not None:
+            ArchiveCache._total_bytes -= cached.size
+            if unlink:
+                cached.path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _evict():
+        max_bytes = get_settings().ZIP_CACHE_MAX_BYTES
+        while ArchiveCache._entries and ArchiveCache._total_bytes > max_bytes:
+            key = next(iter(ArchiveCache._entries))
+            ArchiveCache._remove(key)
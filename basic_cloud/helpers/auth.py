@@ -9,6 +9,10 @@ from passlib.context import CryptContext
 
 from ..config import get_settings
 from ..database import crud, models
+from ..database.cache import UserCache
+from .exceptions import ExecutorBusy
+from .executors import Executors
+from .paths import create_user_home_dir
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -37,6 +41,58 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def hash_password(password: str) -> str:
+    """
+    hashes the plain-text password in the
+    password process pool, so the event loop is not blocked
+
+        :param password: the plain-text password
+        :return: the hashed password
+    """
+    try:
+        return await Executors.run_password(get_password_hash, password)
+    except ExecutorBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="server is busy, try again later",
+            headers={"Retry-After": "1"},
+        ) from None
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    checks the password in the password
+    process pool, so the event loop is not blocked
+
+        :param plain_password: the plain-text password
+        :param hashed_password: the hashed password
+        :return: whether the password matched
+    """
+    try:
+        return await Executors.run_password(
+            verify_password, plain_password, hashed_password)
+    except ExecutorBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="server is busy, try again later",
+            headers={"Retry-After": "1"},
+        ) from None
+
+
+async def setup_default_admin():
+    """
+    creates the default admin account (password is the username)
+    and its home, if the account does not exist yet
+    """
+    admin_uname = get_settings().DEFAULT_ADMIN_UNAME
+    if await crud.get_user_by_username(admin_uname) is None:
+        await crud.create_default_admin(
+            admin_uname,
+            await Executors.run_password(get_password_hash, admin_uname),
+        )
+    await Executors.run_fs(create_user_home_dir, admin_uname, get_settings().HOMES_PATH)
+
+
 async def authenticate_user(
         username: str,
         password: str) -> Union[models.User, bool]:
@@ -50,7 +106,7 @@ async def authenticate_user(
     user = await crud.get_user_by_username(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password.decode()):
+    if not await check_password(password, user.hashed_password.decode()):
         return False
     return user
 
@@ -96,9 +152,13 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> models.User:
         user_uuid: UUID = UUID(user_uuid)
     except (ValueError, JWTError):
         raise credentials_exception
-    user = await crud.get_user_by_uuid(user_uuid)
+    user = UserCache.get(user_uuid)
     if user is None:
-        raise credentials_exception
+        generation = UserCache.get_generation(user_uuid)
+        user = await crud.get_user_by_uuid(user_uuid)
+        if user is None:
+            raise credentials_exception
+        UserCache.set(user, generation)
     return user
 
 
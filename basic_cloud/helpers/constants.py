@@ -1,4 +1,4 @@
-from enum import IntEnum, unique
+from enum import Enum, IntEnum, unique
 from pathlib import Path
 
 from fastapi.staticfiles import StaticFiles
@@ -13,6 +13,12 @@ CURRENT_VERSION = "0.3.0"
 # the oldest compatible version
 # that will work with current version
 OLDEST_COMPATIBLE_VERSION = "0.1.0"
+# prefix of files that are still being uploaded
+UPLOAD_TEMP_PREFIX = ".upload-"
+# prefix of paths waiting to be removed by a delete job
+DELETED_TEMP_PREFIX = ".deleted-"
+# prefixes of paths hidden from listings, the index & archives
+HIDDEN_TEMP_PREFIXES = (UPLOAD_TEMP_PREFIX, DELETED_TEMP_PREFIX)
 
 
 @unique
@@ -35,6 +41,36 @@ class ContentChangeTypes(IntEnum):
     SHARED = 4
 
 
+@unique
+class DirectoryContentSort(str, Enum):
+    """
+    enums responsible for marking
+    how directory contents are sorted
+
+        NAME: by the name
+        SIZE: by the file size, directories first
+        MODIFIED: by when last modified
+    """
+    NAME = "name"
+    SIZE = "size"
+    MODIFIED = "modified"
+
+
+@unique
+class SearchMode(str, Enum):
+    """
+    enums responsible for marking
+    how a search query is matched
+
+        SUBSTRING: name contains the query
+        GLOB: name matches a glob pattern e.g. *.tar.gz
+        EXTENSION: name ends with the extension
+    """
+    SUBSTRING = "substring"
+    GLOB = "glob"
+    EXTENSION = "extension"
+
+
 @unique
 class WebsocketMessageTypeSend(IntEnum):
     """
@@ -43,8 +79,10 @@ class WebsocketMessageTypeSend(IntEnum):
     in a message from the server
 
         WATCHDOG_UPDATE: change from the file/directory watchdog
+        JOB_UPDATE: a background job has changed status
     """
     WATCHDOG_UPDATE = 1
+    JOB_UPDATE = 2
 
 
 @unique
@@ -57,3 +95,37 @@ class WebsocketMessageTypeReceive(IntEnum):
         DIRECTORY_CHANGE: client has changed directory
     """
     DIRECTORY_CHANGE = 1
+
+
+@unique
+class JobType(str, Enum):
+    """
+    enums responsible for marking
+    what a background job does
+
+        DELETE_DIRECTORY: delete a directory & its contents
+        DELETE_USER: delete a users home directory
+        CREATE_ZIP: zip a directory to download later
+        COMPACT_HISTORY: roll up & remove old history
+    """
+    DELETE_DIRECTORY = "delete_directory"
+    DELETE_USER = "delete_user"
+    CREATE_ZIP = "create_zip"
+    COMPACT_HISTORY = "compact_history"
+
+
+@unique
+class JobStatus(str, Enum):
+    """
+    enums responsible for marking
+    the progress of a background job
+
+        QUEUED: waiting to be run
+        RUNNING: currently being run
+        DONE: finished successfully
+        FAILED: finished with an error
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
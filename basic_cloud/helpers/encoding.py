@@ -0,0 +1,332 @@
+"""
+compression of downloads using content negotiation,
+with compressed copies kept in a sidecar cache
+"""
+import mimetypes
+import os
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Optional
+from uuid import uuid4
+
+from ..config import get_settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "application/xml",
+    "image/svg+xml",
+}
+COMPRESSIBLE_SUFFIXES = {".csv", ".log", ".md", ".ndjson", ".tsv", ".yaml", ".yml"}
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def get_available_encodings() -> Dict[str, int]:
+    """
+    gets the supported encodings,
+    with their preference (higher is preferred)
+
+        :return: the encodings
+    """
+    encodings = {"gzip": 1}
+    if brotli is not None:
+        encodings["br"] = 2
+    if zstandard is not None:
+        encodings["zstd"] = 3
+    return encodings
+
+
+def create_compressor(encoding: str):
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "br":
+        return BrotliCompressor()
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"unknown encoding {encoding}")
+
+
+def is_compressible(filename: str) -> bool:
+    """
+    checks whether the file type is worth compressing
+
+        :param filename: the name of the file
+        :return: whether it should be compressed
+    """
+    media_type = mimetypes.guess_type(filename)[0]
+    if media_type is None:
+        return Path(filename).suffix.lower() in COMPRESSIBLE_SUFFIXES
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    picks the best encoding from an Accept-Encoding header
+
+        :param accept_encoding: the header value
+        :return: the encoding, or None for identity
+    """
+    available = get_available_encodings()
+    best = None
+    best_rank = (0.0, 0)
+    for value in accept_encoding.split(","):
+        encoding, *params = value.strip().split(";")
+        encoding = encoding.strip().lower()
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        if encoding not in available or quality <= 0:
+            continue
+        rank = (quality, available[encoding])
+        if rank > best_rank:
+            best = encoding
+            best_rank = rank
+    return best
+
+
+def get_cache_directory(path: Path) -> Optional[Path]:
+    """
+    gets the directory holding the cached compressed copies of a file,
+    the cache mirrors the directory layout so a directory can be removed at once
+
+        :param path: the path of the source file
+        :return: the cache directory, or None if the path can't be cached
+    """
+    if ".." in path.parts or path.is_absolute():
+        return None
+    return get_settings().DOWNLOAD_COMPRESSION_CACHE_PATH.joinpath(*path.parts)
+
+
+def get_encoded_path(path: Path, stat_result: os.stat_result, encoding: str) -> Optional[Path]:
+    """
+    gets where the compressed copy of a file is cached,
+    the name changes when the source file does
+
+        :param path: the path of the source file
+        :param stat_result: the stat of the source file
+        :param encoding: the content encoding
+        :return: the cache path, or None if the path can't be cached
+    """
+    cache_directory = get_cache_directory(path)
+    if cache_directory is None:
+        return None
+    return cache_directory.joinpath(
+        f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}.{encoding}")
+
+
+def open_cached_encoding(
+        path: Path,
+        stat_result: os.stat_result,
+        encoding: str) -> Optional[BinaryIO]:
+    """
+    opens the cached compressed copy of a file
+
+        :param path: the path of the source file
+        :param stat_result: the stat of the source file
+        :param encoding: the content encoding
+        :return: the open copy, or None if not cached
+    """
+    encoded_path = get_encoded_path(path, stat_result, encoding)
+    if encoded_path is None:
+        return None
+    return EncodedCache.open(encoded_path)
+
+
+def stream_encoded(
+        full_path: Path,
+        path: Path,
+        stat_result: os.stat_result,
+        encoding: str,
+        chunk_size: int) -> Iterator[bytes]:
+    """
+    compresses a file as a stream, while also writing it to
+    the cache. it will only be cached once the whole file is read
+
+        :param full_path: the full path of the source file
+        :param path: the path of the source file
+        :param stat_result: the stat of the source file
+        :param encoding: the content encoding
+        :param chunk_size: max bytes to read into memory at once
+        :return: the compressed chunks
+    """
+    compressor = create_compressor(encoding)
+    encoded_path = None
+    if EncodedCache.is_enabled():
+        encoded_path = get_encoded_path(path, stat_result, encoding)
+    if encoded_path is None:
+        with open(full_path, "rb") as fi:
+            for chunk in iter(lambda: fi.read(chunk_size), b""):
+                yield compressor.compress(chunk)
+        yield compressor.flush()
+        return
+
+    encoded_path.parent.mkdir(parents=True, exist_ok=True)
+    # remove copies of older versions of the file
+    for old_path in encoded_path.parent.glob(f"*.{encoding}"):
+        EncodedCache.remove(old_path)
+    temp_path = encoded_path.with_name(f"{encoded_path.name}.{uuid4().hex}.part")
+    try:
+        with open(full_path, "rb") as fi, open(temp_path, "wb") as fo:
+            for chunk in iter(lambda: fi.read(chunk_size), b""):
+                chunk = compressor.compress(chunk)
+                if chunk:
+                    fo.write(chunk)
+                    yield chunk
+            chunk = compressor.flush()
+            fo.write(chunk)
+            yield chunk
+            size = fo.tell()
+        os.replace(temp_path, encoded_path)
+        EncodedCache.add(encoded_path, size)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def invalidate_encoded(path: Path):
+    """
+    removes all cached compressed copies of a file,
+    or of every file in a directory
+
+        :param path: the path of the file/directory
+    """
+    cache_directory = get_cache_directory(path)
+    if cache_directory is not None:
+        EncodedCache.invalidate(cache_directory)
+        shutil.rmtree(cache_directory, ignore_errors=True)
+
+
+class EncodedCache:
+    """
+    static class tracking the sidecar cache of compressed copies,
+    the least recently used are removed to stay in the byte budget
+    """
+    _entries: "OrderedDict[Path, int]" = OrderedDict()
+    _total_bytes: int = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return get_settings().DOWNLOAD_COMPRESSION_CACHE_MAX_BYTES > 0
+
+    @staticmethod
+    def load():
+        """
+        loads the existing compressed copies,
+        removing any that were not finished
+        """
+        cache_path = get_settings().DOWNLOAD_COMPRESSION_CACHE_PATH
+        cache_path.mkdir(parents=True, exist_ok=True)
+        copies = []
+        for path in cache_path.rglob("*"):
+            if path.name.endswith(".part"):
+                path.unlink(missing_ok=True)
+            elif path.is_file():
+                copies.append((path.stat(), path))
+        with EncodedCache._lock:
+            for stat_result, path in sorted(copies, key=lambda c: c[0].st_mtime):
+                EncodedCache._add(path, stat_result.st_size)
+            EncodedCache._evict()
+
+    @staticmethod
+    def open(encoded_path: Path) -> Optional[BinaryIO]:
+        """
+        opens a compressed copy, marking it as recently used.
+        opened under the lock, so it can still be read
+        if it is evicted or invalidated while being sent
+
+            :param encoded_path: the path of the copy
+            :return: the open copy, or None if not cached
+        """
+        with EncodedCache._lock:
+            if encoded_path not in EncodedCache._entries:
+                return None
+            try:
+                fo = open(encoded_path, "rb")
+            except FileNotFoundError:
+                EncodedCache._remove(encoded_path)
+                return None
+            EncodedCache._entries.move_to_end(encoded_path)
+        try:
+            # keeps the order when loaded after a restart
+            os.utime(fo.fileno())
+        except OSError:
+            pass
+        return fo
+
+    @staticmethod
+    def add(encoded_path: Path, size: int):
+        with EncodedCache._lock:
+            EncodedCache._add(encoded_path, size)
+            EncodedCache._evict()
+
+    @staticmethod
+    def remove(encoded_path: Path):
+        with EncodedCache._lock:
+            EncodedCache._remove(encoded_path)
+            # may be a copy that is no longer tracked
+            encoded_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def invalidate(cache_directory: Path):
+        """
+        stops tracking the copies in a cache directory,
+        call before removing the directory
+
+            :param cache_directory: the cache directory
+        """
+        with EncodedCache._lock:
+            paths = [
+                path for path in EncodedCache._entries
+                if cache_directory in path.parents
+            ]
+            for path in paths:
+                EncodedCache._remove(path, unlink=False)
+
+    @staticmethod
+    def _add(encoded_path: Path, size: int):
+        EncodedCache._remove(encoded_path, unlink=False)
+        EncodedCache._entries[encoded_path] = size
+        EncodedCache._total_bytes += size
+
+    @staticmethod
+    def _remove(encoded_path: Path, unlink: bool = True):
+        size = EncodedCache._entries.pop(encoded_path, None)
+        if size is not None:
+            EncodedCache._total_bytes -= size
+            if unlink:
+                encoded_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _evict():
+        max_bytes = get_settings().DOWNLOAD_COMPRESSION_CACHE_MAX_BYTES
+        while EncodedCache._entries and EncodedCache._total_bytes > max_bytes:
+            EncodedCache._remove(next(iter(EncodedCache._entries)))
@@ -4,3 +4,19 @@ class PathNotExists(ValueError):
 
 class SharePathInvalid(ValueError):
     pass
+
+
+class UploadRangeInvalid(ValueError):
+    pass
+
+
+class CursorInvalid(ValueError):
+    pass
+
+
+class QuotaExceeded(ValueError):
+    pass
+
+
+class ExecutorBusy(RuntimeError):
+    pass
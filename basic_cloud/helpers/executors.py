@@ -0,0 +1,127 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from ..config import get_settings
+from .exceptions import ExecutorBusy
+from .schema import ExecutorStats
+
+T = TypeVar("T")
+
+
+class Executors:
+    """
+    static class allowing for easy access to the shared worker pools
+    """
+    _zip_pool: Optional[ProcessPoolExecutor] = None
+    _password_pool: Optional[ProcessPoolExecutor] = None
+    _password_pending: int = 0
+    _fs_pool: Optional[ThreadPoolExecutor] = None
+    _fs_lock = threading.Lock()
+    _fs_running: int = 0
+    _fs_completed: int = 0
+    _fs_wait_total: float = 0
+    _fs_wait_max: float = 0
+
+    @staticmethod
+    def zip_workers() -> int:
+        return get_settings().ZIP_COMPRESS_WORKERS or os.cpu_count() or 1
+
+    @staticmethod
+    def zip_pool() -> ProcessPoolExecutor:
+        if Executors._zip_pool is None:
+            Executors._zip_pool = ProcessPoolExecutor(Executors.zip_workers())
+        return Executors._zip_pool
+
+    @staticmethod
+    def password_pool() -> ProcessPoolExecutor:
+        if Executors._password_pool is None:
+            Executors._password_pool = ProcessPoolExecutor(
+                get_settings().PASSWORD_HASH_WORKERS)
+        return Executors._password_pool
+
+    @staticmethod
+    async def run_password(func: Callable[..., T], *args: Any) -> T:
+        """
+        runs a password hash on the password process pool,
+        turning it away if too many are already waiting
+
+            :param func: the function to call, must be picklable
+            :return: what the function returned
+            :raises ExecutorBusy: when too many hashes are waiting
+        """
+        if Executors._password_pending >= get_settings().PASSWORD_HASH_MAX_PENDING:
+            raise ExecutorBusy("too many password hashes waiting")
+        Executors._password_pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(Executors.password_pool(), func, *args)
+        finally:
+            Executors._password_pending -= 1
+
+    @staticmethod
+    def fs_pool() -> ThreadPoolExecutor:
+        if Executors._fs_pool is None:
+            Executors._fs_pool = ThreadPoolExecutor(
+                get_settings().FS_THREAD_POOL_SIZE,
+                thread_name_prefix="fs",
+            )
+        return Executors._fs_pool
+
+    @staticmethod
+    async def run_fs(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        runs a blocking filesystem call on the filesystem
+        thread pool, so it does not stall the event loop
+
+            :param func: the function to call
+            :return: what the function returned
+        """
+        submitted_at = time.perf_counter()
+
+        def run():
+            waited = time.perf_counter() - submitted_at
+            with Executors._fs_lock:
+                Executors._fs_running += 1
+                Executors._fs_wait_total += waited
+                Executors._fs_wait_max = max(Executors._fs_wait_max, waited)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with Executors._fs_lock:
+                    Executors._fs_running -= 1
+                    Executors._fs_completed += 1
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(Executors.fs_pool(), run)
+
+    @staticmethod
+    def fs_stats() -> ExecutorStats:
+        queued = 0
+        if Executors._fs_pool is not None:
+            queued = Executors._fs_pool._work_queue.qsize()
+        with Executors._fs_lock:
+            completed = Executors._fs_completed
+            return ExecutorStats(
+                workers=get_settings().FS_THREAD_POOL_SIZE,
+                queued=queued,
+                running=Executors._fs_running,
+                completed=completed,
+                wait_avg=Executors._fs_wait_total / completed if completed else 0,
+                wait_max=Executors._fs_wait_max,
+            )
+
+    @staticmethod
+    def shutdown():
+        if Executors._zip_pool is not None:
+            Executors._zip_pool.shutdown(wait=False, cancel_futures=True)
+            Executors._zip_pool = None
+        if Executors._password_pool is not None:
+            Executors._password_pool.shutdown(wait=False, cancel_futures=True)
+            Executors._password_pool = None
+        if Executors._fs_pool is not None:
+            Executors._fs_pool.shutdown(wait=False, cancel_futures=True)
+            Executors._fs_pool = None
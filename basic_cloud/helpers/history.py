@@ -0,0 +1,372 @@
+"""
+buffers content change history in memory,
+writing it to the database in batches
+"""
+import asyncio
+import base64
+import binascii
+import json
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from fastapi import HTTPException, Query, Response, status
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
+
+from ..config import get_settings
+from ..database import crud, models
+from .constants import ContentChangeTypes, JobType
+from .exceptions import CursorInvalid
+from .jobs import JobQueue
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for the last write on shutdown
+STOP_FLUSH_TIMEOUT = 10
+
+
+@dataclass
+class PendingChange:
+    path: Path
+    change_type: ContentChangeTypes
+    is_dir: bool
+    triggered_by_id: Optional[UUID]
+    extra_meta: Optional[dict]
+    created_at: datetime
+
+
+class HistoryBuffer:
+    """
+    static class that collects content changes and
+    writes them as bulk inserts, once enough have been
+    collected or they have waited long enough
+    """
+    _pending: List[Tuple[PendingChange, Optional[asyncio.Future]]] = []
+    _timer: Optional[asyncio.TimerHandle] = None
+    _tasks: Set[asyncio.Task] = set()
+    _lock: Optional[asyncio.Lock] = None
+    _closed: bool = False
+
+    @staticmethod
+    def start():
+        HistoryBuffer._closed = False
+
+    @staticmethod
+    async def log(
+            path: Path,
+            change_type: ContentChangeTypes,
+            is_dir: bool,
+            triggered_by: models.User = None,
+            extra_meta: dict = None):
+        """
+        adds a content change to the buffer, when
+        HISTORY_DURABLE is set this waits until it has been written
+
+            :param path: the path that changed
+            :param change_type: the type of change
+            :param is_dir: whether the path is a directory
+            :param triggered_by: the user that made the change
+            :param extra_meta: any extra meta to store
+        """
+        if HistoryBuffer._closed:
+            logger.warning("history buffer is stopped, dropping change for '%s'", path)
+            return
+        loop = asyncio.get_running_loop()
+        waiter = None
+        if get_settings().HISTORY_DURABLE:
+            waiter = loop.create_future()
+        HistoryBuffer._pending.append((
+            PendingChange(
+                path,
+                change_type,
+                is_dir,
+                None if triggered_by is None else triggered_by.uuid,
+                extra_meta,
+                timezone.now(),
+            ),
+            waiter,
+        ))
+
+        if len(HistoryBuffer._pending) >= get_settings().HISTORY_BUFFER_SIZE:
+            HistoryBuffer._schedule_flush()
+        elif HistoryBuffer._timer is None:
+            HistoryBuffer._timer = loop.call_later(
+                get_settings().HISTORY_FLUSH_INTERVAL,
+                HistoryBuffer._schedule_flush,
+            )
+
+        if waiter is not None:
+            await waiter
+
+    @staticmethod
+    def _schedule_flush():
+        if HistoryBuffer._timer is not None:
+            HistoryBuffer._timer.cancel()
+            HistoryBuffer._timer = None
+        task = asyncio.create_task(HistoryBuffer.flush())
+        HistoryBuffer._tasks.add(task)
+        task.add_done_callback(HistoryBuffer._tasks.discard)
+
+    @staticmethod
+    @asynccontextmanager
+    async def hold():
+        """
+        stops the buffer being written until exited,
+        so fake paths are not removed while they are being used
+        """
+        if HistoryBuffer._lock is None:
+            HistoryBuffer._lock = asyncio.Lock()
+        async with HistoryBuffer._lock:
+            yield
+
+    @staticmethod
+    async def flush():
+        """
+        writes every buffered change to the database
+        """
+        async with HistoryBuffer.hold():
+            if HistoryBuffer._timer is not None:
+                HistoryBuffer._timer.cancel()
+                HistoryBuffer._timer = None
+            batch = HistoryBuffer._pending
+            HistoryBuffer._pending = []
+            if not batch:
+                return
+
+            try:
+                await HistoryBuffer._write([change for change, _ in batch])
+            except Exception as err:
+                logger.exception("failed to write %d history changes", len(batch))
+                for _, waiter in batch:
+                    if waiter is not None and not waiter.done():
+                        waiter.set_exception(err)
+            else:
+                for _, waiter in batch:
+                    if waiter is not None and not waiter.done():
+                        waiter.set_result(None)
+
+    @staticmethod
+    async def _write(changes: List[PendingChange]):
+        paths = {}
+        for change in changes:
+            paths.setdefault(change.path, change.is_dir)
+        fake_path_ids = await crud.get_or_create_fake_path_ids(paths)
+        rows = [
+            models.ContentChange(
+                fake_path_id=fake_path_ids[change.path],
+                type_enum=change.change_type,
+                triggered_by_id=change.triggered_by_id,
+                extra_meta=change.extra_meta,
+                created_at=change.created_at,
+            )
+            for change in changes
+        ]
+        try:
+            await crud.bulk_create_content_changes(rows)
+            return
+        except IntegrityError:
+            pass
+
+        # a user may have been deleted since making the change
+        user_uuids = await crud.get_existing_user_uuids({
+            row.triggered_by_id for row in rows if row.triggered_by_id is not None
+        })
+        for row in rows:
+            if row.triggered_by_id not in user_uuids:
+                row.triggered_by_id = None
+        try:
+            await crud.bulk_create_content_changes(rows)
+            return
+        except IntegrityError:
+            logger.warning("failed to write history batch, retrying each change")
+
+        # so one bad change can't lose the whole batch
+        for row, change in zip(rows, changes):
+            try:
+                await crud.bulk_create_content_changes([row])
+            except IntegrityError:
+                logger.exception("failed to write history change for '%s'", change.path)
+
+    @staticmethod
+    async def stop():
+        """
+        stops accepting changes & writes anything left
+        in the buffer, used on shutdown once nothing else can make changes
+        """
+        HistoryBuffer._closed = True
+        if HistoryBuffer._timer is not None:
+            HistoryBuffer._timer.cancel()
+            HistoryBuffer._timer = None
+        await asyncio.gather(*HistoryBuffer._tasks, return_exceptions=True)
+        pending = len(HistoryBuffer._pending)
+        try:
+            # a task cancelled while starting a transaction
+            # can leave the database connection locked
+            await asyncio.wait_for(HistoryBuffer.flush(), STOP_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("timed out writing history on shutdown, %d changes lost", pending)
+
+
+def get_retention_cutoffs(now: datetime) -> Dict[ContentChangeTypes, datetime]:
+    """
+    gets when history of each type should be kept from,
+    types that are kept forever are left out
+
+        :param now: the current time
+        :return: the cutoff for each type
+    """
+    cutoffs = {}
+    for change_type in ContentChangeTypes:
+        days = get_settings().HISTORY_RETENTION_BY_TYPE.get(
+            change_type.name,
+            get_settings().HISTORY_RETENTION_DAYS,
+        )
+        if days > 0:
+            cutoffs[change_type] = now - timedelta(days=days)
+    return cutoffs
+
+
+class HistoryCompactor:
+    """
+    static class that queues a history compaction job
+    every HISTORY_COMPACT_INTERVAL hours
+    """
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def start():
+        if get_settings().HISTORY_COMPACT_INTERVAL > 0:
+            HistoryCompactor._task = asyncio.create_task(HistoryCompactor._run())
+
+    @staticmethod
+    async def stop():
+        if HistoryCompactor._task is not None:
+            HistoryCompactor._task.cancel()
+            try:
+                await HistoryCompactor._task
+            except asyncio.CancelledError:
+                pass
+            HistoryCompactor._task = None
+
+    @staticmethod
+    async def _run():
+        interval = get_settings().HISTORY_COMPACT_INTERVAL * 60 * 60
+        while True:
+            next_run = interval
+            try:
+                job = await crud.get_latest_job(JobType.COMPACT_HISTORY)
+                since = interval
+                if job is not None:
+                    since = (timezone.now() - job.created_at).total_seconds()
+                if since < interval:
+                    # was queued recently, e.g. before a restart
+                    next_run = interval - since
+                # a job still running from before is left to finish
+                elif job is None or job.finished_at is not None:
+                    owner = await crud.get_first_admin_user()
+                    if owner is None:
+                        logger.warning("no admin user to own history compaction")
+                    else:
+                        await JobQueue.submit(owner, JobType.COMPACT_HISTORY, {})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("failed to queue history compaction")
+            await asyncio.sleep(next_run)
+
+
+@dataclass
+class HistoryParams:
+    limit: int
+    after: Optional[Tuple[datetime, int]]
+    descending: bool
+    since: Optional[datetime]
+    until: Optional[datetime]
+    type_enums: Optional[List[ContentChangeTypes]]
+    triggered_by_id: Optional[UUID]
+
+    def as_filters(self) -> dict:
+        return {
+            # one extra row tells us if there is another page
+            "limit": self.limit + 1,
+            "after": self.after,
+            "descending": self.descending,
+            "since": self.since,
+            "until": self.until,
+            "type_enums": self.type_enums,
+            "triggered_by_id": self.triggered_by_id,
+        }
+
+
+def encode_history_cursor(row: models.ContentChange, descending: bool) -> str:
+    cursor = [descending, row.created_at.isoformat(), row.id]
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_history_cursor(cursor: str, descending: bool) -> Tuple[datetime, int]:
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(cursor, list) or len(cursor) != 3:
+            raise ValueError()
+        if cursor[0] != descending:
+            raise CursorInvalid("cursor is for a different order")
+        return datetime.fromisoformat(cursor[1]), int(cursor[2])
+    except (ValueError, TypeError, binascii.Error):
+        raise CursorInvalid("malformed cursor") from None
+
+
+def get_history_params(
+        limit: int = Query(100, ge=1, le=1000),
+        cursor: Optional[str] = None,
+        descending: bool = False,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        type_enum: Optional[List[ContentChangeTypes]] = Query(None),
+        user: Optional[UUID] = None) -> HistoryParams:
+    """
+    the query parameters for paging & filtering history,
+    used as a dependency
+    """
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_history_cursor(cursor, descending)
+        except CursorInvalid as err:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(err),
+            ) from None
+    return HistoryParams(limit, after, descending, since, until, type_enum, user)
+
+
+async def get_history_page(
+        path: Path,
+        params: HistoryParams,
+        response: Response,
+        recursive: bool = False) -> List[models.ContentChange]:
+    """
+    gets a page of a paths history, setting
+    X-Next-Cursor when there are more pages
+
+        :param path: the path
+        :param params: the paging & filters
+        :param response: the response to add the header to
+        :param recursive: whether to include everything below the path
+        :return: the content changes
+    """
+    # include any changes still waiting to be written
+    await HistoryBuffer.flush()
+    if recursive:
+        rows = await crud.get_content_changes_below(path, **params.as_filters())
+    else:
+        rows = await crud.get_content_changes_by_path(path, **params.as_filters())
+    if len(rows) > params.limit:
+        rows = rows[:params.limit]
+        response.headers["X-Next-Cursor"] = encode_history_cursor(
+            rows[-1], params.descending)
+    return rows
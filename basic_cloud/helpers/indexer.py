@@ -0,0 +1,408 @@
+"""
+keeps the filesystem metadata index up to date,
+using changes made through the app and a background reconciler
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import stat
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from tortoise import timezone
+
+from ..config import get_settings
+from ..database import crud
+from ..database.models import IndexedPath
+from .constants import HIDDEN_TEMP_PREFIXES, ContentChangeTypes
+from .exceptions import PathNotExists
+from .executors import Executors
+from .paths import create_root_path
+
+logger = logging.getLogger(__name__)
+
+# directories to reconcile before saving the progress
+CHECKPOINT_EVERY = 100
+
+
+class IndexEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int
+    mtime_ns: int
+
+
+def hash_file(full_path: Path, chunk_size: int) -> str:
+    """
+    creates a sha256 of a files content
+
+        :param full_path: the file to hash
+        :param chunk_size: max bytes to read into memory at once
+        :return: the hex digest
+    """
+    hasher = hashlib.sha256()
+    with open(full_path, "rb") as fo:
+        for chunk in iter(lambda: fo.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def scan_index_entries(full_path: Path) -> List[IndexEntry]:
+    """
+    scans a directory for the index, sorted by name
+
+        :param full_path: the directory to scan
+        :return: the directory entries
+    """
+    entries = []
+    try:
+        with os.scandir(full_path) as it:
+            for entry in it:
+                if entry.name.startswith(HIDDEN_TEMP_PREFIXES):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    stat_result = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append(IndexEntry(
+                    entry.name,
+                    is_dir,
+                    0 if is_dir else stat_result.st_size,
+                    stat_result.st_mtime_ns,
+                ))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+
+
+def get_usage_keys(path_key: str) -> List[str]:
+    """
+    gets the storage usage totals that a path counts towards
+
+        :param path_key: the path key
+        :return: the usage keys, the root and the users home if in one
+    """
+    parts = path_key.split("/")
+    keys = [parts[0]]
+    if parts[0] == get_settings().HOMES_PATH.name and len(parts) > 1:
+        keys.append("/".join(parts[:2]))
+    return keys
+
+
+def get_root_paths() -> Dict[str, Path]:
+    return {
+        get_settings().SHARED_PATH.name: get_settings().SHARED_PATH,
+        get_settings().HOMES_PATH.name: get_settings().HOMES_PATH,
+    }
+
+
+class IndexReconciler:
+    """
+    static class that walks the root directories in the
+    background, bringing the index back in line with the filesystem.
+    progress is saved so a pass can resume after a restart
+    """
+    _generations: Dict[str, int] = {}
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def get_generation(path_key: str) -> int:
+        root = path_key.split("/", 1)[0]
+        return IndexReconciler._generations.get(root, 0)
+
+    @staticmethod
+    async def load():
+        for root in get_root_paths():
+            state = await crud.get_index_state(root)
+            IndexReconciler._generations[root] = state.generation
+
+    @staticmethod
+    def start():
+        if get_settings().INDEX_RECONCILE_INTERVAL > 0:
+            IndexReconciler._task = asyncio.create_task(IndexReconciler._run())
+
+    @staticmethod
+    async def stop():
+        if IndexReconciler._task is not None:
+            IndexReconciler._task.cancel()
+            try:
+                await IndexReconciler._task
+            except asyncio.CancelledError:
+                pass
+            IndexReconciler._task = None
+
+    @staticmethod
+    async def _run():
+        interval = get_settings().INDEX_RECONCILE_INTERVAL
+        while True:
+            next_run = interval
+            for root, root_path in get_root_paths().items():
+                state = await crud.get_index_state(root)
+                if state.finished_at is not None and state.checkpoint is None:
+                    since = (timezone.now() - state.finished_at).total_seconds()
+                    if since < interval:
+                        # was reconciled recently, e.g. before a restart
+                        next_run = min(next_run, interval - since)
+                        continue
+                try:
+                    await IndexReconciler.reconcile_root(root, root_path)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("failed to reconcile index for '%s'", root)
+            await asyncio.sleep(next_run)
+
+    @staticmethod
+    async def reconcile_root(root: str, root_path: Path):
+        """
+        walks a root directory updating the index, directories are
+        visited in sorted order so a saved checkpoint can be resumed from
+
+            :param root: the root directory name
+            :param root_path: the full path of the root directory
+        """
+        state = await crud.get_index_state(root)
+        generation = state.generation
+        IndexReconciler._generations[root] = generation
+        checkpoint = None
+        if state.checkpoint is not None:
+            checkpoint = Path(state.checkpoint).parts
+
+        await index_path(Path(root), root_path, generation)
+
+        since_checkpoint = 0
+        stack: List[Tuple[Path, Path]] = [(root_path, Path(root))]
+        while stack:
+            full_path, path = stack.pop()
+            parts = path.parts
+            entries = await Executors.run_fs(scan_index_entries, full_path)
+            # directories up to the checkpoint were done before a restart
+            if checkpoint is None or parts > checkpoint:
+                await reconcile_directory(full_path, path, entries, generation)
+                since_checkpoint += 1
+                if since_checkpoint >= CHECKPOINT_EVERY:
+                    state.checkpoint = path.as_posix()
+                    await state.save()
+                    since_checkpoint = 0
+
+            for entry in reversed(entries):
+                if not entry.is_dir:
+                    continue
+                child_parts = parts + (entry.name,)
+                if (checkpoint is not None and child_parts < checkpoint and
+                        checkpoint[:len(child_parts)] != child_parts):
+                    # whole directory was done before the checkpoint
+                    continue
+                stack.append((full_path.joinpath(entry.name), path.joinpath(entry.name)))
+
+        # anything not seen in this pass no longer exists
+        await crud.delete_unseen_indexed_paths(root, generation)
+        await recalculate_storage_usage(root)
+        state.generation = generation + 1
+        state.checkpoint = None
+        state.finished_at = timezone.now()
+        await state.save()
+        IndexReconciler._generations[root] = state.generation
+
+
+async def recalculate_storage_usage(root: str):
+    """
+    sets the storage usage totals for a root directory
+    (and the homes inside it) from the index, correcting any drift
+
+        :param root: the root directory name
+    """
+    bytes_size, file_count = await crud.get_indexed_usage(root)
+    await crud.set_storage_usage(root, bytes_size, file_count)
+    if root != get_settings().HOMES_PATH.name:
+        return
+    homes = set()
+    for name, row in (await crud.get_indexed_children(root)).items():
+        if not row.is_dir:
+            continue
+        key = f"{root}/{name}"
+        bytes_size, file_count = await crud.get_indexed_usage(key)
+        await crud.set_storage_usage(key, bytes_size, file_count)
+        homes.add(key)
+    for usage in await crud.get_storage_usages_below(root):
+        if usage.key not in homes:
+            await crud.delete_storage_usage(usage.key)
+
+
+async def reconcile_directory(
+        full_path: Path,
+        path: Path,
+        entries: List[IndexEntry],
+        generation: int):
+    """
+    updates the index rows for a directories entries
+
+        :param full_path: the full path of the directory
+        :param path: the path of the directory
+        :param entries: the scanned directory entries
+        :param generation: the current reconcile pass
+    """
+    parent_key = path.as_posix()
+    existing = await crud.get_indexed_children(parent_key)
+    hash_content = get_settings().INDEX_CONTENT_HASH
+    to_create = []
+    to_update = []
+    for entry in entries:
+        row = existing.get(entry.name)
+        changed = row is None or (
+            row.is_dir != entry.is_dir or
+            row.size != entry.size or
+            row.mtime_ns != entry.mtime_ns
+        )
+        if not changed:
+            continue
+        content_hash = None
+        if hash_content and not entry.is_dir:
+            try:
+                content_hash = await Executors.run_fs(
+                    hash_file,
+                    full_path.joinpath(entry.name),
+                    get_settings().DOWNLOAD_CHUNK_SIZE,
+                )
+            except FileNotFoundError:
+                continue
+        if row is None:
+            to_create.append(IndexedPath(
+                path_key=f"{parent_key}/{entry.name}",
+                parent_key=parent_key,
+                name=entry.name,
+                is_dir=entry.is_dir,
+                size=entry.size,
+                mtime_ns=entry.mtime_ns,
+                content_hash=content_hash,
+                generation=generation,
+            ))
+        else:
+            row.is_dir = entry.is_dir
+            row.size = entry.size
+            row.mtime_ns = entry.mtime_ns
+            row.content_hash = content_hash
+            row.generation = generation
+            to_update.append(row)
+    if to_create:
+        await crud.bulk_create_indexed_paths(to_create)
+    if to_update:
+        await crud.bulk_update_indexed_paths(
+            to_update,
+            ["is_dir", "size", "mtime_ns", "content_hash", "generation"],
+        )
+    await crud.mark_indexed_children_seen(parent_key, generation)
+
+
+async def index_path(path: Path, full_path: Path, generation: int = None) -> Optional[IndexedPath]:
+    """
+    adds or updates a single path in the index
+
+        :param path: the path
+        :param full_path: the full path
+        :param generation: the reconcile pass, or the current one when None
+        :return: the index row, or None if the path does not exist
+    """
+    try:
+        stat_result = await Executors.run_fs(full_path.stat)
+    except FileNotFoundError:
+        return None
+    path_key = path.as_posix()
+    is_dir = stat.S_ISDIR(stat_result.st_mode)
+    content_hash = None
+    if get_settings().INDEX_CONTENT_HASH and not is_dir:
+        content_hash = await Executors.run_fs(
+            hash_file, full_path, get_settings().DOWNLOAD_CHUNK_SIZE)
+    if generation is None:
+        generation = IndexReconciler.get_generation(path_key)
+    parent_key = path.parent.as_posix() if len(path.parts) > 1 else ""
+    old_row = await crud.get_indexed_path(path_key)
+    row = await crud.upsert_indexed_path(path_key, {
+        "parent_key": parent_key,
+        "name": path.name,
+        "is_dir": is_dir,
+        "size": 0 if is_dir else stat_result.st_size,
+        "mtime_ns": stat_result.st_mtime_ns,
+        "content_hash": content_hash,
+        "generation": generation,
+    })
+
+    bytes_delta = row.size if not row.is_dir else 0
+    files_delta = 0 if row.is_dir else 1
+    if old_row is not None and not old_row.is_dir:
+        bytes_delta -= old_row.size
+        files_delta -= 1
+    if bytes_delta or files_delta:
+        await crud.add_storage_usage(get_usage_keys(path_key), bytes_delta, files_delta)
+    return row
+
+
+async def remove_index_path(path_key: str):
+    """
+    removes a path and everything below it from the index
+
+        :param path_key: the path key
+    """
+    bytes_size, file_count = await crud.get_indexed_usage(path_key)
+    await crud.delete_indexed_path(path_key)
+    usage_keys = get_usage_keys(path_key)
+    if file_count:
+        await crud.add_storage_usage(usage_keys, -bytes_size, -file_count)
+    if usage_keys[-1] == path_key and len(usage_keys) > 1:
+        # a users home was removed
+        await crud.delete_storage_usage(path_key)
+
+
+async def move_index_path(path_key: str, new_path_key: str):
+    """
+    moves a path and everything below it in the index
+
+        :param path_key: the current path key
+        :param new_path_key: the new path key
+    """
+    bytes_size, file_count = await crud.get_indexed_usage(path_key)
+    await crud.rename_indexed_paths(path_key, new_path_key)
+    old_keys = get_usage_keys(path_key)
+    new_keys = get_usage_keys(new_path_key)
+    if file_count:
+        removed = [key for key in old_keys if key not in new_keys]
+        added = [key for key in new_keys if key not in old_keys]
+        if removed:
+            await crud.add_storage_usage(removed, -bytes_size, -file_count)
+        if added:
+            await crud.add_storage_usage(added, bytes_size, file_count)
+    if old_keys[-1] == path_key and len(old_keys) > 1:
+        # a users home was moved
+        await crud.delete_storage_usage(path_key)
+
+
+async def update_index(path: Path, change_type: ContentChangeTypes):
+    """
+    updates the index after a change made through the app
+
+        :param path: the path that changed
+        :param change_type: the type of change
+    """
+    if change_type in (ContentChangeTypes.DOWNLOAD, ContentChangeTypes.SHARED):
+        return
+    try:
+        full_path = create_root_path(
+            path,
+            get_settings().HOMES_PATH,
+            get_settings().SHARED_PATH,
+        )
+    except PathNotExists:
+        return
+
+    if change_type == ContentChangeTypes.DELETION or await index_path(path, full_path) is None:
+        await remove_index_path(path.as_posix())
+        return
+
+    # make sure any directories created along the way are indexed
+    for parent in path.parents:
+        if parent == Path() or await crud.get_indexed_path(parent.as_posix()) is not None:
+            break
+        await index_path(parent, full_path.parents[len(path.parts) - len(parent.parts) - 1])
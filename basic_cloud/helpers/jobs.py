@@ -0,0 +1,155 @@
+"""
+runs long operations in the background, jobs are stored
+in the database so they can be resumed after a restart
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from tortoise import timezone
+
+from ..config import get_settings
+from ..database import crud, models
+from .constants import JobStatus, JobType
+from .websocket import dispatch_job_update
+
+logger = logging.getLogger(__name__)
+
+# seconds between saving the progress of a running job
+PROGRESS_SAVE_INTERVAL = 1
+
+
+class JobProgress:
+    """
+    the progress of a running job, can be
+    updated from the thread doing the work
+    """
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, done: int, total: int):
+        self.value = done / total if total else 1.0
+
+
+JobHandler = Callable[[models.Job, JobProgress], Awaitable[Optional[dict]]]
+
+
+class JobQueue:
+    """
+    static class that runs the background jobs,
+    limiting how many run at once in total and for each job type
+    """
+    _handlers: Dict[JobType, JobHandler] = {}
+    _tasks: Set[asyncio.Task] = set()
+    _workers: Optional[asyncio.Semaphore] = None
+    _type_limits: Dict[JobType, asyncio.Semaphore] = {}
+
+    @staticmethod
+    def register(job_type: JobType, handler: JobHandler):
+        """
+        sets the function that runs a job type,
+        it must be safe to run again if interrupted by a restart
+
+            :param job_type: the job type
+            :param handler: the function, returning the jobs result
+        """
+        JobQueue._handlers[job_type] = handler
+
+    @staticmethod
+    async def start():
+        """
+        creates the worker limits and queues any
+        jobs that did not finish before the last shutdown
+        """
+        JobQueue._workers = asyncio.Semaphore(get_settings().JOB_WORKERS)
+        JobQueue._type_limits = {
+            job_type: asyncio.Semaphore(
+                get_settings().JOB_CONCURRENCY.get(job_type.value, 1))
+            for job_type in JobType
+        }
+        for job in await crud.get_unfinished_jobs():
+            JobQueue._schedule(job)
+
+    @staticmethod
+    async def stop():
+        """
+        cancels the running jobs, they will be
+        left as running so are started again next time
+        """
+        tasks = list(JobQueue._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def submit(owner: models.User, job_type: JobType, payload: dict) -> models.Job:
+        """
+        stores a new job and queues it to be run
+
+            :param owner: the user starting the job
+            :param job_type: the job type
+            :param payload: the arguments for the job
+            :return: the created job
+        """
+        job = await crud.create_job(owner, job_type, payload)
+        JobQueue._schedule(job)
+        return job
+
+    @staticmethod
+    def _schedule(job: models.Job):
+        task = asyncio.create_task(JobQueue._run(job))
+        JobQueue._tasks.add(task)
+        task.add_done_callback(JobQueue._tasks.discard)
+
+    @staticmethod
+    async def _save_progress(job: models.Job, progress: JobProgress):
+        while True:
+            await asyncio.sleep(PROGRESS_SAVE_INTERVAL)
+            if progress.value != job.progress:
+                await crud.update_job(job, progress=progress.value)
+
+    @staticmethod
+    async def _run(job: models.Job):
+        async with JobQueue._type_limits[job.job_type]:
+            async with JobQueue._workers:
+                await crud.update_job(job, status=JobStatus.RUNNING)
+                await JobQueue._dispatch(job)
+
+                progress = JobProgress()
+                progress_saver = asyncio.create_task(
+                    JobQueue._save_progress(job, progress))
+                try:
+                    result = await JobQueue._handlers[job.job_type](job, progress)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as err:
+                    logger.exception("job '%s' failed", job.uuid)
+                    values = {"status": JobStatus.FAILED, "result": {"detail": str(err)}}
+                else:
+                    values = {"status": JobStatus.DONE, "progress": 1.0, "result": result}
+                finally:
+                    progress_saver.cancel()
+                    # so a save still in progress can't overwrite the final update
+                    try:
+                        await progress_saver
+                    except asyncio.CancelledError:
+                        pass
+                    except Exception:
+                        logger.exception("failed to save progress of job '%s'", job.uuid)
+
+                await crud.update_job(job, finished_at=timezone.now(), **values)
+                await JobQueue._dispatch(job)
+
+    @staticmethod
+    async def _dispatch(job: models.Job):
+        try:
+            await dispatch_job_update(
+                job.owner_id,
+                job.uuid,
+                job.job_type,
+                job.status,
+                job.progress,
+            )
+        except Exception:
+            # the job still ran, even if a client could not be told
+            logger.exception("failed to send update for job '%s'", job.uuid)
@@ -0,0 +1,94 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from ..config import get_settings
+from .constants import DirectoryContentSort
+from .paths import relative_dir_contents, sort_dir_contents
+from .schema import PathContent
+
+
+@dataclass
+class CachedListing:
+    mtime_ns: int
+    contents: List[PathContent]
+    etag: str
+    _sorted: Dict[DirectoryContentSort, Tuple[List[list], List[PathContent]]] = field(
+        default_factory=dict, repr=False)
+
+    def get_sorted(self, sort: DirectoryContentSort) -> Tuple[List[list], List[PathContent]]:
+        """
+        gets the contents sorted in ascending order, sorted
+        once per listing so later pages don't sort again
+
+            :param sort: what to sort by
+            :return: the sort keys and the contents, in the same order
+        """
+        sorted_contents = self._sorted.get(sort)
+        if sorted_contents is None:
+            sorted_contents = sort_dir_contents(self.contents, sort)
+            self._sorted[sort] = sorted_contents
+        return sorted_contents
+
+
+class DirectoryListingCache:
+    """
+    static class for caching directory listings in memory,
+    keyed by the full directory path. listings are removed when
+    content_changed is triggered and checked against the
+    directory mtime in case of changes made outside of the app.
+    a file edited in place outside of the app does not change
+    the directory mtime, so its size & mtime stay stale until then
+    """
+    _entries: "OrderedDict[Path, CachedListing]" = OrderedDict()
+    _generation: int = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_listing(root_path: Path) -> CachedListing:
+        """
+        gets a directory listing from the cache,
+        or from the filesystem if not cached
+
+            :param root_path: the full path of the directory
+            :return: the directory listing
+        """
+        mtime_ns = root_path.stat().st_mtime_ns
+        max_size = get_settings().LISTING_CACHE_SIZE
+        with DirectoryListingCache._lock:
+            cached = DirectoryListingCache._entries.get(root_path)
+            if cached is not None and cached.mtime_ns == mtime_ns:
+                DirectoryListingCache._entries.move_to_end(root_path)
+                return cached
+            generation = DirectoryListingCache._generation
+
+        contents = relative_dir_contents(root_path)
+        hasher = hashlib.sha256()
+        for content in contents:
+            hasher.update(content.json().encode())
+        cached = CachedListing(mtime_ns, contents, hasher.hexdigest()[:32])
+
+        with DirectoryListingCache._lock:
+            # don't store if it was changed while being listed
+            if max_size > 0 and generation == DirectoryListingCache._generation:
+                DirectoryListingCache._entries[root_path] = cached
+                DirectoryListingCache._entries.move_to_end(root_path)
+                while len(DirectoryListingCache._entries) > max_size:
+                    DirectoryListingCache._entries.popitem(last=False)
+        return cached
+
+    @staticmethod
+    def invalidate(full_path: Path):
+        """
+        removes the listings affected by a changed path,
+        which is the path itself and its parent directory
+
+            :param full_path: the full path that changed
+        """
+        with DirectoryListingCache._lock:
+            DirectoryListingCache._generation += 1
+            DirectoryListingCache._entries.pop(full_path, None)
+            DirectoryListingCache._entries.pop(full_path.parent, None)
@@ -1,19 +1,224 @@
-import zipfile
-from io import BytesIO
+import base64
+import binascii
+import json
+import mimetypes
+import os
+import shutil
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from uuid import uuid4
 
-from .exceptions import PathNotExists
+from .constants import (DELETED_TEMP_PREFIX, HIDDEN_TEMP_PREFIXES,
+                        DirectoryContentSort)
+from .exceptions import CursorInvalid, PathNotExists
+from .executors import Executors
 from .schema import PathContent, PathMeta
+from .zipstream import (ZIP_DEFLATED, ZipStream, coalesce_chunks,
+                        deflate_file)
 
 
-def relative_dir_contents(root_path: Path):
-    for path in root_path.glob("*"):
-        is_dir = path.is_dir()
-        path = path.relative_to(root_path)
-        yield PathContent(
-            name=str(path).replace("\\", "/"),
-            meta=PathMeta(is_directory=is_dir),
-        )
+def relative_dir_contents(root_path: Path) -> List[PathContent]:
+    """
+    gets the contents of a directory,
+    using the stat cached by the directory scan
+
+        :param root_path: the directory to list
+        :return: the directory contents
+    """
+    contents = []
+    with os.scandir(root_path) as it:
+        for entry in it:
+            if entry.name.startswith(HIDDEN_TEMP_PREFIXES):
+                # don't show unfinished uploads or pending deletes
+                continue
+            try:
+                is_dir = entry.is_dir()
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            contents.append(PathContent(
+                name=entry.name,
+                meta=PathMeta(
+                    is_directory=is_dir,
+                    size=None if is_dir else stat_result.st_size,
+                    modified=datetime.fromtimestamp(stat_result.st_mtime, timezone.utc),
+                    mime_type=None if is_dir else mimetypes.guess_type(entry.name)[0],
+                ),
+            ))
+    return contents
+
+
+def get_content_sort_key(content: PathContent, sort: DirectoryContentSort) -> list:
+    if sort == DirectoryContentSort.SIZE:
+        size = -1 if content.meta.size is None else content.meta.size
+        return [size, content.name]
+    if sort == DirectoryContentSort.MODIFIED:
+        return [content.meta.modified.timestamp(), content.name]
+    return [content.name]
+
+
+def encode_contents_cursor(
+        sort: DirectoryContentSort,
+        descending: bool,
+        key: list) -> str:
+    cursor = [sort.value, descending, *key]
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_contents_cursor(
+        cursor: str,
+        sort: DirectoryContentSort,
+        descending: bool) -> list:
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise CursorInvalid("malformed cursor") from None
+    if not isinstance(cursor, list) or cursor[:2] != [sort.value, descending]:
+        raise CursorInvalid("cursor is for a different sort")
+    return cursor[2:]
+
+
+def sort_dir_contents(
+        contents: List[PathContent],
+        sort: DirectoryContentSort) -> Tuple[List[list], List[PathContent]]:
+    """
+    sorts directory contents in ascending order,
+    ready to be paginated in either direction
+
+        :param contents: the directory contents
+        :param sort: what to sort by
+        :return: the sort keys and the contents, in the same order
+    """
+    keyed = sorted(
+        ((get_content_sort_key(content, sort), content) for content in contents),
+        key=lambda item: item[0],
+    )
+    return [key for key, _ in keyed], [content for _, content in keyed]
+
+
+def paginate_dir_contents(
+        keys: List[list],
+        contents: List[PathContent],
+        sort: DirectoryContentSort,
+        descending: bool = False,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None) -> Tuple[List[PathContent], Optional[str]]:
+    """
+    gets a page of sorted directory contents,
+    the cursor marks the last item of the previous page
+    so pages stay correct as items are added or removed.
+    the cursor is found with a binary search, so each page
+    only costs the size of the page
+
+        :param keys: the ascending sort keys, from sort_dir_contents
+        :param contents: the contents in the same order as the keys
+        :param sort: what the contents were sorted by
+        :param descending: whether to page in reverse
+        :param limit: max number of items in the page
+        :param cursor: the cursor from the previous page
+        :return: the page and the cursor for the next page (if there is one)
+    """
+    start, end = 0, len(keys)
+    if cursor is not None:
+        cursor_key = decode_contents_cursor(cursor, sort, descending)
+        try:
+            if descending:
+                end = bisect_left(keys, cursor_key)
+            else:
+                start = bisect_right(keys, cursor_key)
+        except TypeError:
+            raise CursorInvalid("malformed cursor") from None
+
+    next_cursor = None
+    if limit is not None and end - start > limit:
+        if descending:
+            start = end - limit
+            next_cursor = encode_contents_cursor(sort, descending, keys[start])
+        else:
+            end = start + limit
+            next_cursor = encode_contents_cursor(sort, descending, keys[end - 1])
+    page = contents[start:end]
+    if descending:
+        page.reverse()
+    return page, next_cursor
+
+
+def iter_tree_entries(
+        root_path: Path,
+        max_depth: Optional[int] = None) -> Iterator[Tuple[str, bool, int, int]]:
+    """
+    walks a directory depth first, only keeping the open
+    directory scans in memory so huge trees can be walked
+
+        :param root_path: the directory to walk
+        :param max_depth: how many directories deep to go, None for no limit
+        :yield: the relative path, whether it is a directory, size and mtime in ns
+    """
+    stack = [(os.scandir(root_path), "", 0)]
+    try:
+        while stack:
+            it, prefix, depth = stack[-1]
+            entry = next(it, None)
+            if entry is None:
+                it.close()
+                stack.pop()
+                continue
+            if entry.name.startswith(HIDDEN_TEMP_PREFIXES):
+                # don't show unfinished uploads or pending deletes
+                continue
+            try:
+                # don't follow links, they could loop back on themselves
+                is_dir = entry.is_dir(follow_symlinks=False)
+                stat_result = entry.stat(follow_symlinks=False)
+            except OSError:
+                # removed or unreadable, the response has already started
+                continue
+            path = prefix + entry.name
+            yield path, is_dir, 0 if is_dir else stat_result.st_size, stat_result.st_mtime_ns
+            if is_dir and (max_depth is None or depth < max_depth):
+                try:
+                    stack.append((os.scandir(entry.path), path + "/", depth + 1))
+                except (FileNotFoundError, NotADirectoryError, PermissionError):
+                    continue
+    finally:
+        for it, _, _ in stack:
+            it.close()
+
+
+def iter_tree_ndjson(
+        root_path: Path,
+        max_depth: Optional[int],
+        chunk_size: int) -> Iterator[bytes]:
+    """
+    streams a directory tree as newline delimited json,
+    lines are grouped so each chunk is roughly chunk_size
+
+        :param root_path: the directory to walk
+        :param max_depth: how many directories deep to go, None for no limit
+        :param chunk_size: the size to group lines up to
+        :yield: the chunks of json lines
+    """
+    lines = []
+    size = 0
+    for path, is_dir, file_size, mtime_ns in iter_tree_entries(root_path, max_depth):
+        line = json.dumps({
+            "path": path,
+            "is_dir": is_dir,
+            "size": None if is_dir else file_size,
+            "mtime": mtime_ns / 1e9,
+        }, separators=(",", ":")).encode() + b"\n"
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(lines)
+            lines.clear()
+            size = 0
+    if lines:
+        yield b"".join(lines)
 
 
 def create_user_home_dir(username: str, homes_path: Path):
@@ -68,33 +273,226 @@ def is_root_path(
     return False
 
 
-def create_zip(root_path: Path) -> BytesIO:
-    file_obj = BytesIO()
-    with zipfile.ZipFile(
-            file_obj, mode="w",
-            compression=zipfile.ZIP_STORED,
-            compresslevel=None) as zip_obj:
-        for file_path in root_path.rglob("*"):
-            zip_obj.write(file_path, file_path.relative_to(root_path))
-    file_obj.seek(0)
-    return file_obj
+def iter_zip_paths(root_path: Path) -> Iterator[Tuple[Path, str]]:
+    """
+    walks a directory for the paths to add to a zip
 
+        :param root_path: the directory to walk
+        :return: each path and its name in the archive
+    """
+    for path in root_path.rglob("*"):
+        if path.name.startswith(HIDDEN_TEMP_PREFIXES):
+            continue
+        yield path, path.relative_to(root_path).as_posix()
+
+
+def write_zip_entries(
+        paths: Iterable[Tuple[Path, str]],
+        zip_stream: ZipStream,
+        chunk_size: int) -> Iterator[bytes]:
+    for path, arcname in paths:
+        try:
+            if path.is_dir():
+                yield from zip_stream.add_directory(arcname, path.stat())
+            elif path.is_file():
+                yield from zip_stream.add_file(arcname, path, chunk_size)
+        except FileNotFoundError:
+            # removed while the zip was being made
+            continue
+
+
+def remove_deflated_file(future: Future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().remove()
+
+
+def write_compressed_zip_entries(
+        paths: Iterable[Tuple[Path, str]],
+        zip_stream: ZipStream,
+        chunk_size: int,
+        compression_level: int) -> Iterator[bytes]:
+    """
+    compresses files in parallel using the zip worker pool,
+    entries are still written to the stream in order
+
+        :param paths: each path and its name in the archive
+        :param zip_stream: the stream to write the entries to
+        :param chunk_size: max bytes to read into memory at once
+        :param compression_level: the deflate level 1-9
+        :return: the archive chunks
+    """
+    pool = Executors.zip_pool()
+    max_pending = Executors.zip_workers() * 2
+    pending = deque()
+
+    def write_next() -> Iterator[bytes]:
+        path, arcname, future = pending.popleft()
+        try:
+            if future is None:
+                yield from zip_stream.add_directory(arcname, path.stat())
+                return
+            deflated = future.result()
+        except FileNotFoundError:
+            # removed while the zip was being made
+            return
+        try:
+            if deflated.compressed_size >= deflated.size:
+                # compression did not help, so store it instead
+                yield from zip_stream.add_file(arcname, path, chunk_size)
+            else:
+                yield from zip_stream.add_encoded(
+                    arcname,
+                    deflated.stat_result,
+                    deflated.iter_chunks(chunk_size),
+                    ZIP_DEFLATED,
+                    deflated.crc,
+                    deflated.size,
+                )
+        except FileNotFoundError:
+            pass
+        finally:
+            deflated.remove()
+
+    try:
+        for path, arcname in paths:
+            future: Optional[Future] = None
+            if path.is_file():
+                future = pool.submit(deflate_file, path, compression_level, chunk_size)
+            elif not path.is_dir():
+                continue
+            pending.append((path, arcname, future))
+            if len(pending) >= max_pending:
+                yield from write_next()
+        while pending:
+            yield from write_next()
+    finally:
+        # stream was closed early, clean up any compressed files
+        for _, _, future in pending:
+            if future is not None and not future.cancel():
+                future.add_done_callback(remove_deflated_file)
+
+
+def iter_batch_zip_paths(full_paths: Iterable[Path]) -> Iterator[Tuple[Path, str]]:
+    """
+    gets the paths to add to a zip of multiple
+    files & directories, each is placed at the top of the archive
+
+        :param full_paths: the files & directories to add
+        :return: each path and its name in the archive
+    """
+    used_names = set()
+    for full_path in full_paths:
+        name = full_path.name
+        count = 1
+        while name in used_names:
+            # two selected paths share the same name
+            name = f"{full_path.stem} ({count}){full_path.suffix}"
+            count += 1
+        used_names.add(name)
+        yield full_path, name
+        if full_path.is_dir():
+            for path, arcname in iter_zip_paths(full_path):
+                yield path, f"{name}/{arcname}"
 
-def calculate_directory_size(root_path: Path) -> int:
+
+def create_zip(
+        paths: Iterable[Tuple[Path, str]],
+        chunk_size: int,
+        compression_level: Optional[int] = None) -> Iterator[bytes]:
+    """
+    creates a zip as a stream,
+    entries are written while the paths are walked
+
+        :param paths: each path and its name in the archive
+        :param chunk_size: max bytes to read into memory at once
+        :param compression_level: the deflate level 1-9, or None to store
+        :return: the zip chunks
+    """
+    zip_stream = ZipStream()
+    if compression_level:
+        chunks = write_compressed_zip_entries(
+            paths, zip_stream, chunk_size, compression_level)
+    else:
+        chunks = write_zip_entries(paths, zip_stream, chunk_size)
+    yield from coalesce_chunks(chunks, chunk_size)
+    yield zip_stream.finish()
+
+
+def write_zip_file(
+        root_path: Path,
+        zip_path: Path,
+        chunk_size: int,
+        compression_level: Optional[int] = None,
+        on_progress: Callable[[int, int], None] = None) -> int:
+    """
+    zips a directory into a file, the zip is written
+    to a temporary file first and then renamed into place
+
+        :param root_path: the directory to zip
+        :param zip_path: where to write the zip
+        :param chunk_size: max bytes to read into memory at once
+        :param compression_level: the deflate level 1-9, or None to store
+        :param on_progress: called with the entries done & total entries
+        :return: the size of the zip in bytes
+    """
+    paths = list(iter_zip_paths(root_path))
+
+    def iter_paths():
+        for done, path in enumerate(paths):
+            if on_progress is not None:
+                on_progress(done, len(paths))
+            yield path
+
+    temp_path = zip_path.with_name(zip_path.name + ".part")
+    try:
+        with open(temp_path, "wb") as fo:
+            for chunk in create_zip(iter_paths(), chunk_size, compression_level):
+                fo.write(chunk)
+        os.replace(temp_path, zip_path)
+    finally:
+        # will only exist if the zip failed
+        temp_path.unlink(missing_ok=True)
+    return zip_path.stat().st_size
+
+
+def remove_tree(
+        root_path: Path,
+        on_progress: Callable[[int, int], None] = None):
     """
-    calculates the size in bytes of a directory and its contents
+    deletes a directory and its contents, one top level
+    entry at a time. can be run again if interrupted
 
-        :param root_path: the root directory to calculate
-        :return: the calculated size in bytes
+        :param root_path: the directory to delete
+        :param on_progress: called with the entries done & total entries
     """
-    return sum(f.stat().st_size for f in root_path.glob('**/*') if f.is_file())
+    try:
+        with os.scandir(root_path) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        # already deleted
+        return
+    for done, entry in enumerate(entries, start=1):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+        if on_progress is not None:
+            on_progress(done, len(entries) + 1)
+    os.rmdir(root_path)
 
 
-def calculate_directory_file_count(root_path: Path) -> int:
+def move_to_trash(full_path: Path) -> Path:
     """
-    calculates the file count for a directory
+    renames a path to a unique hidden name next to it,
+    so it can be removed later without touching anything
+    that is created at the original path in the meantime
 
-        :param root_path: the root directory to calculate
-        :return: the file count
+        :param full_path: the path to move
+        :return: the hidden path it was moved to
     """
-    return sum(1 for f in root_path.glob('**/*') if f.is_file())
+    trash_path = full_path.with_name(f"{DELETED_TEMP_PREFIX}{uuid4().hex}")
+    os.rename(full_path, trash_path)
+    return trash_path
@@ -0,0 +1,179 @@
+"""
+checks uploads against the storage quotas,
+using the storage usage totals and the bytes still being uploaded
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Optional
+
+from tortoise import timezone
+
+from ..config import get_settings
+from ..database import crud, models, schema
+from .exceptions import QuotaExceeded
+from .executors import Executors
+from .indexer import get_usage_keys
+
+
+def get_quota_limit(usage_key: str, user: models.User) -> Optional[int]:
+    """
+    gets the quota for a storage usage key
+
+        :param usage_key: the usage key e.g. shared or homes/bob
+        :param user: the user that owns the home, if usage key is a home
+        :return: the limit in bytes, or None when unlimited
+    """
+    if usage_key == get_settings().SHARED_PATH.name:
+        limit = get_settings().SHARED_QUOTA_BYTES
+    elif "/" in usage_key:
+        limit = user.quota_bytes
+        if limit is None:
+            limit = get_settings().USER_QUOTA_BYTES
+    else:
+        # the homes root only has the quotas of each home
+        return None
+    return limit or None
+
+
+class UploadQuota:
+    """
+    tracks the bytes of a single upload against
+    the quotas of the paths it will count towards
+    """
+    def __init__(self, usage: Dict[str, int], limits: Dict[str, int], replaced: int):
+        self._usage = usage
+        self._limits = limits
+        self._replaced = replaced
+        self._reserved = 0
+
+    def check(self, size: int):
+        """
+        checks bytes would fit without reserving them
+
+            :param size: the number of bytes
+            :raises QuotaExceeded: when a quota would be exceeded
+        """
+        for key, limit in self._limits.items():
+            in_flight = QuotaTracker.get_in_flight(key)
+            if self._usage[key] + in_flight + size - self._replaced > limit:
+                raise QuotaExceeded(f"storage quota for '{key}' exceeded")
+
+    def add(self, size: int):
+        """
+        reserves bytes for the upload, call before writing them
+
+            :param size: the number of bytes about to be written
+            :raises QuotaExceeded: when a quota would be exceeded
+        """
+        self.check(size)
+        for key in self._limits:
+            QuotaTracker.add_in_flight(key, size)
+        self._reserved += size
+
+    def release(self):
+        """
+        releases the reserved bytes, call once
+        the upload has finished or been aborted
+        """
+        for key in self._limits:
+            QuotaTracker.add_in_flight(key, -self._reserved)
+        self._reserved = 0
+
+
+class QuotaTracker:
+    """
+    static class for tracking the bytes being uploaded
+    that are not counted in the storage usage totals yet
+    """
+    _in_flight: Dict[str, int] = {}
+
+    @staticmethod
+    def get_in_flight(usage_key: str) -> int:
+        return QuotaTracker._in_flight.get(usage_key, 0)
+
+    @staticmethod
+    def add_in_flight(usage_key: str, size: int):
+        in_flight = QuotaTracker._in_flight.get(usage_key, 0) + size
+        if in_flight:
+            QuotaTracker._in_flight[usage_key] = in_flight
+        else:
+            QuotaTracker._in_flight.pop(usage_key, None)
+
+    @staticmethod
+    async def get_upload_quota(
+            path: Path,
+            full_path: Path,
+            user: models.User) -> UploadQuota:
+        """
+        gets the quota tracker for a upload
+
+            :param path: the path being uploaded to
+            :param full_path: the full path being uploaded to
+            :param user: the user uploading
+            :return: the upload quota
+        """
+        path_key = path.as_posix()
+        usage = {}
+        limits = {}
+        for usage_key in get_usage_keys(path_key):
+            limit = get_quota_limit(usage_key, user)
+            if limit is None:
+                continue
+            limits[usage_key] = limit
+            usage[usage_key] = (
+                (await crud.get_storage_usage(usage_key)).bytes +
+                await get_pending_session_bytes(usage_key, user)
+            )
+        replaced = 0
+        if limits and await Executors.run_fs(full_path.is_file):
+            # overwriting a file will free its space
+            replaced = (await Executors.run_fs(full_path.stat)).st_size
+        return UploadQuota(usage, limits, replaced)
+
+
+def get_session_expiry_cutoff() -> Optional[datetime]:
+    """
+    gets the time an upload session must have been
+    written to since, for it to not have expired
+
+        :return: the cutoff, or None when sessions never expire
+    """
+    expire_hours = get_settings().UPLOAD_SESSION_EXPIRE_HOURS
+    if expire_hours <= 0:
+        return None
+    return timezone.now() - timedelta(hours=expire_hours)
+
+
+async def get_pending_session_bytes(usage_key: str, user: models.User) -> int:
+    """
+    totals the space reserved by unfinished upload sessions,
+    leaving out expired sessions that are waiting to be removed
+
+        :param usage_key: the usage key
+        :param user: the user that owns the home, if usage key is a home
+        :return: the reserved bytes
+    """
+    # only the owner can upload to their home
+    owner = user if "/" in usage_key else None
+    return await crud.get_upload_sessions_size(
+        usage_key,
+        owner,
+        get_session_expiry_cutoff(),
+    )
+
+
+async def get_storage_quota(path: Path, user: models.User) -> schema.StorageQuota:
+    """
+    gets the storage usage & quota of a root directory or home
+
+        :param path: the root directory or home
+        :param user: the user that owns the home
+        :return: the usage & quota
+    """
+    usage = await crud.get_storage_usage(path.as_posix())
+    return schema.StorageQuota(
+        path=path,
+        bytes_used=usage.bytes,
+        file_count=usage.files,
+        bytes_limit=get_quota_limit(usage.key, user),
+    )
@@ -0,0 +1,391 @@
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import quote
+from uuid import uuid4
+
+import aiofiles
+from fastapi import Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from ..config import get_settings
+from .archive_cache import iter_open_file
+from .encoding import (is_compressible, negotiate_encoding,
+                       open_cached_encoding, stream_encoded)
+from .upload import merge_ranges
+
+# more ranges than this will just send the whole file
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def get_file_etag(stat_result: os.stat_result, suffix: str = "") -> str:
+    """
+    creates a strong etag from a files stat
+
+        :param stat_result: the stat of the file
+        :param suffix: added to the tag, to tell apart other representations
+        :return: the quoted etag
+    """
+    return (
+        f'"{stat_result.st_ino:x}-{stat_result.st_size:x}'
+        f'-{stat_result.st_mtime_ns:x}{suffix}"'
+    )
+
+
+def get_content_disposition(filename: str) -> str:
+    """
+    creates the content disposition header
+    for downloading a file as an attachment
+
+        :param filename: the filename the client should use
+        :return: the header value
+    """
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def get_media_type(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def get_validator_headers(
+        stat_result: os.stat_result,
+        filename: str,
+        etag_suffix: str = "") -> Dict[str, str]:
+    """
+    creates the headers describing a downloadable file version
+
+        :param stat_result: the stat of the file
+        :param filename: the filename the client should use
+        :param etag_suffix: added to the etag, to tell apart other representations
+        :return: the headers
+    """
+    return {
+        "etag": get_file_etag(stat_result, etag_suffix),
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "accept-ranges": "bytes",
+        "content-disposition": get_content_disposition(filename),
+    }
+
+
+def not_modified_response(headers: Dict[str, str]) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={
+            key: value for key, value in headers.items()
+            if key != "content-disposition"
+        },
+    )
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    parses a http Range header
+
+        :param range_header: the header value
+        :param size: the size of the file in bytes
+        :return: the merged (start, end) ranges with an exclusive end,
+                 or None if the header should be ignored
+        :raises RangeNotSatisfiable: when none of the ranges are in the file
+    """
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not range_set:
+        return None
+    ranges = []
+    for range_spec in range_set.split(","):
+        start, sep, end = range_spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not start:
+                # suffix range e.g. -500 is the last 500 bytes
+                length = int(end)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size))
+                continue
+            start = int(start)
+            end = int(end) + 1 if end else None
+        except ValueError:
+            return None
+        if end is None:
+            end = size
+        elif start >= end:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    ranges = merge_ranges(ranges)
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """
+    checks the conditional request headers to see
+    whether the client already has the current file
+
+        :param request: the request
+        :param etag: the current etag
+        :param mtime: when the file was last modified
+        :return: whether the client copy is current
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(
+            tag.removeprefix("W/") == etag for tag in tags
+        )
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def is_download_start(response: Response) -> bool:
+    """
+    checks whether a download response sends the file from the start,
+    so resumed & partial requests are not counted as another download
+
+        :param response: the download response
+        :return: whether it is a whole file or a range starting at byte 0
+    """
+    if response.status_code == status.HTTP_200_OK:
+        return True
+    if response.status_code == status.HTTP_206_PARTIAL_CONTENT:
+        # multipart responses have no single range to check
+        return response.headers.get("content-range", "").startswith("bytes 0-")
+    return False
+
+
+def is_range_allowed(request: Request, etag: str, last_modified: str) -> bool:
+    """
+    checks If-Range to see whether a partial response can be given
+
+        :param request: the request
+        :param etag: the current etag
+        :param last_modified: the current http last modified date
+        :return: whether the range header can be used
+    """
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    return if_range == last_modified
+
+
+async def iter_file_range(path: Path, start: int, end: int) -> AsyncIterator[bytes]:
+    """
+    reads part of a file in chunks
+
+        :param path: the file to read
+        :param start: where to start reading
+        :param end: where to stop reading, exclusive
+        :return: the chunks read
+    """
+    chunk_size = get_settings().DOWNLOAD_CHUNK_SIZE
+    async with aiofiles.open(path, "rb") as fo:
+        await fo.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await fo.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def iter_file_multirange(
+        path: Path,
+        ranges: List[Tuple[int, int]],
+        part_headers: List[bytes],
+        boundary: str) -> AsyncIterator[bytes]:
+    """
+    reads multiple parts of a file as a multipart/byteranges body
+
+        :param path: the file to read
+        :param ranges: the (start, end) ranges to read
+        :param part_headers: the encoded headers for each range
+        :param boundary: the multipart boundary
+        :return: the chunks read
+    """
+    for (start, end), part_header in zip(ranges, part_headers):
+        yield part_header
+        async for chunk in iter_file_range(path, start, end):
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def file_response(
+        request: Request,
+        path: Path,
+        filename: str,
+        media_type: str = None,
+        headers: Dict[str, str] = None) -> Response:
+    """
+    creates a response for downloading a file,
+    handling conditional and range requests
+
+        :param request: the request
+        :param path: the file to send
+        :param filename: the filename the client should use
+        :param media_type: the content type, guessed from filename when None
+        :param headers: any extra headers to send
+        :return: the response
+    """
+    stat_result = path.stat()
+    size = stat_result.st_size
+    if media_type is None:
+        media_type = get_media_type(filename)
+    base_headers = get_validator_headers(stat_result, filename)
+    etag = base_headers["etag"]
+    last_modified = base_headers["last-modified"]
+    if headers:
+        base_headers.update(headers)
+
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return not_modified_response(base_headers)
+
+    range_header = request.headers.get("range")
+    ranges = None
+    if range_header and is_range_allowed(request, etag, last_modified):
+        try:
+            ranges = parse_range_header(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={**base_headers, "content-range": f"bytes */{size}"},
+            )
+
+    if ranges is None:
+        return FileResponse(
+            path,
+            media_type=media_type,
+            headers=base_headers,
+            stat_result=stat_result,
+        )
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return StreamingResponse(
+            iter_file_range(path, start, end),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type=media_type,
+            headers={
+                **base_headers,
+                "content-range": f"bytes {start}-{end - 1}/{size}",
+                "content-length": str(end - start),
+            },
+        )
+
+    boundary = uuid4().hex
+    part_headers = [
+        (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+        ).encode()
+        for start, end in ranges
+    ]
+    content_length = (
+        sum(len(part_header) + 2 for part_header in part_headers) +
+        sum(end - start for start, end in ranges) +
+        len(f"--{boundary}--\r\n")
+    )
+    return StreamingResponse(
+        iter_file_multirange(path, ranges, part_headers, boundary),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers={**base_headers, "content-length": str(content_length)},
+    )
+
+
+def encoded_file_response(
+        request: Request,
+        full_path: Path,
+        path: Path,
+        encoding: str) -> Response:
+    """
+    creates a response for downloading a compressed file,
+    using the cached copy or compressing it while it is sent
+
+        :param request: the request
+        :param full_path: the full path of the file
+        :param path: the path of the file
+        :param encoding: the content encoding to use
+        :return: the response
+    """
+    stat_result = full_path.stat()
+    base_headers = get_validator_headers(stat_result, path.name, f"-{encoding}")
+    base_headers.update({"content-encoding": encoding, "vary": "accept-encoding"})
+    # ranges are only given from the uncompressed file
+    del base_headers["accept-ranges"]
+    if is_not_modified(request, base_headers["etag"], stat_result.st_mtime):
+        return not_modified_response(base_headers)
+
+    cached_file = open_cached_encoding(path, stat_result, encoding)
+    if cached_file is not None:
+        # sent from the open file, it may be removed from the cache meanwhile
+        return StreamingResponse(
+            iter_open_file(cached_file, get_settings().DOWNLOAD_CHUNK_SIZE),
+            media_type=get_media_type(path.name),
+            headers={
+                **base_headers,
+                "content-length": str(os.fstat(cached_file.fileno()).st_size),
+            },
+        )
+    return StreamingResponse(
+        stream_encoded(
+            full_path,
+            path,
+            stat_result,
+            encoding,
+            get_settings().DOWNLOAD_CHUNK_SIZE,
+        ),
+        media_type=get_media_type(path.name),
+        headers=base_headers,
+    )
+
+
+def download_file_response(request: Request, full_path: Path, path: Path) -> Response:
+    """
+    creates a response for downloading a file, compressing
+    it when the client accepts it and the file type is worth it
+
+        :param request: the request
+        :param full_path: the full path of the file
+        :param path: the path of the file
+        :return: the response
+    """
+    if not get_settings().DOWNLOAD_COMPRESSION or not is_compressible(path.name):
+        return file_response(request, full_path, path.name)
+
+    encoding = None
+    if ("range" not in request.headers and
+            full_path.stat().st_size >= get_settings().DOWNLOAD_COMPRESSION_MIN_SIZE):
+        # ranges are always given from the uncompressed file
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    if encoding is None:
+        return file_response(
+            request,
+            full_path,
+            path.name,
+            headers={"vary": "accept-encoding"},
+        )
+    return encoded_file_response(request, full_path, path, encoding)
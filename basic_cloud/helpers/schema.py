@@ -1,6 +1,8 @@
+from datetime import datetime
 from pathlib import Path
+from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, conlist
 
 
 class PathMeta(BaseModel):
@@ -8,6 +10,9 @@ class PathMeta(BaseModel):
     extra info for a path content
     """
     is_directory: bool
+    size: Optional[int]
+    modified: Optional[datetime]
+    mime_type: Optional[str]
 
 
 class PathContent(BaseModel):
@@ -18,6 +23,14 @@ class PathContent(BaseModel):
     meta: PathMeta
 
 
+class SearchResult(BaseModel):
+    """
+    a path found by a search
+    """
+    path: str
+    meta: PathMeta
+
+
 class Roots(BaseModel):
     """
     the root paths
@@ -50,3 +63,24 @@ class RootStats(BaseModel):
     """
     shared: DirectoryStats
     homes: DirectoryStats
+
+
+class ExecutorStats(BaseModel):
+    """
+    the usage of a worker pool,
+    wait times are in seconds
+    """
+    workers: int
+    queued: int
+    running: int
+    completed: int
+    wait_avg: float
+    wait_max: float
+
+
+class BatchDownload(BaseModel):
+    """
+    multiple paths to download as one zip
+    """
+    paths: conlist(Path, min_items=1)
+    compression_level: Optional[conint(ge=0, le=9)]
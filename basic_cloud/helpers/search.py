@@ -0,0 +1,205 @@
+"""
+filename search over the metadata index,
+using a sqlite FTS5 trigram index when available
+"""
+import logging
+import mimetypes
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+from typing import List
+
+from tortoise import Tortoise
+from tortoise.expressions import Q
+
+from ..database.crud import get_key_range
+from ..database.models import IndexedPath
+from .constants import SearchMode
+from .schema import PathMeta, SearchResult
+
+logger = logging.getLogger(__name__)
+
+FTS_SETUP_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS indexedpath_fts USING fts5(
+    name, content='indexedpath', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS indexedpath_fts_insert AFTER INSERT ON indexedpath BEGIN
+    INSERT INTO indexedpath_fts(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS indexedpath_fts_delete AFTER DELETE ON indexedpath BEGIN
+    INSERT INTO indexedpath_fts(indexedpath_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS indexedpath_fts_update AFTER UPDATE OF name ON indexedpath BEGIN
+    INSERT INTO indexedpath_fts(indexedpath_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO indexedpath_fts(rowid, name) VALUES (new.id, new.name);
+END;
+"""
+
+# trigram index can't be used for shorter queries
+MIN_TRIGRAM_LENGTH = 3
+# rows read at once when matching a glob without the trigram index
+GLOB_BATCH_SIZE = 500
+
+
+def row_to_result(path_key: str, name: str, is_dir: bool, size: int, mtime_ns: int) -> SearchResult:
+    return SearchResult(
+        path=path_key,
+        meta=PathMeta(
+            is_directory=bool(is_dir),
+            size=None if is_dir else size,
+            modified=datetime.fromtimestamp(mtime_ns / 1e9, timezone.utc),
+            mime_type=None if is_dir else mimetypes.guess_type(name)[0],
+        ),
+    )
+
+
+class SearchIndex:
+    """
+    static class for searching the metadata index by filename
+    """
+    _fts_enabled: bool = False
+
+    @staticmethod
+    async def setup():
+        """
+        creates the trigram index when using sqlite,
+        other databases will fall back to normal queries
+        """
+        connection = Tortoise.get_connection("default")
+        if connection.capabilities.dialect != "sqlite":
+            return
+        try:
+            existed = await connection.execute_query_dict(
+                "SELECT name FROM sqlite_master WHERE name = 'indexedpath_fts'")
+            await connection.execute_script(FTS_SETUP_SQL)
+            if not existed:
+                # index any paths added before the search index existed
+                await connection.execute_script(
+                    "INSERT INTO indexedpath_fts(indexedpath_fts) VALUES ('rebuild');")
+            SearchIndex._fts_enabled = True
+        except Exception:
+            logger.warning("sqlite FTS5 trigram not available, search will be slower")
+
+    @staticmethod
+    async def search(
+            query: str,
+            mode: SearchMode,
+            scopes: List[str],
+            limit: int,
+            offset: int) -> List[SearchResult]:
+        """
+        searches for paths by name, best matches first
+
+            :param query: the search query
+            :param mode: how the query is matched
+            :param scopes: the path keys to search below
+            :param limit: max number of results
+            :param offset: number of results to skip
+            :return: the matching paths
+        """
+        if not scopes:
+            return []
+        if mode == SearchMode.EXTENSION:
+            query = "." + query.lstrip(".")
+        if SearchIndex._fts_enabled:
+            return await SearchIndex._search_fts(query, mode, scopes, limit, offset)
+        return await SearchIndex._search_fallback(query, mode, scopes, limit, offset)
+
+    @staticmethod
+    async def _search_fts(
+            query: str,
+            mode: SearchMode,
+            scopes: List[str],
+            limit: int,
+            offset: int) -> List[SearchResult]:
+        scope_sql = " OR ".join("(p.path_key >= ? AND p.path_key < ?)" for _ in scopes)
+        scope_params = [key for scope in scopes for key in get_key_range(scope)]
+
+        if mode == SearchMode.GLOB:
+            match_sql = "f.name GLOB ?"
+            match_params = [query]
+            rank_sql = "length(p.name)"
+        elif mode == SearchMode.EXTENSION:
+            match_sql = "f.name LIKE ?"
+            match_params = ["%" + query.replace("%", "").replace("_", "")]
+            rank_sql = "length(p.name)"
+        elif len(query) >= MIN_TRIGRAM_LENGTH:
+            match_sql = "f.name MATCH ?"
+            match_params = ['"' + query.replace('"', '""') + '"']
+            rank_sql = "f.rank"
+        else:
+            match_sql = "instr(lower(f.name), lower(?)) > 0"
+            match_params = [query]
+            rank_sql = "length(p.name)"
+
+        sql = (
+            "SELECT p.path_key, p.name, p.is_dir, p.size, p.mtime_ns "
+            "FROM indexedpath_fts f JOIN indexedpath p ON p.id = f.rowid "
+            f"WHERE {match_sql} AND ({scope_sql}) "
+            f"ORDER BY lower(p.name) = lower(?) DESC, {rank_sql}, p.path_key "
+            "LIMIT ? OFFSET ?"
+        )
+        rows = await Tortoise.get_connection("default").execute_query_dict(
+            sql, [*match_params, *scope_params, query, limit, offset])
+        return [
+            row_to_result(row["path_key"], row["name"], row["is_dir"], row["size"], row["mtime_ns"])
+            for row in rows
+        ]
+
+    @staticmethod
+    async def _search_fallback(
+            query: str,
+            mode: SearchMode,
+            scopes: List[str],
+            limit: int,
+            offset: int) -> List[SearchResult]:
+        scope_filter = Q()
+        for scope in scopes:
+            start, end = get_key_range(scope)
+            scope_filter |= Q(path_key__gte=start, path_key__lt=end)
+
+        rows = IndexedPath.filter(scope_filter)
+        if mode == SearchMode.EXTENSION:
+            rows = rows.filter(name__iendswith=query)
+        elif mode == SearchMode.SUBSTRING:
+            rows = rows.filter(name__icontains=query)
+        else:
+            # narrow using the longest part without wildcards
+            literal = max(
+                "".join(c if c not in "*?[]" else "\0" for c in query).split("\0"),
+                key=len,
+            )
+            if literal:
+                rows = rows.filter(name__contains=literal)
+
+        rows = rows.order_by("name", "path_key")
+        if mode != SearchMode.GLOB:
+            found = await rows.offset(offset).limit(limit)
+        else:
+            # the pattern is matched here, so the rows are read in
+            # batches after the last row seen, stopping once the page is full
+            found = []
+            skipped = 0
+            after = None
+            while len(found) < limit:
+                batch_rows = rows
+                if after is not None:
+                    batch_rows = batch_rows.filter(
+                        Q(name__gt=after.name) |
+                        Q(name=after.name, path_key__gt=after.path_key))
+                batch = await batch_rows.limit(GLOB_BATCH_SIZE)
+                for row in batch:
+                    if not fnmatchcase(row.name, query):
+                        continue
+                    if skipped < offset:
+                        skipped += 1
+                        continue
+                    found.append(row)
+                    if len(found) >= limit:
+                        break
+                if len(batch) < GLOB_BATCH_SIZE:
+                    break
+                after = batch[-1]
+        return [
+            row_to_result(row.path_key, row.name, row.is_dir, row.size, row.mtime_ns)
+            for row in found
+        ]
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+import aiofiles
+from fastapi import UploadFile
+
+from ..config import get_settings
+from ..database import crud
+from .constants import UPLOAD_TEMP_PREFIX
+from .exceptions import PathNotExists, UploadRangeInvalid
+from .executors import Executors
+from .paths import create_root_path
+from .quota import UploadQuota, get_session_expiry_cutoff
+
+logger = logging.getLogger(__name__)
+
+# how many expired upload sessions to remove at once
+SWEEP_BATCH_SIZE = 100
+
+
+def create_temp_path(path: Path) -> Path:
+    """
+    creates a unique temporary path
+    in the same directory as the given path
+
+        :param path: the final path
+        :return: the temporary path
+    """
+    return path.with_name(f"{UPLOAD_TEMP_PREFIX}{uuid4().hex}.part")
+
+
+async def stream_upload_file(
+        file: UploadFile,
+        path: Path,
+        chunk_size: int,
+        quota: Optional[UploadQuota] = None):
+    """
+    writes an uploaded file to the path in chunks,
+    the file is written to a temporary file first
+    and then renamed into place
+
+        :param file: the uploaded file
+        :param path: where the file should be written
+        :param chunk_size: max bytes to hold in memory at once
+        :param quota: checked before each chunk is written
+        :raises QuotaExceeded: when the quota is exceeded, nothing is kept
+    """
+    temp_path = create_temp_path(path)
+    try:
+        async with aiofiles.open(temp_path, "wb") as fo:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                if quota is not None:
+                    quota.add(len(chunk))
+                await fo.write(chunk)
+        await Executors.run_fs(os.replace, temp_path, path)
+    finally:
+        # will only exist if the upload failed
+        await Executors.run_fs(temp_path.unlink, missing_ok=True)
+        await file.close()
+
+
+def get_session_temp_path(path: Path, session_uuid: UUID) -> Path:
+    """
+    gets the temporary path that a upload session
+    writes to, in the same directory as the final path
+
+        :param path: the final path
+        :param session_uuid: the upload session uuid
+        :return: the temporary path
+    """
+    return path.with_name(f"{UPLOAD_TEMP_PREFIX}{session_uuid.hex}.part")
+
+
+def create_session_file(temp_path: Path, total_size: int):
+    """
+    creates the file a upload session will
+    write its chunks into, sized to the final size
+
+        :param temp_path: the upload session temporary path
+        :param total_size: the final size in bytes
+    """
+    with open(temp_path, "wb") as fo:
+        fo.truncate(total_size)
+        if total_size and hasattr(os, "posix_fallocate"):
+            try:
+                # reserve the disk space now so parts can't run out mid-upload
+                os.posix_fallocate(fo.fileno(), 0, total_size)
+            except OSError:
+                # filesystem does not support it, leave file sparse
+                pass
+
+
+async def write_stream_at(
+        stream: AsyncIterator[bytes],
+        path: Path,
+        offset: int,
+        end: int) -> int:
+    """
+    writes a stream of bytes into an existing
+    file, starting at the offset given
+
+        :param stream: the bytes to write
+        :param path: the file to write into
+        :param offset: where to start writing
+        :param end: the position that must not be written past
+        :return: the number of bytes written
+    """
+    if offset < 0 or offset > end:
+        raise UploadRangeInvalid("offset is outside of file")
+    written = 0
+    async with aiofiles.open(path, "r+b") as fo:
+        await fo.seek(offset)
+        async for chunk in stream:
+            if offset + written + len(chunk) > end:
+                raise UploadRangeInvalid("chunk goes past end of range")
+            await fo.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    merges overlapping or touching byte ranges
+
+        :param ranges: the (start, end) ranges, end is exclusive
+        :return: the sorted merged ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def is_upload_complete(ranges: List[Tuple[int, int]], total_size: int) -> bool:
+    """
+    checks whether the merged ranges cover the whole file
+
+        :param ranges: the merged ranges
+        :param total_size: the final size in bytes
+        :return: whether every byte has been received
+    """
+    if total_size == 0:
+        return True
+    return ranges == [(0, total_size)]
+
+
+def get_part_count(total_size: int, part_size: int) -> int:
+    """
+    gets how many parts a file is split into
+
+        :param total_size: the final size in bytes
+        :param part_size: the size of each part in bytes
+        :return: the number of parts
+    """
+    return max(1, -(-total_size // part_size))
+
+
+def get_part_range(part_number: int, total_size: int, part_size: int) -> Tuple[int, int]:
+    """
+    gets the byte range a numbered part covers
+
+        :param part_number: the part number, starting at 0
+        :param total_size: the final size in bytes
+        :param part_size: the size of each part in bytes
+        :return: the (start, end) range, end is exclusive
+    """
+    if part_number < 0 or part_number >= get_part_count(total_size, part_size):
+        raise UploadRangeInvalid("unknown part number")
+    start = part_number * part_size
+    return start, min(start + part_size, total_size)
+
+
+class UploadSessionSweeper:
+    """
+    static class that removes expired upload sessions
+    & their temporary files every UPLOAD_SESSION_SWEEP_INTERVAL seconds
+    """
+    _task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def start():
+        if (get_settings().UPLOAD_SESSION_SWEEP_INTERVAL > 0 and
+                get_settings().UPLOAD_SESSION_EXPIRE_HOURS > 0):
+            UploadSessionSweeper._task = asyncio.create_task(UploadSessionSweeper._run())
+
+    @staticmethod
+    async def stop():
+        if UploadSessionSweeper._task is not None:
+            UploadSessionSweeper._task.cancel()
+            try:
+                await UploadSessionSweeper._task
+            except asyncio.CancelledError:
+                pass
+            UploadSessionSweeper._task = None
+
+    @staticmethod
+    async def sweep() -> int:
+        """
+        removes the upload sessions that have expired
+
+            :return: the number of sessions removed
+        """
+        expiry_cutoff = get_session_expiry_cutoff()
+        if expiry_cutoff is None:
+            return 0
+        removed = 0
+        while True:
+            upload_sessions = await crud.get_expired_upload_sessions(
+                expiry_cutoff,
+                SWEEP_BATCH_SIZE,
+            )
+            if not upload_sessions:
+                return removed
+            for upload_session in upload_sessions:
+                try:
+                    full_path = create_root_path(
+                        upload_session.path,
+                        get_settings().HOMES_PATH,
+                        get_settings().SHARED_PATH,
+                    )
+                except PathNotExists:
+                    continue
+                temp_path = get_session_temp_path(full_path, upload_session.uuid)
+                # files are removed first, so an interrupted sweep leaves no orphans
+                await Executors.run_fs(temp_path.unlink, missing_ok=True)
+            await crud.delete_upload_sessions(
+                [upload_session.uuid for upload_session in upload_sessions])
+            removed += len(upload_sessions)
+
+    @staticmethod
+    async def _run():
+        interval = get_settings().UPLOAD_SESSION_SWEEP_INTERVAL
+        while True:
+            try:
+                await UploadSessionSweeper.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("failed to remove expired upload sessions")
+            await asyncio.sleep(interval)
@@ -8,8 +8,8 @@ from uuid import UUID, uuid4
 
 from fastapi import WebSocket
 
-from .constants import (ContentChangeTypes, WebsocketMessageTypeReceive,
-                        WebsocketMessageTypeSend)
+from .constants import (ContentChangeTypes, JobStatus, JobType,
+                        WebsocketMessageTypeReceive, WebsocketMessageTypeSend)
 
 
 class WebsocketHandler:
@@ -19,13 +19,19 @@ class WebsocketHandler:
     _ws_by_uuid: Dict[UUID, WebSocket] = {}
     _clients_by_dir: Dict[str, Set[UUID]] = defaultdict(set)
     _clients_by_ws: Dict[UUID, str] = {}
+    _clients_by_user: Dict[UUID, Set[UUID]] = defaultdict(set)
+    _users_by_ws: Dict[UUID, UUID] = {}
 
     @staticmethod
-    async def connect(websocket: WebSocket, curr_dir: Path = None):
+    async def connect(websocket: WebSocket, curr_dir: Path = None, user_uuid: UUID = None):
         await websocket.accept()
         client_uuid = uuid4()
         WebsocketHandler._ws_by_uuid[client_uuid] = websocket
 
+        if user_uuid is not None:
+            WebsocketHandler._clients_by_user[user_uuid].add(client_uuid)
+            WebsocketHandler._users_by_ws[client_uuid] = user_uuid
+
         if curr_dir is not None:
             curr_dir = str(curr_dir)
             WebsocketHandler._clients_by_dir[curr_dir].add(client_uuid)
@@ -52,6 +58,11 @@ class WebsocketHandler:
         curr_dir = WebsocketHandler._clients_by_ws.pop(client_uuid, None)
         if curr_dir:
             WebsocketHandler._clients_by_dir[curr_dir].discard(client_uuid)
+        user_uuid = WebsocketHandler._users_by_ws.pop(client_uuid, None)
+        if user_uuid:
+            WebsocketHandler._clients_by_user[user_uuid].discard(client_uuid)
+            if not WebsocketHandler._clients_by_user[user_uuid]:
+                del WebsocketHandler._clients_by_user[user_uuid]
         del WebsocketHandler._ws_by_uuid[client_uuid]
 
     @staticmethod
@@ -67,6 +78,12 @@ class WebsocketHandler:
             client_ws = WebsocketHandler._ws_by_uuid[client_uuid]
             await client_ws.send_text(data)
 
+    @staticmethod
+    async def send_user(data: str, user_uuid: UUID):
+        for client_uuid in list(WebsocketHandler._clients_by_user.get(user_uuid, ())):
+            client_ws = WebsocketHandler._ws_by_uuid[client_uuid]
+            await client_ws.send_text(data)
+
     @staticmethod
     async def broadcast(data: str, curr_dir: Path = None):
         if curr_dir is None:
@@ -90,6 +107,14 @@ class PayloadServerDirectoryUpdate:
     change_type: ContentChangeTypes
 
 
+@dataclass
+class PayloadServerJobUpdate:
+    uuid: UUID
+    job_type: JobType
+    status: JobStatus
+    progress: float
+
+
 @dataclass
 class WebsocketMessage:
     message_type: Union[
@@ -99,7 +124,8 @@ class WebsocketMessage:
     when: datetime
     payload: Union[
         PayloadClientDirectoryChange,
-        PayloadServerDirectoryUpdate
+        PayloadServerDirectoryUpdate,
+        PayloadServerJobUpdate
     ]
 
     @classmethod
@@ -142,3 +168,23 @@ async def dispatch_content_change(
     while path != Path():
         await WebsocketHandler.broadcast(message_str, path)
         path = path.parent
+
+
+async def dispatch_job_update(
+        user_uuid: UUID,
+        job_uuid: UUID,
+        job_type: JobType,
+        status: JobStatus,
+        progress: float):
+    message = WebsocketMessage(
+        message_type=WebsocketMessageTypeSend.JOB_UPDATE,
+        when=datetime.utcnow(),
+        payload=PayloadServerJobUpdate(
+            job_uuid,
+            job_type,
+            status,
+            progress,
+        ),
+    )
+    message_str = json.dumps(asdict(message), default=str)
+    await WebsocketHandler.send_user(message_str, user_uuid)
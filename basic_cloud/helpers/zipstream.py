@@ -0,0 +1,340 @@
+"""
+write zip archives as a stream,
+without needing to seek or hold the archive in memory
+"""
+import os
+import stat
+import struct
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+__all__ = (
+    "ZipStream",
+    "DeflatedFile",
+    "coalesce_chunks",
+    "deflate_file",
+)
+
+ZIP64_VERSION = 45
+MADE_BY_UNIX = 3 << 8
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+FLAGS = 0x08 | 0x800  # data descriptor & utf-8 names
+MAX_16 = 0xFFFF
+MAX_32 = 0xFFFFFFFF
+DIRECTORY_ATTR = 0x10
+
+
+class ZipEntry(NamedTuple):
+    name: bytes
+    method: int
+    dos_time: int
+    dos_date: int
+    crc: int
+    compressed_size: int
+    size: int
+    offset: int
+    external_attr: int
+
+
+def to_dos_datetime(mtime: float) -> Tuple[int, int]:
+    """
+    converts a timestamp into the zip (MS-DOS) format
+
+        :param mtime: the timestamp
+        :return: the dos time and date
+    """
+    local_time = time.localtime(mtime)
+    if local_time.tm_year < 1980:
+        # earliest time that can be stored
+        return 0, (1 << 5) | 1
+    dos_time = (
+        (local_time.tm_hour << 11) |
+        (local_time.tm_min << 5) |
+        (local_time.tm_sec // 2)
+    )
+    dos_date = (
+        ((local_time.tm_year - 1980) << 9) |
+        (local_time.tm_mon << 5) |
+        local_time.tm_mday
+    )
+    return dos_time, dos_date
+
+
+class DeflatedFile(NamedTuple):
+    """
+    a file that has been compressed ready for a zip entry,
+    the compressed data is either held in data or
+    in a temporary file at temp_path
+    """
+    stat_result: os.stat_result
+    crc: int
+    size: int
+    compressed_size: int
+    data: Optional[bytes] = None
+    temp_path: Optional[str] = None
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[bytes]:
+        if self.data is not None:
+            yield self.data
+            return
+        with open(self.temp_path, "rb") as fo:
+            yield from iter(lambda: fo.read(chunk_size), b"")
+
+    def remove(self):
+        if self.temp_path is not None:
+            try:
+                os.unlink(self.temp_path)
+            except FileNotFoundError:
+                pass
+
+
+def deflate_file(path: Path, level: int, chunk_size: int) -> DeflatedFile:
+    """
+    compresses a file with deflate for a zip entry,
+    intended to be run in a worker process.
+    output bigger than the chunk size goes to a temporary file
+
+        :param path: the file to compress
+        :param level: the compression level 1-9
+        :param chunk_size: max bytes to read into memory at once
+        :return: the compressed file
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    buffer = bytearray()
+    temp_file = None
+    crc = 0
+    size = 0
+    compressed_size = 0
+    try:
+        with open(path, "rb") as fo:
+            stat_result = os.fstat(fo.fileno())
+            for chunk in iter(lambda: fo.read(chunk_size), b""):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                buffer += compressor.compress(chunk)
+                if len(buffer) > chunk_size:
+                    if temp_file is None:
+                        temp_file = tempfile.NamedTemporaryFile(
+                            prefix="basic-cloud-zip-", delete=False)
+                    temp_file.write(buffer)
+                    compressed_size += len(buffer)
+                    buffer.clear()
+        buffer += compressor.flush()
+        compressed_size += len(buffer)
+        if temp_file is None:
+            return DeflatedFile(
+                stat_result, crc, size, compressed_size, data=bytes(buffer))
+        temp_file.write(buffer)
+        temp_file.close()
+        return DeflatedFile(
+            stat_result, crc, size, compressed_size, temp_path=temp_file.name)
+    except BaseException:
+        if temp_file is not None:
+            temp_file.close()
+            os.unlink(temp_file.name)
+        raise
+
+
+def coalesce_chunks(chunks: Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    """
+    joins small chunks together so each
+    yielded chunk is around the chunk size
+
+        :param chunks: the chunks to join
+        :param chunk_size: the size to aim for
+        :return: the joined chunks
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class ZipStream:
+    """
+    builds a zip archive as a stream of bytes,
+    every entry uses a data descriptor & ZIP64 fields
+    so sizes don't need to be known before the data is written
+    """
+    def __init__(self):
+        self._offset = 0
+        self._entries: List[ZipEntry] = []
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def _write_entry(
+            self,
+            arcname: str,
+            stat_result: os.stat_result,
+            chunks: Iterable[bytes],
+            method: int,
+            crc: int = None,
+            size: int = None) -> Iterator[bytes]:
+        name = arcname.encode()
+        dos_time, dos_date = to_dos_datetime(stat_result.st_mtime)
+        offset = self._offset
+
+        # sizes are given in the data descriptor
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+        yield self._emit(struct.pack(
+            "<4sHHHHHLLLHH",
+            b"PK\x03\x04",
+            ZIP64_VERSION,
+            FLAGS,
+            method,
+            dos_time,
+            dos_date,
+            0,
+            MAX_32,
+            MAX_32,
+            len(name),
+            len(extra),
+        ) + name + extra)
+
+        compressed_size = 0
+        calculated_crc = 0
+        for chunk in chunks:
+            compressed_size += len(chunk)
+            if crc is None:
+                calculated_crc = zlib.crc32(chunk, calculated_crc)
+            yield self._emit(chunk)
+        if crc is None:
+            # data was not encoded so the sizes match
+            crc = calculated_crc
+            size = compressed_size
+
+        yield self._emit(struct.pack(
+            "<4sLQQ", b"PK\x07\x08", crc, compressed_size, size))
+
+        external_attr = (stat_result.st_mode & 0xFFFF) << 16
+        if stat.S_ISDIR(stat_result.st_mode):
+            external_attr |= DIRECTORY_ATTR
+        self._entries.append(ZipEntry(
+            name, method, dos_time, dos_date, crc,
+            compressed_size, size, offset, external_attr,
+        ))
+
+    def add_directory(self, arcname: str, stat_result: os.stat_result) -> Iterator[bytes]:
+        """
+        adds an empty directory entry
+
+            :param arcname: the name in the archive
+            :param stat_result: the stat of the directory
+            :return: the archive chunks
+        """
+        yield from self._write_entry(
+            arcname.rstrip("/") + "/", stat_result, (), ZIP_STORED)
+
+    def add_file(self, arcname: str, path: Path, chunk_size: int) -> Iterator[bytes]:
+        """
+        adds a file without compression, reading it in chunks
+
+            :param arcname: the name in the archive
+            :param path: the file to add
+            :param chunk_size: max bytes to read into memory at once
+            :return: the archive chunks
+        """
+        with open(path, "rb") as fo:
+            stat_result = os.fstat(fo.fileno())
+            yield from self._write_entry(
+                arcname,
+                stat_result,
+                iter(lambda: fo.read(chunk_size), b""),
+                ZIP_STORED,
+            )
+
+    def add_encoded(
+            self,
+            arcname: str,
+            stat_result: os.stat_result,
+            chunks: Iterable[bytes],
+            method: int,
+            crc: int,
+            size: int) -> Iterator[bytes]:
+        """
+        adds a file that has already been compressed
+
+            :param arcname: the name in the archive
+            :param stat_result: the stat of the original file
+            :param chunks: the compressed data
+            :param method: the zip compression method used
+            :param crc: the crc32 of the uncompressed data
+            :param size: the uncompressed size
+            :return: the archive chunks
+        """
+        yield from self._write_entry(
+            arcname, stat_result, chunks, method, crc, size)
+
+    def finish(self) -> bytes:
+        """
+        writes the central directory, ending the archive
+
+            :return: the final archive bytes
+        """
+        central_directory = bytearray()
+        for entry in self._entries:
+            extra = struct.pack(
+                "<HHQQQ", 0x0001, 24,
+                entry.size, entry.compressed_size, entry.offset)
+            central_directory += struct.pack(
+                "<4sHHHHHHLLLHHHHHLL",
+                b"PK\x01\x02",
+                MADE_BY_UNIX | ZIP64_VERSION,
+                ZIP64_VERSION,
+                FLAGS,
+                entry.method,
+                entry.dos_time,
+                entry.dos_date,
+                entry.crc,
+                MAX_32,
+                MAX_32,
+                len(entry.name),
+                len(extra),
+                0,
+                0,
+                0,
+                entry.external_attr,
+                MAX_32,
+            ) + entry.name + extra
+
+        entry_count = len(self._entries)
+        directory_offset = self._offset
+        directory_size = len(central_directory)
+        zip64_end_offset = directory_offset + directory_size
+        central_directory += struct.pack(
+            "<4sQHHLLQQQQ",
+            b"PK\x06\x06",
+            44,
+            MADE_BY_UNIX | ZIP64_VERSION,
+            ZIP64_VERSION,
+            0,
+            0,
+            entry_count,
+            entry_count,
+            directory_size,
+            directory_offset,
+        )
+        central_directory += struct.pack(
+            "<4sLQL", b"PK\x06\x07", 0, zip64_end_offset, 1)
+        central_directory += struct.pack(
+            "<4sHHHHLLH",
+            b"PK\x05\x06",
+            0,
+            0,
+            min(entry_count, MAX_16),
+            min(entry_count, MAX_16),
+            min(directory_size, MAX_32),
+            min(directory_offset, MAX_32),
+            0,
+        )
+        return self._emit(bytes(central_directory))
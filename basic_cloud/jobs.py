@@ -0,0 +1,149 @@
+import asyncio
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional
+
+from tortoise import timezone
+
+from .config import get_settings
+from .database import crud, models
+from .helpers.constants import ContentChangeTypes, JobType
+from .helpers.executors import Executors
+from .helpers.history import HistoryBuffer, get_retention_cutoffs
+from .helpers.indexer import remove_index_path
+from .helpers.jobs import JobProgress, JobQueue
+from .helpers.listing_cache import DirectoryListingCache
+from .helpers.paths import create_root_path, remove_tree, write_zip_file
+from .shared import content_changed
+
+
+def get_job_result_path(job: models.Job) -> Path:
+    return get_settings().JOB_RESULTS_PATH.joinpath(f"{job.uuid.hex}.zip")
+
+
+async def delete_directory_job(job: models.Job, progress: JobProgress) -> Optional[dict]:
+    directory = Path(job.payload["path"])
+    if "trash" not in job.payload:
+        # queued before directories were moved aside on request
+        full_path = create_root_path(
+            directory,
+            get_settings().HOMES_PATH,
+            get_settings().SHARED_PATH,
+        )
+        await Executors.run_fs(remove_tree, full_path, progress.set)
+        await job.fetch_related("owner")
+        await content_changed(
+            directory,
+            ContentChangeTypes.DELETION,
+            True,
+            job.owner
+        )
+        return {"path": directory.as_posix()}
+
+    trash_path = create_root_path(
+        Path(job.payload["trash"]),
+        get_settings().HOMES_PATH,
+        get_settings().SHARED_PATH,
+    )
+    await Executors.run_fs(remove_tree, trash_path, progress.set)
+    return {"path": directory.as_posix()}
+
+
+async def delete_user_job(job: models.Job, progress: JobProgress) -> Optional[dict]:
+    username = job.payload["username"]
+    if "trash" not in job.payload:
+        # queued before homes were moved aside on request
+        full_path = get_settings().HOMES_PATH.joinpath(username)
+        await Executors.run_fs(remove_tree, full_path, progress.set)
+        DirectoryListingCache.invalidate(full_path)
+        await remove_index_path(Path(get_settings().HOMES_PATH.name, username).as_posix())
+        return {"username": username}
+
+    trash_path = get_settings().HOMES_PATH.joinpath(job.payload["trash"])
+    await Executors.run_fs(remove_tree, trash_path, progress.set)
+    return {"username": username}
+
+
+async def create_zip_job(job: models.Job, progress: JobProgress) -> Optional[dict]:
+    directory = Path(job.payload["path"])
+    full_path = create_root_path(
+        directory,
+        get_settings().HOMES_PATH,
+        get_settings().SHARED_PATH,
+    )
+    size = await Executors.run_fs(
+        write_zip_file,
+        full_path,
+        get_job_result_path(job),
+        get_settings().DOWNLOAD_CHUNK_SIZE,
+        job.payload.get("compression_level"),
+        progress.set,
+    )
+    return {"path": directory.as_posix(), "size": size}
+
+
+async def compact_history_job(job: models.Job, progress: JobProgress) -> Optional[dict]:
+    settings = get_settings()
+    chunk_size = settings.HISTORY_COMPACT_CHUNK_SIZE
+    now = timezone.now()
+    rollup_before = None
+    if settings.HISTORY_ROLLUP_DAYS > 0:
+        rollup_before = now - timedelta(days=settings.HISTORY_ROLLUP_DAYS)
+    cutoffs = get_retention_cutoffs(now)
+
+    total = 0
+    if rollup_before is not None:
+        total += await crud.filter_downloads_to_rollup(rollup_before).count()
+    if cutoffs:
+        total += await crud.filter_expired_content_changes(cutoffs).count()
+    done = 0
+
+    rolled_up = 0
+    if rollup_before is not None:
+        while True:
+            count = await crud.rollup_downloads_chunk(rollup_before, chunk_size)
+            if not count:
+                break
+            rolled_up += count
+            done += count
+            progress.set(min(done, total), total)
+            # let waiting writers in between chunks
+            await asyncio.sleep(0)
+
+    deleted = 0
+    if cutoffs:
+        expired = crud.filter_expired_content_changes(cutoffs)
+        while True:
+            count = await crud.delete_content_changes_chunk(expired, chunk_size)
+            if not count:
+                break
+            deleted += count
+            done += count
+            progress.set(min(done, total), total)
+            await asyncio.sleep(0)
+    if settings.HISTORY_RETENTION_DAYS > 0:
+        await crud.delete_download_rollups_before(
+            (now - timedelta(days=settings.HISTORY_RETENTION_DAYS)).date())
+
+    removed_paths = 0
+    while True:
+        # buffered history may be about to use a fake path
+        async with HistoryBuffer.hold():
+            count = await crud.delete_orphan_fake_paths_chunk(chunk_size)
+        if not count:
+            break
+        removed_paths += count
+        await asyncio.sleep(0)
+
+    return {
+        "rolled_up": rolled_up,
+        "deleted": deleted,
+        "removed_paths": removed_paths,
+    }
+
+
+def register_jobs():
+    JobQueue.register(JobType.DELETE_DIRECTORY, delete_directory_job)
+    JobQueue.register(JobType.DELETE_USER, delete_user_job)
+    JobQueue.register(JobType.CREATE_ZIP, create_zip_job)
+    JobQueue.register(JobType.COMPACT_HISTORY, compact_history_job)
@@ -1,10 +1,22 @@
 from fastapi import FastAPI
-from tortoise.contrib.fastapi import register_tortoise
+from tortoise import Tortoise
 
 from .config import get_settings
-from .database import models
+from .database import crud, models
+from .database.upgrade import add_missing_columns
+from .helpers.archive_cache import ArchiveCache
+from .helpers.auth import setup_default_admin
 from .helpers.constants import CURRENT_VERSION, STATIC
-from .router import admin, auth, file, folder, html, other, users, websocket
+from .helpers.encoding import EncodedCache
+from .helpers.executors import Executors
+from .helpers.history import HistoryBuffer, HistoryCompactor
+from .helpers.indexer import IndexReconciler
+from .helpers.jobs import JobQueue
+from .helpers.search import SearchIndex
+from .helpers.upload import UploadSessionSweeper
+from .jobs import register_jobs
+from .router import (admin, auth, file, folder, html, jobs, other, search,
+                     users, websocket)
 
 tags_metadata = (
     {
@@ -27,6 +39,14 @@ tags_metadata = (
         "name": "files",
         "description": "operations with files"
     },
+    {
+        "name": "search",
+        "description": "operations for finding files & directories"
+    },
+    {
+        "name": "jobs",
+        "description": "operations with background jobs"
+    },
     {
         "name": "admin",
         "description": "operations for admins"
@@ -52,6 +72,8 @@ app.include_router(websocket.router, prefix="/api", tags=["websocket"])
 app.include_router(users.router, prefix="/api/users", tags=["users"])
 app.include_router(folder.router, prefix="/api/directory", tags=["directories"])
 app.include_router(file.router, prefix="/api/file", tags=["files"])
+app.include_router(search.router, prefix="/api/search", tags=["search"])
+app.include_router(jobs.router, prefix="/api/jobs", tags=["jobs"])
 app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
 
@@ -60,11 +82,43 @@ async def do_startup():
     # create data directories
     get_settings().SHARED_PATH.mkdir(parents=True, exist_ok=True)
     get_settings().HOMES_PATH.mkdir(parents=True, exist_ok=True)
+    get_settings().JOB_RESULTS_PATH.mkdir(parents=True, exist_ok=True)
+    if ArchiveCache.is_enabled():
+        ArchiveCache.load()
+    if EncodedCache.is_enabled():
+        EncodedCache.load()
 
     # database setup
-    register_tortoise(
-        app,
+    await Tortoise.init(
         db_url=get_settings().DB_URI,
         modules={"models": [models]},
-        generate_schemas=True,
-        )
+    )
+    await add_missing_columns()
+    await Tortoise.generate_schemas()
+    await crud.backfill_fake_path_keys()
+    await SearchIndex.setup()
+    await setup_default_admin()
+
+    HistoryBuffer.start()
+    await IndexReconciler.load()
+    IndexReconciler.start()
+
+    register_jobs()
+    await JobQueue.start()
+    HistoryCompactor.start()
+    UploadSessionSweeper.start()
+
+
+@app.on_event("shutdown")
+async def do_shutdown():
+    await HistoryCompactor.stop()
+    await UploadSessionSweeper.stop()
+    # written first, cancelling a task as it starts a transaction
+    # can leave the database connection locked
+    await HistoryBuffer.flush()
+    await IndexReconciler.stop()
+    await JobQueue.stop()
+    # changes made by the stopped tasks
+    await HistoryBuffer.stop()
+    await Tortoise.close_connections()
+    Executors.shutdown()
@@ -1,5 +1,5 @@
 import os
-import shutil
+from pathlib import Path
 from typing import List
 from uuid import UUID
 
@@ -8,10 +8,15 @@ from tortoise.exceptions import DoesNotExist
 
 from ..config import get_settings
 from ..database import crud, models, schema
+from ..database.cache import UserCache
 from ..helpers.auth import get_current_admin_user
-from ..helpers.paths import (calculate_directory_file_count,
-                             calculate_directory_size)
-from ..helpers.schema import DirectoryStats, RootStats
+from ..helpers.constants import JobType
+from ..helpers.executors import Executors
+from ..helpers.indexer import move_index_path, remove_index_path
+from ..helpers.jobs import JobQueue
+from ..helpers.listing_cache import DirectoryListingCache
+from ..helpers.paths import move_to_trash
+from ..helpers.schema import DirectoryStats, ExecutorStats, RootStats
 
 router = APIRouter()
 
@@ -19,24 +24,56 @@ router = APIRouter()
 @router.get(
     "/stats/roots",
     response_model=RootStats,
-    description="get the directory root stats")
+    description="get the directory root stats, from the storage usage totals")
 async def root_stats(curr_user: models.User = Depends(get_current_admin_user)):
-    share_path = get_settings().SHARED_PATH
-    home_path = get_settings().HOMES_PATH
+    shared = await crud.get_storage_usage(get_settings().SHARED_PATH.name)
+    homes = await crud.get_storage_usage(get_settings().HOMES_PATH.name)
     return RootStats(
         shared=DirectoryStats(
-            path=share_path.name,
-            bytes_size=calculate_directory_size(share_path),
-            file_count=calculate_directory_file_count(share_path),
+            path=shared.key,
+            bytes_size=shared.bytes,
+            file_count=shared.files,
         ),
         homes=DirectoryStats(
-            path=home_path.name,
-            bytes_size=calculate_directory_size(home_path),
-            file_count=calculate_directory_file_count(home_path),
+            path=homes.key,
+            bytes_size=homes.bytes,
+            file_count=homes.files,
         ),
     )
 
 
+@router.get(
+    "/stats/homes",
+    response_model=List[DirectoryStats],
+    description="get the stats for each users home")
+async def home_stats(curr_user: models.User = Depends(get_current_admin_user)):
+    return [
+        DirectoryStats(
+            path=usage.key,
+            bytes_size=usage.bytes,
+            file_count=usage.files,
+        )
+        for usage in await crud.get_storage_usages_below(get_settings().HOMES_PATH.name)
+    ]
+
+
+@router.get(
+    "/stats/executor",
+    response_model=ExecutorStats,
+    description="get the filesystem thread pool usage, for sizing the pool")
+async def executor_stats(curr_user: models.User = Depends(get_current_admin_user)):
+    return Executors.fs_stats()
+
+
+@router.post(
+    "/history/compact",
+    response_model=schema.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+    description="roll up & remove old history now, in a background job")
+async def compact_history(curr_user: models.User = Depends(get_current_admin_user)):
+    return await JobQueue.submit(curr_user, JobType.COMPACT_HISTORY, {})
+
+
 @router.get(
     "/users",
     response_model=List[schema.User],
@@ -58,10 +95,16 @@ async def modify_user(
             user = await crud.get_user_by_uuid(user_uuid)
             if not user: raise DoesNotExist()
 
-            os.rename(
+            await Executors.run_fs(
+                os.rename,
                 get_settings().HOMES_PATH.joinpath(user.username),
                 get_settings().HOMES_PATH.joinpath(modifications.username)
             )
+            DirectoryListingCache.invalidate(get_settings().HOMES_PATH.joinpath(user.username))
+            await move_index_path(
+                Path(get_settings().HOMES_PATH.name, user.username).as_posix(),
+                Path(get_settings().HOMES_PATH.name, modifications.username).as_posix(),
+            )
 
         modifications = modifications.dict(exclude_unset=True)
         await crud.update_user_by_uuid(user_uuid, modifications)
@@ -70,18 +113,40 @@ async def modify_user(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="user with that UUID does not exist"
         )
+    finally:
+        # the home may have moved, even if the update failed
+        UserCache.invalidate(user_uuid)
 
 
 @router.delete(
     "/users/{user_uuid}",
-    description="delete a user")
+    response_model=schema.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+    description="delete a user, their home is deleted in a background job")
 async def delete_user(
     user_uuid: UUID,
     curr_user: models.User = Depends(get_current_admin_user)):
     try:
         username = (await crud.get_user_by_uuid(user_uuid)).username
         await crud.delete_user_by_uuid(user_uuid)
-        shutil.rmtree(get_settings().HOMES_PATH.joinpath(username))
+        UserCache.invalidate(user_uuid)
+        # moved aside now, so the job can't remove the home
+        # of a new user that is given the same username
+        home_path = get_settings().HOMES_PATH.joinpath(username)
+        try:
+            trash_path = await Executors.run_fs(move_to_trash, home_path)
+        except FileNotFoundError:
+            trash_path = None
+        DirectoryListingCache.invalidate(home_path)
+        await remove_index_path(Path(get_settings().HOMES_PATH.name, username).as_posix())
+        payload = {"username": username}
+        if trash_path is not None:
+            payload["trash"] = trash_path.name
+        return await JobQueue.submit(
+            curr_user,
+            JobType.DELETE_USER,
+            payload,
+        )
 
     except DoesNotExist:
         raise HTTPException(
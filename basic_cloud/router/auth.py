@@ -4,26 +4,14 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 
 from ..config import get_settings
-from ..database import crud, schema
-from ..helpers.auth import (authenticate_user, create_access_token,
-                            get_password_hash)
-from ..helpers.paths import create_user_home_dir
+from ..database import schema
+from ..helpers.auth import authenticate_user, create_access_token
 
 router = APIRouter()
 
 
 @router.post("/token", response_model=schema.Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-
-    # create default admin user
-    admin_uname = get_settings().DEFAULT_ADMIN_UNAME
-    if form_data.username == admin_uname:
-        await crud.create_default_admin(
-            admin_uname,
-            get_password_hash(admin_uname)
-        )
-        create_user_home_dir(admin_uname, get_settings().HOMES_PATH)
-
     user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
@@ -1,12 +1,12 @@
 import base64
 import binascii
+import os
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 from uuid import UUID
 
-import aiofiles
-from fastapi import (APIRouter, Body, Depends, Form, HTTPException, UploadFile,
-                     status)
+from fastapi import (APIRouter, Body, Depends, Form, HTTPException, Query,
+                     Request, Response, UploadFile, status)
 from fastapi.param_functions import File, Form
 from fastapi.responses import FileResponse
 from tortoise import timezone
@@ -16,8 +16,18 @@ from ..config import get_settings
 from ..database import crud, models, schema
 from ..helpers.auth import get_current_active_user
 from ..helpers.constants import ContentChangeTypes
-from ..helpers.exceptions import PathNotExists, SharePathInvalid
+from ..helpers.exceptions import (PathNotExists, QuotaExceeded,
+                                  SharePathInvalid, UploadRangeInvalid)
+from ..helpers.executors import Executors
+from ..helpers.history import (HistoryParams, get_history_page,
+                               get_history_params)
 from ..helpers.paths import create_root_path
+from ..helpers.quota import QuotaTracker, get_session_expiry_cutoff
+from ..helpers.responses import download_file_response, is_download_start
+from ..helpers.upload import (create_session_file, get_part_count,
+                              get_part_range, get_session_temp_path,
+                              is_upload_complete, merge_ranges,
+                              stream_upload_file, write_stream_at)
 from ..shared import content_changed
 
 router = APIRouter()
@@ -37,18 +47,18 @@ async def delete_file(
             get_settings().SHARED_PATH,
             curr_user.username,
         )
-        if not full_path.exists():
+        if not await Executors.run_fs(full_path.exists):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="directory/file must exist",
             )
-        if not full_path.is_file():
+        if not await Executors.run_fs(full_path.is_file):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="path must be a file",
             )
 
-        full_path.unlink(missing_ok=True)
+        await Executors.run_fs(full_path.unlink, missing_ok=True)
 
         await content_changed(
             file_path,
@@ -70,6 +80,7 @@ async def delete_file(
     description="download a file")
 async def download_file(
         file_path: str,
+        request: Request,
         curr_user: models.User = Depends(get_current_active_user)):
     file_path = base64.b64decode(file_path).decode()
     file_path = Path(file_path)
@@ -87,30 +98,34 @@ async def download_file(
             detail="unknown root directory",
         )
 
-    if not full_path.exists():
+    if not await Executors.run_fs(full_path.exists):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="directory/file must exist",
         )
 
-    if not full_path.is_file():
+    if not await Executors.run_fs(full_path.is_file):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="cannot be a directory",
         )
 
-    await content_changed(
-        file_path,
-        ContentChangeTypes.DOWNLOAD,
-        False,
-        curr_user
-    )
+    response = await Executors.run_fs(download_file_response, request, full_path, file_path)
+
+    if is_download_start(response):
+        await content_changed(
+            file_path,
+            ContentChangeTypes.DOWNLOAD,
+            False,
+            curr_user
+        )
 
-    return FileResponse(full_path, filename=file_path.name)
+    return response
 
 
 @router.post("/upload/overwrite")
 async def upload_file_overwrite(
+        request: Request,
         file: UploadFile = File(...),
         directory: Path = Form(...),
         curr_user: models.User = Depends(get_current_active_user)):
@@ -128,13 +143,13 @@ async def upload_file_overwrite(
             detail="unknown root directory",
         )
 
-    if not root_path.exists():
+    if not await Executors.run_fs(root_path.exists):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="directory/file must exist",
         )
 
-    if not root_path.is_dir():
+    if not await Executors.run_fs(root_path.is_dir):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="cannot be a directory",
@@ -142,19 +157,306 @@ async def upload_file_overwrite(
 
     root_path = root_path.joinpath(file.filename)
 
-    # write the file to system
-    async with aiofiles.open(root_path, "wb") as fo:
-        await fo.write(await file.read())
-        await file.close()
+    quota = await QuotaTracker.get_upload_quota(
+        directory.joinpath(file.filename),
+        root_path,
+        curr_user,
+    )
+    try:
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            # turn away uploads that are too big before writing anything,
+            # the body includes the form fields so is slightly over the file size
+            quota.check(int(content_length))
+        # write the file to system, stopping as soon as the quota is exceeded
+        await stream_upload_file(
+            file,
+            root_path,
+            get_settings().UPLOAD_CHUNK_SIZE,
+            quota,
+        )
+
+        await content_changed(
+            directory.joinpath(file.filename),
+            ContentChangeTypes.CREATION,
+            False,
+            curr_user
+        )
+    except QuotaExceeded as err:
+        raise HTTPException(
+            status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+            detail=str(err),
+        ) from None
+    finally:
+        # usage totals now include the file
+        quota.release()
+
+    return {"path": directory.joinpath(file.filename)}
+
+
+async def get_upload_session_or_404(
+        session_uuid: UUID,
+        curr_user: models.User) -> models.UploadSession:
+    try:
+        upload_session = await crud.get_upload_session_by_uuid(session_uuid, curr_user)
+    except DoesNotExist:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="unknown upload session uuid"
+        ) from None
+    expiry_cutoff = get_session_expiry_cutoff()
+    if expiry_cutoff is not None and upload_session.updated_at < expiry_cutoff:
+        # its space is no longer reserved in the quota,
+        # so it can't be allowed to finish
+        temp_path = get_upload_session_temp_path(upload_session, curr_user)
+        await Executors.run_fs(temp_path.unlink, missing_ok=True)
+        await crud.delete_upload_session(session_uuid)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="upload session has expired"
+        )
+    return upload_session
+
+
+def get_upload_session_temp_path(
+        upload_session: models.UploadSession,
+        curr_user: models.User) -> Path:
+    try:
+        full_path = create_root_path(
+            upload_session.path,
+            get_settings().HOMES_PATH,
+            get_settings().SHARED_PATH,
+            curr_user.username,
+        )
+    except PathNotExists:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="unknown upload session uuid"
+        ) from None
+    return get_session_temp_path(full_path, upload_session.uuid)
+
+
+async def get_upload_session_received(
+        upload_session: models.UploadSession) -> List[Tuple[int, int]]:
+    chunks = await crud.get_upload_chunks(upload_session)
+    return merge_ranges(
+        (chunk.offset, chunk.offset + chunk.length) for chunk in chunks
+    )
+
+
+async def get_upload_session_schema(
+        upload_session: models.UploadSession) -> schema.UploadSession:
+    part_count = None
+    if upload_session.part_size:
+        part_count = get_part_count(
+            upload_session.total_size,
+            upload_session.part_size,
+        )
+    received = await get_upload_session_received(upload_session)
+    return schema.UploadSession(
+        uuid=upload_session.uuid,
+        path=upload_session.path,
+        total_size=upload_session.total_size,
+        part_size=upload_session.part_size,
+        part_count=part_count,
+        received=[
+            schema.ByteRange(start=start, end=end) for start, end in received
+        ],
+    )
+
+
+async def write_upload_session_range(
+        upload_session: models.UploadSession,
+        temp_path: Path,
+        request: Request,
+        offset: int,
+        end: int):
+    try:
+        written = await write_stream_at(request.stream(), temp_path, offset, end)
+    except UploadRangeInvalid as err:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail=str(err),
+        ) from None
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="unknown upload session uuid"
+        ) from None
+
+    if written:
+        await crud.create_upload_chunk(upload_session, offset, written)
+
+
+@router.post(
+    "/upload/session",
+    response_model=schema.UploadSession,
+    description="start a resumable upload")
+async def create_upload_session(
+        upload_session: schema.UploadSessionCreate,
+        curr_user: models.User = Depends(get_current_active_user)):
+    filename = Path(upload_session.filename)
+    if filename.name != upload_session.filename or filename.name in ("", ".", ".."):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="invalid filename",
+        )
+    try:
+        root_path = create_root_path(
+            upload_session.directory,
+            get_settings().HOMES_PATH,
+            get_settings().SHARED_PATH,
+            curr_user.username,
+        )
+    except PathNotExists:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="unknown root directory",
+        ) from None
+
+    if not await Executors.run_fs(root_path.is_dir):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="directory must exist",
+        )
+
+    file_path = upload_session.directory.joinpath(filename)
+    quota = await QuotaTracker.get_upload_quota(
+        file_path,
+        root_path.joinpath(filename),
+        curr_user,
+    )
+    try:
+        # the whole size is reserved upfront as the file is allocated now
+        quota.add(upload_session.total_size)
+        created_row = await crud.create_upload_session(
+            curr_user,
+            file_path,
+            upload_session.total_size,
+            upload_session.part_size,
+        )
+    except QuotaExceeded as err:
+        raise HTTPException(
+            status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+            detail=str(err),
+        ) from None
+    finally:
+        # the upload session now holds the reservation
+        quota.release()
+    await Executors.run_fs(
+        create_session_file,
+        get_session_temp_path(root_path.joinpath(filename), created_row.uuid),
+        created_row.total_size,
+    )
+    return await get_upload_session_schema(created_row)
+
+
+@router.get(
+    "/upload/session/{session_uuid}",
+    response_model=schema.UploadSession,
+    description="get which ranges of a resumable upload have been received")
+async def get_upload_session(
+        session_uuid: UUID,
+        curr_user: models.User = Depends(get_current_active_user)):
+    upload_session = await get_upload_session_or_404(session_uuid, curr_user)
+    return await get_upload_session_schema(upload_session)
+
+
+@router.put(
+    "/upload/session/{session_uuid}",
+    response_model=schema.UploadSession,
+    description="upload a chunk of a resumable upload, the raw body is written at the offset")
+async def upload_session_chunk(
+        session_uuid: UUID,
+        request: Request,
+        offset: int = Query(..., ge=0),
+        curr_user: models.User = Depends(get_current_active_user)):
+    upload_session = await get_upload_session_or_404(session_uuid, curr_user)
+    temp_path = get_upload_session_temp_path(upload_session, curr_user)
+    await write_upload_session_range(
+        upload_session,
+        temp_path,
+        request,
+        offset,
+        upload_session.total_size,
+    )
+    return await get_upload_session_schema(upload_session)
+
+
+@router.put(
+    "/upload/session/{session_uuid}/part/{part_number}",
+    response_model=schema.UploadSession,
+    description="upload a numbered part of a resumable upload, parts can be sent in parallel")
+async def upload_session_part(
+        session_uuid: UUID,
+        part_number: int,
+        request: Request,
+        curr_user: models.User = Depends(get_current_active_user)):
+    upload_session = await get_upload_session_or_404(session_uuid, curr_user)
+    if not upload_session.part_size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="upload session was not created with a part size",
+        )
+    try:
+        start, end = get_part_range(
+            part_number,
+            upload_session.total_size,
+            upload_session.part_size,
+        )
+    except UploadRangeInvalid as err:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail=str(err),
+        ) from None
+
+    temp_path = get_upload_session_temp_path(upload_session, curr_user)
+    await write_upload_session_range(upload_session, temp_path, request, start, end)
+    return await get_upload_session_schema(upload_session)
+
+
+@router.post(
+    "/upload/session/{session_uuid}/finalize",
+    description="finish a resumable upload, moving the file into place")
+async def finalize_upload_session(
+        session_uuid: UUID,
+        curr_user: models.User = Depends(get_current_active_user)):
+    upload_session = await get_upload_session_or_404(session_uuid, curr_user)
+    temp_path = get_upload_session_temp_path(upload_session, curr_user)
+
+    received = await get_upload_session_received(upload_session)
+    if not is_upload_complete(received, upload_session.total_size):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="upload is incomplete",
+        )
+
+    # the chunks were written in place, so just move the file
+    full_path = temp_path.with_name(upload_session.path.name)
+    await Executors.run_fs(os.replace, temp_path, full_path)
 
     await content_changed(
-        directory.joinpath(file.filename),
+        upload_session.path,
         ContentChangeTypes.CREATION,
         False,
         curr_user
     )
+    # removed after the usage totals include the file, keeping it reserved
+    await crud.delete_upload_session(session_uuid)
 
-    return {"path": directory.joinpath(file.filename)}
+    return {"path": upload_session.path}
+
+
+@router.delete(
+    "/upload/session/{session_uuid}",
+    description="cancel a resumable upload")
+async def delete_upload_session(
+        session_uuid: UUID,
+        curr_user: models.User = Depends(get_current_active_user)):
+    upload_session = await get_upload_session_or_404(session_uuid, curr_user)
+    temp_path = get_upload_session_temp_path(upload_session, curr_user)
+    await Executors.run_fs(temp_path.unlink, missing_ok=True)
+    await crud.delete_upload_session(session_uuid)
 
 
 @router.get(
@@ -163,6 +465,8 @@ async def upload_file_overwrite(
     description="get history for file")
 async def get_history_by_file(
         file_path: str,
+        response: Response,
+        history_params: HistoryParams = Depends(get_history_params),
         curr_user: models.User = Depends(get_current_active_user)):
     try:
         file_path = base64.b64decode(file_path).decode()
@@ -174,18 +478,18 @@ async def get_history_by_file(
             get_settings().SHARED_PATH,
             curr_user.username,
         )
-        if not full_path.exists():
+        if not await Executors.run_fs(full_path.exists):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="directory/file must exist",
             )
 
-        if not full_path.is_file():
+        if not await Executors.run_fs(full_path.is_file):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="cannot be a directory",
             )
-        return await crud.get_content_changes_by_path(file_path)
+        return await get_history_page(file_path, history_params, response)
 
     except PathNotExists:
         raise HTTPException(
@@ -217,13 +521,13 @@ async def get_shares_by_file(
             get_settings().SHARED_PATH,
             curr_user.username,
         )
-        if not full_path.exists():
+        if not await Executors.run_fs(full_path.exists):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="directory/file must exist",
             )
 
-        if not full_path.is_file():
+        if not await Executors.run_fs(full_path.is_file):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="cannot be a directory",
@@ -257,13 +561,13 @@ async def create_file_share(
             get_settings().SHARED_PATH,
             curr_user.username,
         )
-        if not root_path.exists():
+        if not await Executors.run_fs(root_path.exists):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="file must exist",
             )
 
-        if not root_path.is_file():
+        if not await Executors.run_fs(root_path.is_file):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="cannot be a directory",
@@ -345,7 +649,7 @@ async def get_file_share_meta(
     "/share/{share_uuid}/download",
     response_class=FileResponse,
     description="get a file shares file")
-async def get_file_share_file(share_uuid: UUID):
+async def get_file_share_file(share_uuid: UUID, request: Request):
     try:
         file_share = await crud.get_file_share_by_uuid(share_uuid)
         fake_path = (await file_share.fake_path.get()).path
@@ -360,17 +664,19 @@ async def get_file_share_file(share_uuid: UUID):
             get_settings().HOMES_PATH,
             get_settings().SHARED_PATH,
         )
-        if not full_path.exists():
+        if not await Executors.run_fs(full_path.exists):
             # remove the share from database as path no longer exists
             await crud.delete_file_share(share_uuid)
             raise PathNotExists()
 
-        if file_share.uses_left is not None:
+        response = await Executors.run_fs(download_file_response, request, full_path, fake_path)
+
+        if file_share.uses_left is not None and is_download_start(response):
             # if the share has limited uses subtract one
             file_share.uses_left -= 1
             await file_share.save()
 
-        return FileResponse(full_path, filename=full_path.name)
+        return response
     except (PathNotExists, DoesNotExist):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -1,36 +1,187 @@
 import base64
 import binascii
-import shutil
+import hashlib
+import os
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
-from fastapi import APIRouter, Body, Depends, HTTPException, status
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi import (APIRouter, Body, Depends, HTTPException, Query, Request,
+                     status)
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
 from ..config import get_settings
-from ..database import crud, models, schema
+from ..database import models, schema
+from ..helpers.archive_cache import ArchiveCache, iter_open_file
 from ..helpers.auth import get_current_active_user
-from ..helpers.constants import ContentChangeTypes
-from ..helpers.exceptions import PathNotExists
+from ..helpers.constants import (ContentChangeTypes, DirectoryContentSort,
+                                 JobType)
+from ..helpers.exceptions import CursorInvalid, PathNotExists
+from ..helpers.executors import Executors
+from ..helpers.history import (HistoryParams, get_history_page,
+                               get_history_params)
+from ..helpers.jobs import JobQueue
+from ..helpers.listing_cache import CachedListing, DirectoryListingCache
 from ..helpers.paths import (create_root_path, create_zip, is_root_path,
-                             relative_dir_contents)
-from ..helpers.schema import PathContent, Roots
+                             iter_batch_zip_paths, iter_tree_ndjson,
+                             iter_zip_paths, move_to_trash,
+                             paginate_dir_contents)
+from ..helpers.responses import is_not_modified
+from ..helpers.schema import BatchDownload, PathContent, Roots
 from ..shared import content_changed
 
 router = APIRouter()
 
 
+async def get_directory_listing(
+        directory: Path,
+        curr_user: models.User) -> CachedListing:
+    try:
+        root_path = create_root_path(
+            directory,
+            get_settings().HOMES_PATH,
+            get_settings().SHARED_PATH,
+            curr_user.username,
+        )
+    except PathNotExists:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="unknown root directory",
+        ) from None
+
+    if not await Executors.run_fs(root_path.exists):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="directory must exist",
+        )
+    if not await Executors.run_fs(root_path.is_dir):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="path must be a directory",
+        )
+
+    return await Executors.run_fs(DirectoryListingCache.get_listing, root_path)
+
+
+def get_contents_page_etag(
+        listing: CachedListing,
+        sort: DirectoryContentSort,
+        descending: bool,
+        limit: Optional[int],
+        cursor: Optional[str]) -> str:
+    page_hash = hashlib.sha256(
+        f"{sort.value}:{descending}:{limit}:{cursor}".encode()).hexdigest()[:16]
+    return f'"{listing.etag}-{page_hash}"'
+
+
+async def get_directory_contents_page(
+        listing: CachedListing,
+        sort: DirectoryContentSort,
+        descending: bool,
+        limit: Optional[int],
+        cursor: Optional[str]) -> Tuple[List[PathContent], Optional[str]]:
+    keys, sorted_contents = await Executors.run_fs(listing.get_sorted, sort)
+    try:
+        return paginate_dir_contents(
+            keys,
+            sorted_contents,
+            sort,
+            descending,
+            limit,
+            cursor,
+        )
+    except CursorInvalid as err:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(err),
+        ) from None
+
+
 @router.post(
     "/contents",
     response_model=List[PathContent],
     description="get a specific directory content")
 async def get_directory_contents(
+        response: Response,
         directory: Path = Body(..., embed=True),
+        sort: DirectoryContentSort = Body(DirectoryContentSort.NAME, embed=True),
+        descending: bool = Body(False, embed=True),
+        limit: Optional[int] = Body(None, embed=True, ge=1),
+        cursor: Optional[str] = Body(None, embed=True),
+        curr_user: models.User = Depends(get_current_active_user)):
+    listing = await get_directory_listing(directory, curr_user)
+    contents, next_cursor = await get_directory_contents_page(
+        listing, sort, descending, limit, cursor)
+    response.headers["ETag"] = get_contents_page_etag(
+        listing, sort, descending, limit, cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return contents
+
+
+@router.get(
+    "/contents/{directory}",
+    response_model=List[PathContent],
+    description=(
+        "get a specific directory content, directory must be encoded as base64. "
+        "supports If-None-Match to skip unchanged directories. "
+        "the etag follows the directory mtime, so a file changed in place "
+        "outside of the app (e.g. only its size or mtime) is not noticed "
+        "until the directory itself changes"
+    ))
+async def get_directory_contents_conditional(
+        directory: str,
+        request: Request,
+        response: Response,
+        sort: DirectoryContentSort = DirectoryContentSort.NAME,
+        descending: bool = False,
+        limit: Optional[int] = Query(None, ge=1),
+        cursor: Optional[str] = None,
         curr_user: models.User = Depends(get_current_active_user)):
-    root_path = directory
     try:
-        root_path = create_root_path(
-            root_path,
+        directory = Path(base64.b64decode(directory).decode())
+    except (ValueError, binascii.Error):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="malformed base64 directory"
+        ) from None
+
+    listing = await get_directory_listing(directory, curr_user)
+    etag = get_contents_page_etag(listing, sort, descending, limit, cursor)
+    # checked before the page is built, the client already has it
+    if is_not_modified(request, etag, listing.mtime_ns / 1e9):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    contents, next_cursor = await get_directory_contents_page(
+        listing, sort, descending, limit, cursor)
+    response.headers["ETag"] = etag
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return contents
+
+
+@router.get(
+    "/tree/{directory}",
+    response_class=StreamingResponse,
+    description=(
+        "get every file & directory below a directory as newline delimited json, "
+        "directory must be encoded as base64"
+    ))
+async def get_directory_tree(
+        directory: str,
+        depth: Optional[int] = Query(None, ge=0),
+        curr_user: models.User = Depends(get_current_active_user)):
+    try:
+        directory = Path(base64.b64decode(directory).decode())
+    except (ValueError, binascii.Error):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="malformed base64 directory"
+        ) from None
+
+    try:
+        full_path = create_root_path(
+            directory,
             get_settings().HOMES_PATH,
             get_settings().SHARED_PATH,
             curr_user.username,
@@ -39,28 +190,50 @@ async def get_directory_contents(
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="unknown root directory",
-        )
+        ) from None
 
-    if not root_path.exists():
+    if not await Executors.run_fs(full_path.exists):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="directory must exist",
         )
-    if not root_path.is_dir():
+    if not await Executors.run_fs(full_path.is_dir):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="path must be a directory",
         )
-    return relative_dir_contents(root_path)
+
+    # chunks are only generated as the client reads them
+    return StreamingResponse(
+        iter_tree_ndjson(
+            full_path,
+            depth,
+            get_settings().DOWNLOAD_CHUNK_SIZE,
+        ),
+        media_type="application/x-ndjson",
+    )
 
 
 @router.get(
     "/{folder_path}/history",
     response_model=List[schema.ContentChange],
-    description="get history for folder")
+    description=(
+        "get history for folder, "
+        "recursive includes everything below the folder. "
+        "recursive needs since or until, as every matching change "
+        "is sorted before a page is taken"
+    ))
 async def get_history_by_folder(
         folder_path: str,
+        response: Response,
+        recursive: bool = False,
+        history_params: HistoryParams = Depends(get_history_params),
         curr_user: models.User = Depends(get_current_active_user)):
+    if recursive and history_params.since is None and history_params.until is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="recursive history needs since or until",
+        )
     try:
         folder_path = base64.b64decode(folder_path).decode()
         folder_path = Path(folder_path)
@@ -71,18 +244,18 @@ async def get_history_by_folder(
             get_settings().SHARED_PATH,
             curr_user.username,
         )
-        if not full_path.exists():
+        if not await Executors.run_fs(full_path.exists):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="directory must exist",
             )
 
-        if not full_path.is_dir():
+        if not await Executors.run_fs(full_path.is_dir):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="cannot be a file",
             )
-        return await crud.get_content_changes_by_path(folder_path)
+        return await get_history_page(folder_path, history_params, response, recursive)
 
     except PathNotExists:
         raise HTTPException(
@@ -133,7 +306,7 @@ async def create_directory(
             detail="unknown root directory",
         )
 
-    full_path.mkdir(parents=True, exist_ok=True)
+    await Executors.run_fs(full_path.mkdir, parents=True, exist_ok=True)
 
     await content_changed(
         directory,
@@ -146,7 +319,9 @@ async def create_directory(
 
 @router.delete(
     "/rm",
-    description="delete a directory")
+    response_model=schema.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+    description="delete a directory, deleted in a background job")
 async def delete_directory(
         directory: Path = Body(..., embed=True),
         curr_user: models.User = Depends(get_current_active_user)):
@@ -167,24 +342,39 @@ async def delete_directory(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="cannot delete root directory",
             )
-        if not full_path.exists():
+        if not await Executors.run_fs(full_path.exists):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="directory must exist",
             )
-        if not full_path.is_dir():
+        if not await Executors.run_fs(full_path.is_dir):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="path must be a directory",
             )
-
-        shutil.rmtree(full_path)
-
+        # moved aside now, so the job can't remove anything
+        # created at the same path before it gets to run
+        try:
+            trash_path = await Executors.run_fs(move_to_trash, full_path)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="directory must exist",
+            )
         await content_changed(
             directory,
             ContentChangeTypes.DELETION,
             True,
-            curr_user
+            curr_user,
+        )
+
+        return await JobQueue.submit(
+            curr_user,
+            JobType.DELETE_DIRECTORY,
+            {
+                "path": directory.as_posix(),
+                "trash": directory.with_name(trash_path.name).as_posix(),
+            },
         )
 
     except PathNotExists:
@@ -200,6 +390,7 @@ async def delete_directory(
     description="download as a zip, directory must be encoded as base64")
 async def download_zip(
         directory: str,
+        compression_level: Optional[int] = Query(None, ge=0, le=9),
         curr_user: models.User = Depends(get_current_active_user)):
     directory = base64.b64decode(directory).decode()
     directory = Path(directory)
@@ -217,23 +408,155 @@ async def download_zip(
             detail="unknown root directory",
         )
 
-    if not full_path.exists():
+    if not await Executors.run_fs(full_path.exists):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="directory must exist",
         )
-    if not full_path.is_dir():
+    if not await Executors.run_fs(full_path.is_dir):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="path must be a directory",
         )
 
-    zip_obj = create_zip(full_path)
-
-    await content_changed(
+    # only log the download once the zip has been sent
+    log_download = BackgroundTask(
+        content_changed,
         directory,
         ContentChangeTypes.DOWNLOAD,
         True,
-        curr_user
+        curr_user,
+    )
+    chunks = create_zip(
+        iter_zip_paths(full_path),
+        get_settings().DOWNLOAD_CHUNK_SIZE,
+        compression_level,
+    )
+
+    if ArchiveCache.is_enabled():
+        cache_key = await Executors.run_fs(
+            ArchiveCache.get_key,
+            full_path,
+            directory,
+            compression_level,
+        )
+        cached_file = await Executors.run_fs(ArchiveCache.open, cache_key)
+        if cached_file is not None:
+            chunks.close()
+            # sent from the open file, it may be removed from the cache meanwhile
+            return StreamingResponse(
+                iter_open_file(cached_file, get_settings().DOWNLOAD_CHUNK_SIZE),
+                media_type="application/zip",
+                headers={"content-length": str(os.fstat(cached_file.fileno()).st_size)},
+                background=log_download,
+            )
+        chunks = ArchiveCache.store(cache_key, directory, chunks)
+
+    return StreamingResponse(
+        chunks,
+        media_type="application/zip",
+        background=log_download,
+    )
+
+
+@router.post(
+    "/zip",
+    response_model=schema.Job,
+    status_code=status.HTTP_202_ACCEPTED,
+    description=(
+        "zip a directory in a background job, "
+        "the zip can be downloaded once the job has finished"
+    ))
+async def create_zip_job(
+        directory: Path = Body(..., embed=True),
+        compression_level: Optional[int] = Body(None, embed=True, ge=0, le=9),
+        curr_user: models.User = Depends(get_current_active_user)):
+    try:
+        full_path = create_root_path(
+            directory,
+            get_settings().HOMES_PATH,
+            get_settings().SHARED_PATH,
+            curr_user.username,
+        )
+    except PathNotExists:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="unknown root directory",
+        ) from None
+
+    if not await Executors.run_fs(full_path.is_dir):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="directory must exist",
+        )
+
+    return await JobQueue.submit(
+        curr_user,
+        JobType.CREATE_ZIP,
+        {"path": directory.as_posix(), "compression_level": compression_level},
+    )
+
+
+@router.post(
+    "/download",
+    response_class=StreamingResponse,
+    description="download multiple files & directories as one zip")
+async def download_batch_zip(
+        batch: BatchDownload,
+        curr_user: models.User = Depends(get_current_active_user)):
+    # ignore paths that are inside another selected directory
+    paths = sorted(set(batch.paths), key=lambda path: path.parts)
+    paths = [
+        path for path in paths
+        if not any(other in path.parents for other in paths)
+    ]
+
+    full_paths = []
+    try:
+        for path in paths:
+            full_path = create_root_path(
+                path,
+                get_settings().HOMES_PATH,
+                get_settings().SHARED_PATH,
+                curr_user.username,
+            )
+            if not await Executors.run_fs(full_path.exists):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="directory/file must exist",
+                )
+            full_paths.append(full_path)
+    except PathNotExists:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="unknown root directory",
+        ) from None
+
+    try:
+        common_path = Path(os.path.commonpath(paths))
+    except ValueError:
+        common_path = Path()
+    if common_path == Path():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="paths must be in the same root directory",
+        )
+    is_dir = common_path not in paths or await Executors.run_fs(full_paths[0].is_dir)
+
+    return StreamingResponse(
+        create_zip(
+            iter_batch_zip_paths(full_paths),
+            get_settings().DOWNLOAD_CHUNK_SIZE,
+            batch.compression_level,
+        ),
+        media_type="application/zip",
+        # log the whole batch as one download, once the zip has been sent
+        background=BackgroundTask(
+            content_changed,
+            common_path,
+            ContentChangeTypes.DOWNLOAD,
+            is_dir,
+            curr_user,
+            {"paths": [str(path) for path in paths]},
+        ),
     )
-    return StreamingResponse(zip_obj, media_type="application/zip")
@@ -0,0 +1,97 @@
+from pathlib import Path
+from typing import List
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import FileResponse
+from tortoise.exceptions import DoesNotExist
+
+from ..database import crud, models, schema
+from ..helpers.auth import get_current_active_user
+from ..helpers.constants import ContentChangeTypes, JobStatus, JobType
+from ..helpers.executors import Executors
+from ..jobs import get_job_result_path
+from ..shared import content_changed
+
+router = APIRouter()
+
+
+async def get_job_or_404(job_uuid: UUID, curr_user: models.User) -> models.Job:
+    try:
+        job = await crud.get_job_by_uuid(job_uuid)
+    except DoesNotExist:
+        job = None
+    if job is None or (job.owner_id != curr_user.uuid and not curr_user.is_admin):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="unknown job uuid",
+        )
+    return job
+
+
+@router.get(
+    "",
+    response_model=List[schema.Job],
+    description="get the users background jobs, newest first")
+async def get_jobs(curr_user: models.User = Depends(get_current_active_user)):
+    return await crud.get_jobs_by_owner(curr_user)
+
+
+@router.get(
+    "/{job_uuid}",
+    response_model=schema.Job,
+    description="get the status & progress of a background job")
+async def get_job(
+        job_uuid: UUID,
+        curr_user: models.User = Depends(get_current_active_user)):
+    return await get_job_or_404(job_uuid, curr_user)
+
+
+@router.get(
+    "/{job_uuid}/download",
+    response_class=FileResponse,
+    description="download the zip made by a finished zip job")
+async def download_job_result(
+        job_uuid: UUID,
+        curr_user: models.User = Depends(get_current_active_user)):
+    job = await get_job_or_404(job_uuid, curr_user)
+    if job.job_type != JobType.CREATE_ZIP or job.status != JobStatus.DONE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="job has no finished zip",
+        )
+    result_path = get_job_result_path(job)
+    if not await Executors.run_fs(result_path.is_file):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="zip no longer exists",
+        )
+
+    directory = Path(job.result["path"])
+    await content_changed(
+        directory,
+        ContentChangeTypes.DOWNLOAD,
+        True,
+        curr_user
+    )
+    return FileResponse(
+        result_path,
+        media_type="application/zip",
+        filename=f"{directory.name}.zip",
+    )
+
+
+@router.delete(
+    "/{job_uuid}",
+    description="remove a finished background job & any file it made")
+async def delete_job(
+        job_uuid: UUID,
+        curr_user: models.User = Depends(get_current_active_user)):
+    job = await get_job_or_404(job_uuid, curr_user)
+    if job.status in (JobStatus.QUEUED, JobStatus.RUNNING):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="job has not finished",
+        )
+    await Executors.run_fs(get_job_result_path(job).unlink, missing_ok=True)
+    await crud.delete_job(job_uuid)
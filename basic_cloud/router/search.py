@@ -0,0 +1,49 @@
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+from ..config import get_settings
+from ..database import models
+from ..helpers.auth import get_current_active_user
+from ..helpers.constants import SearchMode
+from ..helpers.exceptions import PathNotExists
+from ..helpers.paths import create_root_path
+from ..helpers.schema import SearchResult
+from ..helpers.search import SearchIndex
+
+router = APIRouter()
+
+
+@router.get(
+    "",
+    response_model=List[SearchResult],
+    description="search for files & directories by name")
+async def search(
+        q: str = Query(..., min_length=1),
+        mode: SearchMode = SearchMode.SUBSTRING,
+        directory: Optional[Path] = None,
+        limit: int = Query(50, ge=1, le=500),
+        offset: int = Query(0, ge=0),
+        curr_user: models.User = Depends(get_current_active_user)):
+    if directory is not None:
+        try:
+            # makes sure user has access to path
+            create_root_path(
+                directory,
+                get_settings().HOMES_PATH,
+                get_settings().SHARED_PATH,
+                curr_user.username,
+            )
+        except PathNotExists:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="unknown root directory",
+            ) from None
+        scopes = [directory.as_posix()]
+    else:
+        scopes = [
+            get_settings().SHARED_PATH.name,
+            Path(get_settings().HOMES_PATH.name, curr_user.username).as_posix(),
+        ]
+    return await SearchIndex.search(q, mode, scopes, limit, offset)
@@ -1,11 +1,15 @@
+from pathlib import Path
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from tortoise.exceptions import IntegrityError
 
 from ..config import get_settings
 from ..database import crud, models, schema
 from ..helpers import auth
-from ..helpers.auth import get_password_hash
+from ..helpers.auth import hash_password
+from ..helpers.executors import Executors
 from ..helpers.paths import create_user_home_dir
+from ..helpers.quota import get_storage_quota
 
 router = APIRouter()
 
@@ -19,8 +23,8 @@ async def create_account(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="signups are disabled",
             )
-        pass_hash = get_password_hash(new_user.password)
-        create_user_home_dir(new_user.username, get_settings().HOMES_PATH)
+        pass_hash = await hash_password(new_user.password)
+        await Executors.run_fs(create_user_home_dir, new_user.username, get_settings().HOMES_PATH)
         return await crud.create_user(new_user.username, pass_hash)
     except IntegrityError:
         raise HTTPException(
@@ -29,6 +33,17 @@ async def create_account(
         ) from None
 
 
-@router.get("/me", response_model=schema.User)
+@router.get("/me", response_model=schema.UserMe)
 async def get_me(user: models.User = Depends(auth.get_current_user)):
-    return user
+    return schema.UserMe(
+        **{name: getattr(user, name) for name in schema.User.__fields__},
+        quota_bytes=user.quota_bytes,
+        home_storage=await get_storage_quota(
+            Path(get_settings().HOMES_PATH.name, user.username),
+            user,
+        ),
+        shared_storage=await get_storage_quota(
+            Path(get_settings().SHARED_PATH.name),
+            user,
+        ),
+    )
@@ -6,6 +6,7 @@ from fastapi import (APIRouter, HTTPException, WebSocket, WebSocketDisconnect,
 from ..helpers.auth import get_current_user
 from ..helpers.constants import WebsocketMessageTypeReceive
 from ..helpers.exceptions import PathNotExists
+from ..helpers.executors import Executors
 from ..helpers.websocket import WebsocketHandler, WebsocketMessage
 
 router = APIRouter()
@@ -18,7 +19,7 @@ async def watchdog_ws(
 
     try:
         curr_user = await get_current_user(bearer_token)
-        client_uuid = await WebsocketHandler.connect(websocket)
+        client_uuid = await WebsocketHandler.connect(websocket, user_uuid=curr_user.uuid)
         while True:
             try:
                 data = await websocket.receive_json()
@@ -34,7 +35,7 @@ async def watchdog_ws(
                             get_settings().SHARED_PATH,
                             curr_user.username,
                         )
-                        if not real_path.exists() and not real_path.is_dir():
+                        if not await Executors.run_fs(real_path.is_dir):
                             raise PathNotExists()
 
                         WebsocketHandler.move(client_uuid, message.payload.directory)
@@ -1,9 +1,16 @@
 from pathlib import Path
 
 from .config import get_settings
-from .database.crud import create_content_change
 from .database.models import User
+from .helpers.archive_cache import ArchiveCache
 from .helpers.constants import ContentChangeTypes
+from .helpers.encoding import invalidate_encoded
+from .helpers.exceptions import PathNotExists
+from .helpers.executors import Executors
+from .helpers.history import HistoryBuffer
+from .helpers.indexer import update_index
+from .helpers.listing_cache import DirectoryListingCache
+from .helpers.paths import create_root_path
 from .helpers.websocket import dispatch_content_change
 
 
@@ -11,14 +18,29 @@ async def content_changed(
         path: Path,
         change_type: ContentChangeTypes,
         is_dir: bool,
-        triggered_by: User):
+        triggered_by: User,
+        extra_meta: dict = None):
     # log change to database if enabled
     if get_settings().HISTORY_LOG:
-        await create_content_change(
+        await HistoryBuffer.log(
             path,
             change_type,
             is_dir,
             triggered_by,
+            extra_meta,
         )
+    if change_type not in (ContentChangeTypes.DOWNLOAD, ContentChangeTypes.SHARED):
+        # cached zips & compressed copies of the path are now out of date
+        await Executors.run_fs(ArchiveCache.invalidate, path)
+        await Executors.run_fs(invalidate_encoded, path)
+        try:
+            DirectoryListingCache.invalidate(create_root_path(
+                path,
+                get_settings().HOMES_PATH,
+                get_settings().SHARED_PATH,
+            ))
+        except PathNotExists:
+            pass
+        await update_index(path, change_type)
     # notify any listening websockets
     await dispatch_content_change(path, change_type)
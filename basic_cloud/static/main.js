@@ -114,7 +114,7 @@ async function handle_file_content_history(file_path) {
     try {
         const history = await BasicCloudApi.get_file_history(file_path);
         const history_table = helpers.create_history_container(history);
-        Popup.append_container("File History", "the complete file history", history_table);
+        Popup.append_container("File History", "the latest file history", history_table);
     }
     finally {
         loading_popup.remove();
@@ -129,7 +129,7 @@ async function handle_directory_content_history(directory) {
     try {
         const history = await BasicCloudApi.get_directory_history(directory);
         const history_table = helpers.create_history_container(history);
-        Popup.append_container("Directory History", "the complete directory history", history_table);
+        Popup.append_container("Directory History", "the latest directory history", history_table);
     }
     finally {
         loading_popup.remove();
@@ -120,11 +120,11 @@ export default class BasicCloudApi {
     /**
      * get the folder's history
      * @param {string} directory - the directory
-     * @returns the complete directory history as a ContentChange
+     * @returns the latest directory history as a ContentChange
      */
     static async get_directory_history(directory) {
         directory = btoa(directory);
-        const api_url = BasicCloudApi.base_url + "/api/directory/" + directory + "/history";
+        const api_url = BasicCloudApi.base_url + "/api/directory/" + directory + "/history?descending=true";
         const response = await fetch(api_url,
             {
                 method: "GET",
@@ -228,11 +228,11 @@ export default class BasicCloudApi {
     /**
      * get the files history
      * @param {string} file_path - the file to get the history
-     * @returns the complete file history as a ContentChange
+     * @returns the latest files history as a ContentChange
      */
     static async get_file_history(file_path) {
         file_path = btoa(file_path);
-        const api_url = BasicCloudApi.base_url + "/api/file/" + file_path + "/history";
+        const api_url = BasicCloudApi.base_url + "/api/file/" + file_path + "/history?descending=true";
         const response = await fetch(api_url,
             {
                 method: "GET",